@@ -1,8 +1,18 @@
-import streamlit as st
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 import io
-
+import upload_cache
+import snapshots
+import schema
+import compact
+import profiling
+import pipeline
+import results
+import grid
+import exports
+
+@lru_cache(maxsize=None)
 def create_sample_file():
     # Creating a sample DataFrame with the required headers
     sample_data = {
@@ -19,72 +29,94 @@ def create_sample_file():
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         sample_df.to_excel(writer, index=False, sheet_name='Sample Data')
         writer.close()  # Close the writer
-    output.seek(0)
-
-    return output
-
-def process_data(file1, file2, threshold):
-    # Read the files into DataFrames
-    df = pd.read_excel(file1)
-    new_df = pd.read_excel(file2)
-
-    # Ensure 'Shop Rcv Qty' and 'Disp. Qty' are numeric
-    df['Shop Rcv Qty'] = pd.to_numeric(df['Shop Rcv Qty'], errors='coerce')
-    df['Disp. Qty'] = pd.to_numeric(df['Disp. Qty'], errors='coerce')
 
+    # Built once per process, so hand out immutable bytes rather than the buffer
+    return output.getvalue()
+
+# Columns read from the sales upload and the incoming stock upload; see schema.py.
+# Sales rows without a store still count towards their UPC's sell-through.
+SALES_SCHEMA = [
+    schema.field('STORE_NAME'),
+    schema.field('UPC', drop_blank=True),
+    schema.field('Shop Rcv Qty', 'numeric'),
+    schema.field('Disp. Qty', 'numeric'),
+    schema.field('Sold Qty', 'numeric')
+]
+SALES_COLUMNS = schema.columns(SALES_SCHEMA)
+SALES_DTYPES = schema.dtypes(SALES_SCHEMA)
+STOCK_SCHEMA = [
+    schema.field('UPC', drop_blank=True),
+    schema.field('QTY', 'numeric')
+]
+STOCK_COLUMNS = schema.columns(STOCK_SCHEMA)
+STOCK_DTYPES = schema.dtypes(STOCK_SCHEMA)
+
+def load_data(file1, file2):
+    # Both uploads are checked before either is processed
+    df = upload_cache.read_excel(file1, columns=SALES_COLUMNS, dtype=SALES_DTYPES)
+    new_df = upload_cache.read_excel(file2, columns=STOCK_COLUMNS, dtype=STOCK_DTYPES)
+    df = schema.validate(df, SALES_SCHEMA, snapshots.upload_name(file1))
+    new_df = schema.validate(new_df, STOCK_SCHEMA, snapshots.upload_name(file2))
+    return df, new_df
+
+KEY_COLUMNS = ['STORE_NAME', 'UPC']
+
+def normalize_data(df, new_df):
+    df = compact.normalize(df, KEY_COLUMNS)
+    new_df = compact.normalize(new_df, ['UPC'])
+    # Both uploads share one UPC encoding so they can be matched on codes
+    return compact.align_categories([df, new_df], 'UPC')
+
+def process_data(df, new_df, threshold):
     # Create 'Net Rcv' column using the formula
     df['Net Rcv'] = df['Shop Rcv Qty'] - df['Disp. Qty']
 
-    # Convert 'Sold Qty' to numeric
-    df['Sold Qty'] = pd.to_numeric(df['Sold Qty'], errors='coerce')
-
     # Calculate sell-through rate
     df['Sell Through Rate (%)'] = ((df['Sold Qty'] / df['Net Rcv']) * 100).round(0)
-    df['Sell Through Rate (%)'].replace([float('inf'), float('-inf'), np.nan], 0, inplace=True)
+    df['Sell Through Rate (%)'] = df['Sell Through Rate (%)'].replace([float('inf'), float('-inf'), np.nan], 0)
 
     # Calculate UPC-specific sell-through rate
-    df['UPC Sell Through Rate (%)'] = df.groupby('UPC')['Sold Qty'].transform('sum') / df.groupby('UPC')['Net Rcv'].transform('sum') * 100
-    df['UPC Sell Through Rate (%)'].replace([float('inf'), float('-inf'), np.nan], 0, inplace=True)
+    df['UPC Sell Through Rate (%)'] = df.groupby('UPC', observed=True)['Sold Qty'].transform('sum') / df.groupby('UPC', observed=True)['Net Rcv'].transform('sum') * 100
+    df['UPC Sell Through Rate (%)'] = df['UPC Sell Through Rate (%)'].replace([float('inf'), float('-inf'), np.nan], 0)
     df['UPC Sell Through Rate (%)'] = df['UPC Sell Through Rate (%)'].round(0)
 
     # Add a 'Status' column based on the comparison of sell-through rates
-    df['Status'] = np.where(df['Sell Through Rate (%)'] > threshold, 'High', 'Low')
+    df['Status'] = compact.status(df['Sell Through Rate (%)'] > threshold)
 
     # Create a pivot table
     pivot_table = df.pivot_table(values=['Net Rcv', 'Sold Qty', 'Sell Through Rate (%)', 'UPC Sell Through Rate (%)', 'Status'], 
                                  index=['STORE_NAME', 'UPC'], 
                                  aggfunc={'Net Rcv': 'sum', 'Sold Qty': 'sum', 'Sell Through Rate (%)': 'first', 
-                                          'UPC Sell Through Rate (%)': 'first', 'Status': 'first'})
+                                          'UPC Sell Through Rate (%)': 'first', 'Status': 'first'},
+                                 observed=True)
 
     # Process new_df to allocate stock
-    pivot_table['Transfer Qty'] = 0
-
-    high_priority_stores = pivot_table[pivot_table['Status'] == 'High'].copy()
-    high_priority_stores.sort_values(['Sell Through Rate (%)', 'UPC Sell Through Rate (%)'], ascending=[False, False], inplace=True)
+    pivot_table['Transfer Qty'] = allocate_stock(pivot_table, new_df)
 
-    for index, row in new_df.iterrows():
-        upc = row['UPC']
-        qty_to_distribute = row['QTY']
-
-        eligible_stores = high_priority_stores.loc[high_priority_stores.index.get_level_values('UPC') == upc]
+    return pivot_table.reset_index()
 
-        for store_index, store_row in eligible_stores.iterrows():
-            if qty_to_distribute <= 0:
-                break
+def allocate_stock(pivot_table, new_df):
+    high_priority_stores = pivot_table[pivot_table['Status'] == 'High']
+    high_priority_stores = high_priority_stores.sort_values(['Sell Through Rate (%)', 'UPC Sell Through Rate (%)'], ascending=[False, False])
 
-            if store_row['Sold Qty'] < 0:
-                additional_transfer = 0
-            else:
-                max_transferable = min(store_row['Sold Qty'], qty_to_distribute)
-                current_transfer = pivot_table.loc[store_index, 'Transfer Qty']
-                additional_transfer = min(max_transferable, store_row['Sold Qty'] - current_transfer)
+    # Incoming stock per UPC; rows with no positive QTY distribute nothing
+    incoming_qty = new_df['QTY'].fillna(0).clip(lower=0)
+    incoming_qty = incoming_qty.groupby(new_df['UPC'], sort=False, observed=True).sum()
 
-            pivot_table.loc[store_index, 'Transfer Qty'] += additional_transfer
-            qty_to_distribute -= additional_transfer
+    # Fill stores in priority order, each capped at its Sold Qty
+    upcs = high_priority_stores.index.get_level_values('UPC')
+    capacity = high_priority_stores['Sold Qty'].clip(lower=0)
+    filled_before = capacity.groupby(upcs, sort=False, observed=True).cumsum() - capacity
+    # Looked up by plain values: mapping the categorical level can return a Categorical
+    available = pd.Series(incoming_qty.reindex(np.asarray(upcs)).fillna(0).to_numpy(), index=high_priority_stores.index)
+    transfer_qty = (available - filled_before).clip(lower=0, upper=capacity)
 
-    return pivot_table.reset_index()
+    return transfer_qty.reindex(pivot_table.index, fill_value=0).fillna(0).astype(np.int64)
 
 def main():
+    # Only the page needs Streamlit; the pipeline above also runs headless from batch.py
+    import streamlit as st
+
     st.title('Assortment✍')
     
     # Provide the sample file for download
@@ -95,16 +127,50 @@ def main():
     # File upload and processing section
     st.markdown("### Upload Files for Processing")
     file1 = st.file_uploader("Upload the first Excel file", type=["xlsx"])
+    if file1 is None:
+        file1 = snapshots.picker(SALES_COLUMNS, SALES_DTYPES, key='assortment_sales')
     file2 = st.file_uploader("Upload the second Excel file", type=["xlsx"])
+    if file2 is None:
+        file2 = snapshots.picker(STOCK_COLUMNS, STOCK_DTYPES, key='assortment_stock')
     threshold = st.number_input("Set Sell-Through Threshold (%)", min_value=0, max_value=100, value=50, step=1)
     
     if file1 is not None and file2 is not None and st.button("Process Data"):
-        result = process_data(file1, file2, threshold)
+        report = []
+        trace = profiling.tracing_enabled()
+        try:
+            df, new_df = profiling.record(report, 'load_data', load_data, [file1, file2], trace)
+        except schema.SchemaError as error:
+            st.error(str(error))
+            return
+        # Parse reports, and the rows dropped for a missing key
+        st.caption(df.attrs.get('note'))
+        st.caption(new_df.attrs.get('note'))
+        st.caption(upload_cache.stats_report())
+        df, new_df = profiling.record(report, 'normalize_data', normalize_data, [df, new_df], trace)
+        st.caption(df.attrs['note'])
+        result = profiling.record(report, 'process_data', process_data, [df, new_df, threshold], trace)
+        st.session_state.assortment_stage_report = report
+        # Kept in the shared result store, so paging through it reruns nothing
+        st.session_state.assortment_result = results.put(pipeline.source_fingerprint(result), result)
         st.success("Data processed successfully!")
-        st.dataframe(result)
-        st.download_button(label="Download Result", data=result.to_csv(index=False), file_name='result.csv', mime='text/csv')
     elif st.button("Process Data"):
         st.error("Please upload both files to proceed.")
 
+    handle = st.session_state.get('assortment_result')
+    # Converted from the store once per result, not on every rerun
+    kept = st.session_state.get('assortment_frame')
+    if kept is not None and kept[0] == handle:
+        result = kept[1]
+    else:
+        result = results.get(handle) if handle is not None else None
+        st.session_state.assortment_frame = (handle, result) if result is not None else None
+    if result is not None:
+        grid.view(result, key='assortment')
+        # Built once per result rather than on every rerun
+        data = exports.export('CSV', {'result': result}, {'result': handle})
+        st.download_button(label="Download Result", data=data, file_name='result.csv', mime='text/csv')
+
+    profiling.panel(st.session_state.get('assortment_stage_report'))
+
 if __name__ == "__main__":
     main()
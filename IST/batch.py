@@ -0,0 +1,145 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+import exports
+import flow
+import loader
+import outofcore
+import pipeline
+import transfers
+import upload_cache
+
+# Headless runner for the IST pages, for scheduled jobs that cannot click
+# through Streamlit. Every input workbook goes through the page's
+# run_pipeline in a worker process and its processed data and transfer
+# details are written next to each other in the output directory:
+#
+#   python batch.py regional plans/ --launch-date 2024-03-01 --output-dir out
+#
+# The page modules only import Streamlit inside main(), so nothing here does.
+
+PAGES = ['network', 'regional', 'city']
+OUTPUTS = {'filtered_data': 'processed_data', 'transfer_details': 'transfer_details'}
+
+
+def find_inputs(paths, engine='pandas'):
+    extensions = ('.xlsx',) + (tuple(outofcore.SCANNED_EXTENSIONS) if engine != 'pandas' else ())
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path)
+                           if name.lower().endswith(extensions) and not name.startswith('~$'))
+            files.extend(os.path.join(path, name) for name in names)
+        else:
+            files.append(path)
+    return files
+
+
+def process_file(page, path, output_dir, fmt, threshold_date, sell_through_threshold, days_threshold, engine='pandas',
+                 transfer_method='greedy', costs_file=None, as_of=None):
+    # Runs in a worker process; returns a summary rather than the frames
+    start = time.perf_counter()
+    module = importlib.import_module(page)
+    # Files are already spread over the cores, so each one parses its sheets
+    # and matches (or optimises) transfers serially
+    loader.WORKERS = 1
+    transfers.WORKERS = 1
+    stem = os.path.splitext(os.path.basename(path))[0]
+    extension, _ = exports.FORMATS[fmt]
+    try:
+        outputs, report = module.run_pipeline(path, threshold_date, sell_through_threshold, days_threshold, engine=engine,
+                                              transfer_method=transfer_method, costs_file=costs_file, as_of=as_of)
+        written = []
+        for name, suffix in OUTPUTS.items():
+            target = os.path.join(output_dir, f'{stem}_{suffix}.{extension}')
+            with open(target, 'wb') as handle:
+                handle.write(exports.build(fmt, {'Sheet1': outputs[name]}))
+            written.append(target)
+        summary = {
+            'file': path,
+            'ok': True,
+            'rows': len(outputs['filtered_data']),
+            'transfers': len(outputs['transfer_details']),
+            'written': written,
+            'stages': [{key: entry[key] for key in ('stage', 'seconds', 'rows_in', 'rows_out')} for entry in report]
+        }
+    except Exception as error:
+        summary = {'file': path, 'ok': False, 'error': f'{type(error).__name__}: {error}'}
+    finally:
+        # Files are not revisited, so caching them would only hold memory
+        upload_cache.clear()
+        pipeline.clear()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run(page, files, output_dir, fmt, threshold_date, sell_through_threshold, days_threshold, workers=None, engine='pandas',
+        transfer_method='greedy', costs_file=None, as_of=None):
+    os.makedirs(output_dir, exist_ok=True)
+    # Every file of the batch is planned as of the same day
+    as_of = as_of or date.today()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(process_file, page, path, output_dir, fmt, threshold_date, sell_through_threshold, days_threshold, engine,
+                        transfer_method, costs_file, as_of): path
+            for path in files
+        }
+        for future in as_completed(futures):
+            summary = future.result()
+            _print_summary(summary)
+            summaries[futures[future]] = summary
+    return [summaries[path] for path in files]
+
+
+def _print_summary(summary):
+    if summary['ok']:
+        slowest = max(summary['stages'], key=lambda entry: entry['seconds'])
+        print(f"{summary['seconds']:>8.2f}s  {summary['file']}: {summary['rows']:,} rows, "
+              f"{summary['transfers']:,} transfers (slowest stage {slowest['stage']} {slowest['seconds']:.2f}s)")
+    else:
+        print(f"{summary['seconds']:>8.2f}s  {summary['file']}: failed, {summary['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an IST plan over Excel uploads without the Streamlit app")
+    parser.add_argument('page', choices=PAGES)
+    parser.add_argument('inputs', nargs='+', help="workbooks, or directories of .xlsx workbooks (and .csv/.parquet files with the duckdb or polars engine)")
+    parser.add_argument('--launch-date', type=date.fromisoformat, required=True, help="season launch date, YYYY-MM-DD")
+    parser.add_argument('--sell-through', type=int, default=60, help="sell-through threshold in %% (default 60)")
+    parser.add_argument('--min-age', type=int, default=30, help="minimum age in days (default 30)")
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--format', choices=list(exports.FORMATS), default='Excel')
+    parser.add_argument('--engine', choices=list(pipeline.ENGINE_LABELS), default='pandas',
+                        help="duckdb computes the plan out of core, spilling to disk; polars as one lazy query")
+    parser.add_argument('--transfer-method', choices=list(flow.METHOD_LABELS), default='greedy',
+                        help="optimal plans the lowest-cost transfers, priced by --costs")
+    parser.add_argument('--costs', help="workbook of From Store, To Store, Cost rows for --transfer-method optimal")
+    parser.add_argument('--as-of', type=date.fromisoformat, help="date ages are counted to, YYYY-MM-DD (default today)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--report', help="also write the per-file summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    files = find_inputs(args.inputs, args.engine)
+    if not files:
+        parser.error("no input files found in the given inputs")
+    start = time.perf_counter()
+    summaries = run(args.page, files, args.output_dir, args.format, args.launch_date,
+                    args.sell_through, args.min_age, args.workers, args.engine, args.transfer_method, args.costs,
+                    args.as_of)
+    failed = [summary for summary in summaries if not summary['ok']]
+    print(f"{len(files) - len(failed)} of {len(files)} files processed in {time.perf_counter() - start:.2f}s")
+    if args.report:
+        with open(args.report, 'w') as handle:
+            json.dump(summaries, handle, indent=2, default=str)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,370 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+import exports
+import flow
+import snapshots
+import upload_cache
+
+# Benchmark suite for the planning pages.
+#
+# A seeded generator builds chain-scale uploads for network, regional, city
+# and assortment: stores roll up into cities and zones, designs, UPCs and
+# stores follow a power-law popularity so sales are skewed, and a share of
+# the receipt dates are blank, decades old or in the future. Each page is
+# then run stage by stage, from load_data through to_excel, and the wall
+# time, peak traced memory and row counts of every stage are written as
+# JSON together with the commit they were measured on. Stages are called
+# directly, so nothing is served from the stage or upload caches.
+#
+#   python benchmark.py --sizes 10000 100000 --output before.json
+#   python benchmark.py --sizes 10000 100000 --compare before.json
+#
+# Workbooks stop at 1,048,576 rows, so larger sizes hand the generated frame
+# straight to the first in-memory stage and record load_data and to_excel
+# as skipped.
+#
+# The transfer stage is also timed with the lowest-cost planner, against a
+# generated cost table listing each store's nearest stores on a plane:
+#
+#   python benchmark.py --pages network --sizes 1000000 --stores 1000 --designs 30000
+
+PAGES = ['network', 'regional', 'city', 'assortment']
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+SHEET_ROWS = 1_048_576
+
+THRESHOLD_DATE = date(2024, 3, 1)
+SELL_THROUGH_THRESHOLD = 50
+DAYS_THRESHOLD = 30
+
+# Destinations listed per store in the generated cost table
+LISTED_COSTS = 40
+
+FIRST_RECEIPT = pd.Timestamp('2023-01-01')
+RECEIPT_SPAN_DAYS = 700
+# Ages are counted to, and future receipts dated after, this fixed day, so a
+# seed gives the same data and timings whenever the suite runs
+AS_OF = date(2025, 1, 1)
+
+
+def _popularity(count, skew):
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    return weights / weights.sum()
+
+
+def _names(prefix, count):
+    return np.array([f'{prefix}{number:05d}' for number in range(1, count + 1)], dtype=object)
+
+
+def _receipt_dates(rng, rows, as_of):
+    offsets = rng.integers(0, RECEIPT_SPAN_DAYS, rows)
+    dates = (FIRST_RECEIPT + pd.to_timedelta(offsets, unit='D')).to_numpy().copy()
+    dirt = rng.random(rows)
+    dates[dirt < 0.03] = np.datetime64('NaT')
+    dates[(dirt >= 0.03) & (dirt < 0.05)] = np.datetime64('1900-01-01')
+    future = dirt >= 0.99
+    dates[future] = (pd.Timestamp(as_of) + pd.to_timedelta(rng.integers(30, 200, future.sum()), unit='D')).to_numpy()
+    return dates
+
+
+def _quantities(rng, rows, appeal):
+    received = rng.poisson(12, rows) * rng.integers(1, 6, rows)
+    received[rng.random(rows) < 0.02] = 0
+    dispatched = rng.binomial(received, 0.05)
+    sold = rng.binomial(received - dispatched, appeal)
+    on_hand = np.maximum(received - dispatched - sold + rng.integers(-2, 3, rows), 0)
+    return {'Shop Rcv Qty': received, 'Disp. Qty': dispatched, 'O.H Qty': on_hand, 'Sold Qty': sold}
+
+
+def generate(page, rows, seed=0, stores=300, designs=5000, zones=8, cities=40, upcs=20000):
+    # Returns {upload name: frame} in the layout the page's uploader expects
+    rng = np.random.default_rng(seed)
+    store_names = _names('Store', stores)
+    store = rng.choice(stores, rows, p=_popularity(stores, 0.6))
+
+    if page == 'assortment':
+        upc_codes = 8900000000000 + np.arange(upcs)
+        upc = rng.choice(upcs, rows, p=_popularity(upcs, 1.1))
+        appeal = rng.beta(2, 3, upcs)[upc]
+        quantities = _quantities(rng, rows, appeal)
+        sales = pd.DataFrame({'STORE_NAME': store_names[store], 'UPC': upc_codes[upc]})
+        for name in ['Shop Rcv Qty', 'Disp. Qty', 'Sold Qty']:
+            sales[name] = quantities[name]
+        stock_rows = max(upcs * 4 // 5, 1)
+        stock = pd.DataFrame({
+            'UPC': upc_codes[rng.choice(upcs, stock_rows)],
+            'QTY': rng.integers(-20, 400, stock_rows)
+        })
+        return {'sales': sales, 'stock': stock}
+
+    design = rng.choice(designs, rows, p=_popularity(designs, 1.1))
+    appeal = rng.beta(2, 3, designs)[design]
+    data = {}
+    if page == 'regional':
+        data['Zone'] = _names('Zone', zones)[store % cities % zones]
+    elif page == 'city':
+        data['City'] = _names('City', cities)[store % cities]
+    data['DESIGN'] = _names('Design', designs)[design]
+    data['STORE_NAME'] = store_names[store]
+    data['1st Rcv Date'] = _receipt_dates(rng, rows, AS_OF)
+    data.update(_quantities(rng, rows, appeal))
+    return {'sales': pd.DataFrame(data)}
+
+
+def generate_costs(stores, seed=0, listed=LISTED_COSTS):
+    # A cost table for the stores generate() names: each store lists its
+    # nearest stores, costed by distance on a unit square
+    rng = np.random.default_rng(seed)
+    store_names = _names('Store', stores)
+    points = rng.random((stores, 2))
+    listed = min(listed, stores - 1)
+    senders, destinations = [], []
+    for start in range(0, stores, 1000):
+        # Distances are taken a block of stores at a time
+        distance = np.linalg.norm(points[start:start + 1000, None, :] - points[None, :, :], axis=2)
+        nearest = np.argsort(distance, axis=1)[:, 1:listed + 1]
+        senders.append(np.repeat(np.arange(start, start + len(nearest)), listed))
+        destinations.append(nearest.ravel())
+    senders, destinations = np.concatenate(senders), np.concatenate(destinations)
+    return pd.DataFrame({
+        'From Store': store_names[senders],
+        'To Store': store_names[destinations],
+        'Cost': np.round(np.linalg.norm(points[senders] - points[destinations], axis=1) * 100, 2)
+    })
+
+
+def write_uploads(frames, directory, stem):
+    paths = {}
+    for name, df in frames.items():
+        paths[name] = os.path.join(directory, f'{stem}_{name}.xlsx')
+        exports.write_xlsx({'Sheet1': df}, paths[name])
+    return paths
+
+
+def _rows(value):
+    if isinstance(value, (tuple, list)):
+        return sum(_rows(item) or 0 for item in value)
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+
+def _copy(value):
+    if isinstance(value, (tuple, list)):
+        return type(value)(_copy(item) for item in value)
+    return value.copy() if isinstance(value, pd.DataFrame) else value
+
+
+def _call(func, args):
+    # Inputs are copied before the clock starts, since stages may modify them,
+    # and parsed uploads are dropped so load stages always parse
+    args = [_copy(arg) for arg in args]
+    upload_cache.clear()
+    start = time.perf_counter()
+    value = func(*args)
+    return value, time.perf_counter() - start
+
+
+def _measure(records, name, func, args, trace):
+    value, seconds = _call(func, args)
+    record = {'stage': name, 'seconds': seconds, 'rows_in': _rows(list(args)), 'rows_out': _rows(value)}
+    if isinstance(value, bytes):
+        record['bytes_out'] = len(value)
+    if trace:
+        # tracemalloc slows Python-level loops several times over, so memory
+        # is measured in a second run of the stage rather than the timed one
+        tracemalloc.start()
+        try:
+            _call(func, args)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        record['peak_bytes'] = peak
+        record['retained_bytes'] = current
+    records.append(record)
+    return value
+
+
+def _skip(records, name, reason):
+    records.append({'stage': name, 'skipped': reason})
+
+
+def _excel(*frames):
+    return exports.to_xlsx({f'Sheet{number}': df for number, df in enumerate(frames, 1)})
+
+
+def run_stage_graph(module, upload, frame, trace, costs=None):
+    params = {
+        'threshold_date': THRESHOLD_DATE,
+        'sell_through_threshold': SELL_THROUGH_THRESHOLD,
+        'days_threshold': DAYS_THRESHOLD,
+        'transfer_method': 'greedy',
+        'as_of': AS_OF
+    }
+    records = []
+    # Optional sources are left out, as when nothing is uploaded for them
+    results = {'costs': None}
+    for s in module.STAGES:
+        if s.inputs and all(results.get(name, '') is None for name in s.inputs):
+            # Nothing to time for a source that is not given
+            results[s.name] = None
+            continue
+        if s.inputs == ('upload',):
+            if upload is None:
+                _skip(records, s.name, 'exceeds the workbook row limit')
+                results[s.name] = frame
+                continue
+            args = [upload]
+        else:
+            args = [results[name] for name in s.inputs]
+        args += [params[name] for name in s.params]
+        results[s.name] = _measure(records, s.name, s.func, args, trace)
+
+    filtered, details = results['filtered_data'], results['transfer_details']
+    if costs is not None:
+        _measure(records, 'transfer_details (lowest cost)', module.process_transfer_details, [filtered, costs, 'optimal'], trace)
+    if max(len(filtered), len(details)) >= SHEET_ROWS:
+        _skip(records, 'to_excel', 'exceeds the workbook row limit')
+    else:
+        _measure(records, 'to_excel', _excel, [filtered, details], trace)
+    return records
+
+
+def run_assortment(module, uploads, frames, trace):
+    records = []
+    if uploads is None:
+        _skip(records, 'load_data', 'exceeds the workbook row limit')
+        data = (frames['sales'], frames['stock'])
+    else:
+        data = _measure(records, 'load_data', module.load_data, [uploads['sales'], uploads['stock']], trace)
+    df, new_df = _measure(records, 'normalize_data', module.normalize_data, list(data), trace)
+    result = _measure(records, 'process_data', module.process_data, [df, new_df, SELL_THROUGH_THRESHOLD], trace)
+    if len(result) >= SHEET_ROWS:
+        _skip(records, 'to_excel', 'exceeds the workbook row limit')
+    else:
+        _measure(records, 'to_excel', _excel, [result], trace)
+    return records
+
+
+def run_page(page, rows, seed, directory, trace=True, optimal=True, **shape):
+    # Load stages are timed as parses, so stored snapshots are never opened
+    enabled, snapshots.ENABLED = snapshots.ENABLED, False
+    try:
+        module = importlib.import_module(page)
+        frames = generate(page, rows, seed, **shape)
+        uploads = None
+        if rows < SHEET_ROWS:
+            uploads = write_uploads(frames, directory, f'{page}_{rows}_{seed}')
+        if page == 'assortment':
+            records = run_assortment(module, uploads, frames, trace)
+        else:
+            costs = generate_costs(shape.get('stores', 300), seed) if optimal else None
+            records = run_stage_graph(module, uploads and uploads['sales'], frames['sales'], trace, costs)
+    finally:
+        snapshots.ENABLED = enabled
+    for record in records:
+        record.update(page=page, rows=rows, seed=seed)
+    return records
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(seed, trace):
+    return {
+        'commit': _commit(),
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'seed': seed,
+        'memory_traced': trace
+    }
+
+
+def _key(record):
+    return record['page'], record['rows'], record['stage']
+
+
+def compare(baseline, results):
+    # Returns (key, baseline seconds, current seconds, ratio) for stages measured in both
+    before = {_key(record): record for record in baseline['results'] if 'seconds' in record}
+    rows = []
+    for record in results['results']:
+        old = before.get(_key(record))
+        if old is None or 'seconds' not in record:
+            continue
+        ratio = record['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        rows.append((_key(record), old['seconds'], record['seconds'], ratio))
+    return rows
+
+
+def _print_record(record):
+    label = f"{record['page']:<11}{record['rows']:>11,}  {record['stage']:<32}"
+    if 'skipped' in record:
+        print(f"{label}skipped ({record['skipped']})")
+        return
+    memory = f"{record['peak_bytes'] / 1024 ** 2:>10.1f} MB" if 'peak_bytes' in record else ''
+    if record['rows_out'] is not None:
+        size = f"{record['rows_out']:>12,} rows"
+    else:
+        size = f"{record.get('bytes_out', 0) / 1024 ** 2:>12.1f} MB written"
+    print(f"{label}{record['seconds']:>9.3f}s{memory}{size}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the planning pages on generated data")
+    parser.add_argument('--pages', nargs='+', choices=PAGES, default=PAGES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stores', type=int, default=300)
+    parser.add_argument('--designs', type=int, default=5000)
+    parser.add_argument('--zones', type=int, default=8)
+    parser.add_argument('--cities', type=int, default=40)
+    parser.add_argument('--upcs', type=int, default=20000)
+    parser.add_argument('--no-memory', action='store_true', help="skip the second, traced run of every stage")
+    parser.add_argument('--no-optimal', action='store_true', help="skip timing the lowest-cost transfer planner")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare wall times against")
+    args = parser.parse_args(argv)
+
+    trace = not args.no_memory
+    shape = {name: getattr(args, name) for name in ['stores', 'designs', 'zones', 'cities', 'upcs']}
+    results = {'meta': dict(metadata(args.seed, trace), shape=shape), 'results': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.sizes:
+            for page in args.pages:
+                for record in run_page(page, rows, args.seed, directory, trace, not args.no_optimal, **shape):
+                    _print_record(record)
+                    results['results'].append(record)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        print(f"\nCompared with {baseline['meta'].get('commit')}:")
+        for (page, rows, stage_name), before, after, ratio in compare(baseline, results):
+            print(f"{page:<11}{rows:>11,}  {stage_name:<32}{before:>9.3f}s → {after:>9.3f}s  {ratio:>6.2f}×")
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
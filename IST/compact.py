@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Compact column representation for the planning frames. Key columns become
+# categoricals with lexically sorted categories, so groupby output keeps the
+# same order as with plain strings, and integer quantities are stored as
+# int32 when even their column total fits, so no group sum can overflow.
+# merge() aligns categorical keys to one shared set of categories first,
+# because pandas silently falls back to object keys when they differ.
+
+STATUS_CATEGORIES = ['High', 'Low']
+
+_INT32 = np.iinfo(np.int32)
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(before, after):
+    ratio = before / after if after else 0
+    return f"Memory {before / 1024 ** 2:.1f} MB → {after / 1024 ** 2:.1f} MB after compacting ({ratio:.1f}× smaller)"
+
+
+def to_category(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    return series.astype('category')
+
+
+def downcast(series):
+    if not pd.api.types.is_integer_dtype(series.dtype) or series.dtype.itemsize <= 4:
+        return series
+    if len(series) and int(series.abs().sum()) > _INT32.max:
+        return series
+    return series.astype(np.int32)
+
+
+def normalize(df, key_columns):
+    before = frame_bytes(df)
+    for name in key_columns:
+        if name in df.columns:
+            df[name] = to_category(df[name])
+    for name in df.columns:
+        if name not in key_columns:
+            df[name] = downcast(df[name])
+    df.attrs['note'] = memory_report(before, frame_bytes(df))
+    return df
+
+
+def status(condition):
+    return pd.Categorical.from_codes(np.where(condition, 0, 1), categories=STATUS_CATEGORIES)
+
+
+def align_categories(frames, column):
+    if not any(isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+        return frames
+    categories = None
+    for df in frames:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.categories
+        else:
+            values = pd.Index(series.dropna().unique())
+        if categories is None:
+            categories = values
+        elif not categories.equals(values):
+            categories = categories.union(values)
+    shared = pd.CategoricalDtype(categories)
+    return [df if df[column].dtype == shared else df.assign(**{column: df[column].astype(shared)}) for df in frames]
+
+
+def merge(left, right, on, **kwargs):
+    keys = [on] if isinstance(on, str) else list(on)
+    categorical = [name for name in keys
+                   if isinstance(left[name].dtype, pd.CategoricalDtype) or isinstance(right[name].dtype, pd.CategoricalDtype)]
+    for name in categorical:
+        left, right = align_categories([left, right], name)
+    merged = pd.merge(left, right, on=on, **kwargs)
+    lost = [name for name in categorical if not isinstance(merged[name].dtype, pd.CategoricalDtype)]
+    if lost:
+        raise TypeError(f"Merge on {lost} fell back to object keys")
+    return merged
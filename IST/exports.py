@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+import pandas as pd
+
+# Download builders shared by every page. Workbooks are written row by row
+# with xlsxwriter's constant_memory mode, so only one row is held in the
+# writer at a time, and nothing is built until a download is requested.
+# Finished files are cached by the fingerprints of the frames they contain.
+
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+FORMATS = {
+    'Excel': ('xlsx', XLSX_MIME),
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet')
+}
+
+MAX_BYTES = 512 * 1024 * 1024
+CHUNK_ROWS = 50000
+
+# Rows in an Excel worksheet, the header row included
+XLSX_MAX_ROWS = 1_048_576
+
+_files = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cell_values(series):
+    values = series.astype(object)
+    return values.where(series.notna(), None).tolist()
+
+
+def fits_xlsx(df):
+    return len(df) < XLSX_MAX_ROWS
+
+
+def write_xlsx(sheets, output):
+    import xlsxwriter
+
+    # xlsxwriter skips rows past the limit instead of failing
+    for sheet_name, df in sheets.items():
+        if not fits_xlsx(df):
+            raise ValueError(f"'{sheet_name}' has {len(df):,} rows, more than an Excel sheet holds "
+                             f"({XLSX_MAX_ROWS - 1:,} below the header); export it as CSV or Parquet")
+
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        'nan_inf_to_errors': True,
+        'remove_timezone': True
+    })
+    for sheet_name, df in sheets.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, [str(name) for name in df.columns])
+        for start in range(0, len(df), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS]
+            columns = [_cell_values(chunk[name]) for name in chunk.columns]
+            for offset, row in enumerate(zip(*columns)):
+                if worksheet.write_row(start + offset + 1, 0, row) == -1:
+                    raise ValueError(f"Row {start + offset + 2:,} of '{sheet_name}' is outside the Excel sheet")
+    workbook.close()
+
+
+def to_xlsx(sheets):
+    output = BytesIO()
+    write_xlsx(sheets, output)
+    return output.getvalue()
+
+
+def to_csv(df):
+    return df.to_csv(index=False).encode('utf-8')
+
+
+def to_parquet(df):
+    output = BytesIO()
+    df.to_parquet(output, index=False)
+    return output.getvalue()
+
+
+def build(fmt, sheets):
+    if fmt == 'Excel':
+        return to_xlsx(sheets)
+    if len(sheets) != 1:
+        raise ValueError(f"{fmt} exports hold a single table")
+    df = next(iter(sheets.values()))
+    return to_csv(df) if fmt == 'CSV' else to_parquet(df)
+
+
+def export(fmt, sheets, fingerprints):
+    # fingerprints maps each sheet name to the fingerprint of its frame
+    key = (fmt, tuple((name, fingerprints[name]) for name in sheets))
+    with _lock:
+        if key in _files:
+            _files.move_to_end(key)
+            return _files[key]
+    data = build(fmt, sheets)
+    with _lock:
+        _files[key] = data
+        total = sum(len(value) for value in _files.values())
+        while total > MAX_BYTES and len(_files) > 1:
+            _, evicted = _files.popitem(last=False)
+            total -= len(evicted)
+    return data
+
+
+def _download_button(label, fmt, sheets, fingerprints, stem, key):
+    import streamlit as st
+
+    extension, mime = FORMATS[fmt]
+    st.download_button(
+        label=label,
+        data=lambda: export(fmt, sheets, fingerprints),
+        file_name=f"{stem}.{extension}",
+        mime=mime,
+        key=key,
+        on_click='ignore'
+    )
+
+
+def download_buttons(tables, fingerprints, key):
+    # tables maps a label to (frame, file stem) and fingerprints maps the same
+    # labels to the frames' fingerprints; files are only generated on click
+    import streamlit as st
+
+    for label, (df, stem) in tables.items():
+        if fits_xlsx(df):
+            _download_button(f"Download {label}", 'Excel', {'Sheet1': df}, {'Sheet1': fingerprints[label]}, stem, f'{key}_xlsx_{stem}')
+        else:
+            st.info(f"{label} has {len(df):,} rows, more than an Excel sheet holds; download it as CSV or Parquet below.")
+    if len(tables) > 1 and all(fits_xlsx(df) for df, _ in tables.values()):
+        sheets = {label: df for label, (df, _) in tables.items()}
+        _download_button("Download All Sheets", 'Excel', sheets, fingerprints, f'{key}_plan', f'{key}_xlsx_all')
+    with st.expander("CSV and Parquet downloads"):
+        for label, (df, stem) in tables.items():
+            for fmt in ('CSV', 'Parquet'):
+                _download_button(f"{label} ({fmt})", fmt, {label: df}, {label: fingerprints[label]}, stem, f'{key}_{fmt.lower()}_{stem}')
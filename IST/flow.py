@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+import transfers
+import upload_cache
+
+# Lowest-cost transfer planning, as an alternative to the row-order matcher
+# in transfers.py.
+#
+# Within each group (DESIGN, plus Zone/City where relevant) every store's
+# rows are netted first, so a store either sends or receives. Moving stock
+# is then a transportation problem: ship min(total supply, total demand)
+# at the lowest total cost. Costs come from an optional table of
+# 'From Store' / 'To Store' / 'Cost' rows; pairs missing from it cost as
+# much as the dearest listed pair. All unlisted pairs costing the same is
+# what keeps the problem sparse: they are modelled by one hub node per
+# group, which every sender can ship to and every receiver draw from at
+# half that cost, instead of one variable per store pair. Only listed
+# pairs get their own variable, and only a store's NEIGHBOURS cheapest
+# listed destinations among its group's receivers are kept.
+#
+# Groups are solved as linear programs with HiGHS (through scipy), a block
+# of groups per solve; blocks go to the transfer matcher's process pool.
+# Transportation problems have integral optimal vertices, so the simplex
+# solution is whole units. Flow through a hub is paired off in store order,
+# which costs the same as any other pairing at the optimum. Without a cost
+# table every pairing costs the same and no solver is needed.
+
+COST_COLUMNS = ['From Store', 'To Store', 'Cost']
+COST_DTYPES = {'Cost': 'numeric'}
+
+# Transfer matching methods a page offers
+METHOD_LABELS = {'greedy': "Row order", 'optimal': "Lowest cost"}
+
+NEIGHBOURS = 50
+BLOCK_VARIABLES = 5_000
+
+
+def load_costs(file):
+    # Returns the cost table of an uploaded workbook, or None without one
+    if file is None:
+        return None
+    costs = upload_cache.read_excel(file, columns=COST_COLUMNS, dtype=COST_DTYPES)
+    return costs.dropna()
+
+
+def _positions(filtered_df, group_keys, senders_negative, store_col, value_col):
+    # Net position of every store in every group, split into senders and
+    # receivers, each ordered by group and then store
+    net = filtered_df.groupby(group_keys + [store_col], observed=True)[value_col].sum().reset_index()
+    net['group'] = net.groupby(group_keys, observed=True, sort=False).ngroup()
+    sending = net[value_col] < 0 if senders_negative else net[value_col] > 0
+    receiving = net[value_col] > 0 if senders_negative else net[value_col] < 0
+    senders = net[sending].reset_index(drop=True)
+    receivers = net[receiving].reset_index(drop=True)
+    senders['qty'] = senders[value_col].abs().astype(np.int64)
+    receivers['qty'] = receivers[value_col].abs().astype(np.int64)
+    return net, senders, receivers
+
+
+def _listed_edges(senders, receivers, costs, store_col):
+    # (sender position, receiver position, cost) for a sender's NEIGHBOURS
+    # cheapest listed pairs inside its group
+    listed = costs[costs['From Store'].isin(senders[store_col]) & costs['To Store'].isin(receivers[store_col])]
+    listed = listed.sort_values(['From Store', 'Cost'], kind='stable')
+    # Stores are matched on integer codes shared by both tables
+    codes, uniques = pd.factorize(pd.concat([senders[store_col].astype(object), receivers[store_col].astype(object),
+                                             listed['From Store'].astype(object), listed['To Store'].astype(object)],
+                                            ignore_index=True))
+    sender_store, receiver_store, from_store, to_store = np.split(codes, np.cumsum([len(senders), len(receivers), len(listed)]))
+    order = np.argsort(from_store, kind='stable')
+    from_store, to_store, cost = from_store[order], to_store[order], listed['Cost'].to_numpy(dtype=np.float64)[order]
+
+    n_stores = len(uniques)
+    counts = np.bincount(from_store, minlength=n_stores)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sender_group = senders['group'].to_numpy(dtype=np.int64)
+    receiver_key = receivers['group'].to_numpy(dtype=np.int64) * n_stores + receiver_store
+    receiver_order = np.argsort(receiver_key, kind='stable')
+    sorted_key = receiver_key[receiver_order]
+
+    # Senders are expanded a batch at a time, so stores with long cost
+    # lists don't materialise every pair at once
+    per_sender = counts[sender_store]
+    batches = np.searchsorted(np.cumsum(per_sender), np.arange(BLOCK_VARIABLES * 100, per_sender.sum(), BLOCK_VARIABLES * 100))
+    edges = []
+    for first, last in zip(np.concatenate([[0], batches]), np.concatenate([batches, [len(senders)]])):
+        # Every sender's listed destinations, cheapest first ...
+        batch = per_sender[first:last]
+        edge_sender = first + np.repeat(np.arange(len(batch)), batch)
+        within = np.arange(len(edge_sender)) - np.repeat(np.cumsum(batch) - batch, batch)
+        position = starts[sender_store][edge_sender] + within
+        # ... where the destination is a receiver of the same group ...
+        edge_key = sender_group[edge_sender] * n_stores + to_store[position]
+        found = np.searchsorted(sorted_key, edge_key).clip(max=max(len(receivers) - 1, 0))
+        keep = sorted_key[found] == edge_key
+        edge_sender, edge_receiver, edge_cost = edge_sender[keep], receiver_order[found[keep]], cost[position[keep]]
+        # ... and only the NEIGHBOURS cheapest of those
+        run_start = np.flatnonzero(np.r_[True, edge_sender[1:] != edge_sender[:-1]]) if len(edge_sender) else np.array([], dtype=np.int64)
+        rank = np.arange(len(edge_sender)) - np.repeat(run_start, np.diff(np.r_[run_start, len(edge_sender)]))
+        nearest = rank < NEIGHBOURS
+        edges.append((edge_sender[nearest], edge_receiver[nearest], edge_cost[nearest]))
+    edge_sender, edge_receiver, edge_cost = (np.concatenate(parts) for parts in zip(*edges))
+    order = np.lexsort((edge_receiver, edge_sender))
+    return edge_sender[order], edge_receiver[order], edge_cost[order]
+
+
+def _solve_block(sender_group, supply, receiver_group, demand, edge_sender, edge_receiver, edge_cost, hub_cost, first_group, n_groups):
+    # One LP for groups first_group .. first_group + n_groups - 1, with
+    # positions local to the block; returns (listed flows, hub-out, hub-in)
+    from scipy.optimize import linprog
+    from scipy.sparse import coo_matrix
+
+    n_senders, n_receivers, n_edges = len(supply), len(demand), len(edge_cost)
+    local_sender_group = sender_group - first_group
+    local_receiver_group = receiver_group - first_group
+    # Variables: listed edges, then sender -> hub, then hub -> receiver
+    hub_out = n_edges + np.arange(n_senders)
+    hub_in = n_edges + n_senders + np.arange(n_receivers)
+    n_variables = n_edges + n_senders + n_receivers
+    cost = np.concatenate([edge_cost, np.full(n_senders + n_receivers, hub_cost / 2)])
+
+    # Rows: one per sender, one per receiver, one per hub
+    receiver_row = n_senders + np.arange(n_receivers)
+    hub_row = n_senders + n_receivers + np.arange(n_groups)
+    rows = np.concatenate([edge_sender, n_senders + edge_receiver, np.arange(n_senders), hub_row[local_sender_group],
+                           receiver_row, hub_row[local_receiver_group]])
+    columns = np.concatenate([np.arange(n_edges), np.arange(n_edges), hub_out, hub_out, hub_in, hub_in])
+    values = np.concatenate([np.ones(2 * n_edges), np.ones(n_senders), np.ones(n_senders), np.ones(n_receivers), -np.ones(n_receivers)])
+    matrix = coo_matrix((values, (rows, columns)), shape=(n_senders + n_receivers + n_groups, n_variables)).tocsr()
+    limits = np.concatenate([supply, demand, np.zeros(n_groups)]).astype(np.float64)
+
+    # The side with less in total ships or receives all of it
+    total_supply = np.bincount(local_sender_group, weights=supply, minlength=n_groups)
+    total_demand = np.bincount(local_receiver_group, weights=demand, minlength=n_groups)
+    supply_short = total_supply <= total_demand
+    equal = np.concatenate([supply_short[local_sender_group], ~supply_short[local_receiver_group], np.ones(n_groups, dtype=bool)])
+
+    result = linprog(cost, A_ub=matrix[~equal], b_ub=limits[~equal], A_eq=matrix[equal], b_eq=limits[equal],
+                     bounds=(0, None), method='highs-ds')
+    if result.status != 0:
+        raise RuntimeError(f"Transfer optimisation failed: {result.message}")
+    flows = np.rint(result.x).astype(np.int64)
+    return flows[:n_edges], flows[hub_out], flows[hub_in]
+
+
+def _blocks(sender_group, receiver_group, edge_group, n_groups):
+    # Cuts the groups into runs of about BLOCK_VARIABLES variables each
+    sizes = (np.bincount(sender_group, minlength=n_groups) + np.bincount(receiver_group, minlength=n_groups)
+             + np.bincount(edge_group, minlength=n_groups))
+    cuts = np.searchsorted(np.cumsum(sizes), np.arange(BLOCK_VARIABLES, sizes.sum(), BLOCK_VARIABLES))
+    cuts = np.unique(np.concatenate([[0], cuts + 1, [n_groups]]).clip(0, n_groups))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _optimal_flows(senders, receivers, costs, store_col, n_groups, workers):
+    # Returns (listed edges and their flows, flow into the hub per sender, out of it per receiver)
+    supply = senders['qty'].to_numpy()
+    demand = receivers['qty'].to_numpy()
+    edge_sender, edge_receiver, edge_cost = _listed_edges(senders, receivers, costs, store_col)
+    listed = np.zeros(len(edge_cost), dtype=np.int64)
+    hub_out, hub_in = supply.copy(), demand.copy()
+
+    # Groups without a listed pair only use the hub, where every pairing
+    # costs the same; the others are renumbered and solved
+    active = np.zeros(n_groups, dtype=bool)
+    active[senders['group'].to_numpy()[edge_sender]] = True
+    rank = np.cumsum(active) - 1
+    sending = np.flatnonzero(active[senders['group'].to_numpy()])
+    receiving = np.flatnonzero(active[receivers['group'].to_numpy()])
+    sender_group = rank[senders['group'].to_numpy()[sending]]
+    receiver_group = rank[receivers['group'].to_numpy()[receiving]]
+    edge_group = sender_group[np.searchsorted(sending, edge_sender)]
+
+    spans, blocks = [], []
+    hub_cost = float(costs['Cost'].max())
+    for first, last in _blocks(sender_group, receiver_group, edge_group, int(active.sum())):
+        s = slice(*np.searchsorted(sender_group, [first, last]))
+        r = slice(*np.searchsorted(receiver_group, [first, last]))
+        e = slice(*np.searchsorted(edge_group, [first, last]))
+        spans.append((s, r, e))
+        blocks.append((sender_group[s], supply[sending[s]], receiver_group[r], demand[receiving[r]],
+                       np.searchsorted(sending, edge_sender[e]) - s.start,
+                       np.searchsorted(receiving, edge_receiver[e]) - r.start,
+                       edge_cost[e], hub_cost, first, last - first))
+    # Blocks are independent, so they go to the matcher's process pool when there is one
+    workers = transfers.WORKERS if workers is None else workers
+    if workers > 1 and len(blocks) > 1:
+        solved = transfers.executor(workers).map(_solve_block, *zip(*blocks))
+    else:
+        solved = (_solve_block(*block) for block in blocks)
+    for (s, r, e), (edge_flow, sender_flow, receiver_flow) in zip(spans, solved):
+        listed[e], hub_out[sending[s]], hub_in[receiving[r]] = edge_flow, sender_flow, receiver_flow
+    return (edge_sender, edge_receiver, listed), hub_out, hub_in
+
+
+def _hub_pairs(sender_group, hub_out, receiver_group, hub_in):
+    # Pairs off what each group's senders put into the hub with what its
+    # receivers take out, in store order
+    senders = np.flatnonzero(hub_out > 0)
+    receivers = np.flatnonzero(hub_in > 0)
+    if not len(senders) or not len(receivers):
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    a, b, qty = transfers.overlap_pairs(sender_group[senders], hub_out[senders], receiver_group[receivers], hub_in[receivers])
+    return senders[a], receivers[b], qty
+
+
+def optimal_transfers(filtered_df, group_keys, senders_negative, costs=None, store_col='STORE_NAME', value_col='Transfer in/out',
+                      workers=None):
+    # Same columns as transfers.transfer_details: group_keys, then
+    # 'Sending Store' / 'Receiving Store' / 'Quantity Transferred'
+    net, senders, receivers = _positions(filtered_df, group_keys, senders_negative, store_col, value_col)
+    n_groups = int(net['group'].max()) + 1 if len(net) else 0
+    sender_group = senders['group'].to_numpy()
+    receiver_group = receivers['group'].to_numpy()
+
+    if costs is None or costs.empty or not len(senders) or not len(receivers):
+        hub_out, hub_in = senders['qty'].to_numpy(), receivers['qty'].to_numpy()
+        direct = (np.array([], dtype=np.int64),) * 3
+    else:
+        direct, hub_out, hub_in = _optimal_flows(senders, receivers, costs, store_col, n_groups, workers)
+    pair_sender, pair_receiver, qty = _hub_pairs(sender_group, hub_out, receiver_group, hub_in)
+
+    moved = direct[2] > 0
+    sender_idx = np.concatenate([direct[0][moved], pair_sender])
+    receiver_idx = np.concatenate([direct[1][moved], pair_receiver])
+    qty = np.concatenate([direct[2][moved], qty])
+
+    result = {key: senders[key].to_numpy()[sender_idx] for key in group_keys}
+    result['group'] = sender_group[sender_idx]
+    result['Sending Store'] = senders[store_col].to_numpy()[sender_idx]
+    result['Receiving Store'] = receivers[store_col].to_numpy()[receiver_idx]
+    result['Quantity Transferred'] = qty
+    result = pd.DataFrame(result)
+    # A pair can be both listed and reached through the hub when its cost is the hub's
+    result = result.groupby(['group', 'Sending Store', 'Receiving Store'], sort=True, observed=True).agg(
+        {**{key: 'first' for key in group_keys}, 'Quantity Transferred': 'sum'}).reset_index()
+    return result[group_keys + ['Sending Store', 'Receiving Store', 'Quantity Transferred']]
+
+
+def transfer_details(filtered_df, group_keys, senders_negative, method='greedy', costs=None, store_col='STORE_NAME'):
+    if method == 'optimal':
+        return optimal_transfers(filtered_df, group_keys, senders_negative, costs, store_col=store_col)
+    return transfers.transfer_details(filtered_df, group_keys, senders_negative, store_col=store_col)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import compact
+
+# Single-pass version of the IST chain that runs from the aggregated frame to
+# the final planning columns (shop sell-through through to the group age;
+# tests/test_fused.py checks it against the step-by-step chain it replaced,
+# one merge per step). Each grouping level is aggregated once and
+# the totals are broadcast back by group code, so no merge copies the frame;
+# the new columns are added to the frame that is passed in.
+#
+# A page describes its levels and column names with a spec:
+#   sell_through_keys  keys of the group sell-through (e.g. ['Zone', 'DESIGN'])
+#   cover_keys         keys of desired cover and group age (e.g. ['Zone'])
+#   shop_sell_through  name of the row-level sell-through column
+#   group_sell_through name of the group sell-through column
+#   age                name of the group age column
+#
+# Ages are whole days from the receipt to the run's as-of date, so the same
+# inputs give the same plan whenever it is run.
+
+
+def _ratio_to_int(values):
+    return pd.Series(values).replace([np.inf, -np.inf, np.nan], 0).astype(int).to_numpy()
+
+
+def _broadcast(df, keys, **aggregations):
+    grouped = df.groupby(keys, observed=True, sort=False)
+    codes = grouped.ngroup().to_numpy()
+    totals = grouped.agg(**aggregations)
+    return {name: totals[name].to_numpy()[codes] for name in aggregations}
+
+
+def build_plan(df, spec, as_of):
+    received = df['Adjusted 1st Rcv Date']
+    as_of = pd.Timestamp(as_of).normalize()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df[spec['shop_sell_through']] = _ratio_to_int(df['Sold Qty'].to_numpy() / (df['Shop Rcv Qty'] - df['Disp. Qty']).to_numpy() * 100)
+        df['Days'] = (as_of - received).dt.days
+        df['Net Receiving'] = df['Shop Rcv Qty'] - df['Disp. Qty']
+
+        totals = _broadcast(df, spec['sell_through_keys'], sold=('Sold Qty', 'sum'), net=('Net Receiving', 'sum'))
+        df[spec['group_sell_through']] = _ratio_to_int(totals['sold'] / totals['net'] * 100)
+        df['Status'] = compact.status(df[spec['shop_sell_through']] > df[spec['group_sell_through']])
+
+        totals = _broadcast(df, spec['cover_keys'], on_hand=('O.H Qty', 'sum'), sold=('Sold Qty', 'sum'), days=('Days', 'max'), first_received=('Adjusted 1st Rcv Date', 'min'))
+        df['desired_cover'] = _ratio_to_int(totals['on_hand'] / (totals['sold'] / totals['days']))
+        df['Transfer in/out'] = _ratio_to_int(df['desired_cover'].to_numpy() * (df['Sold Qty'] / df['Days']).to_numpy() - df['O.H Qty'].to_numpy())
+
+    # The oldest receipt in the group gives the group's age
+    df[spec['age']] = (as_of - pd.DatetimeIndex(totals['first_received'])).days
+    return df
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+# Server-side result grid for the pages.
+#
+# st.dataframe serialises the whole frame to Arrow and sends it to the
+# browser on every rerun, which at a few hundred thousand rows is most of
+# a page's latency. view() keeps the result on the server instead: column
+# filters and the sort are applied here, only the rows of the current page
+# are handed to st.dataframe (and so only they are sent as Arrow), and the
+# per-group summaries are computed here from the filtered rows.
+#
+# Sorting orders row positions by the one sort column rather than
+# reordering the frame, so a page costs a slice of the result, not a copy.
+
+PAGE_SIZES = [50, 100, 500, 1000]
+DEFAULT_PAGE_SIZE = 100
+
+# Columns the summaries group by, where a result has them
+GROUP_COLUMNS = ['Zone', 'City', 'DESIGN']
+
+# Quantities that add up within a group; other numeric columns are averaged
+SUM_COLUMNS = ['Shop Rcv Qty', 'Disp. Qty', 'O.H Qty', 'Sold Qty', 'Net Receiving', 'Transfer in/out', 'Quantity Transferred']
+
+# Text columns with at most this many values are filtered by picking values
+MAX_CHOICES = 500
+
+
+def filter_mask(df, filters):
+    # filters maps a column to (low, high) for numbers and dates, a list of
+    # values, or a substring; returns a boolean array over the rows
+    mask = np.ones(len(df), dtype=bool)
+    for name, condition in filters.items():
+        column = df[name]
+        if isinstance(condition, tuple):
+            low, high = condition
+            mask &= (column >= low).to_numpy(dtype=bool) & (column <= high).to_numpy(dtype=bool)
+        elif isinstance(condition, list):
+            mask &= column.isin(condition).to_numpy(dtype=bool)
+        elif condition:
+            mask &= column.astype(str).str.contains(condition, case=False, regex=False).to_numpy(dtype=bool)
+    return mask
+
+
+def order(df, positions, sort_column=None, ascending=True):
+    # Row positions in display order; ties keep the result's own order
+    if sort_column is None:
+        return positions
+    values = df[sort_column].iloc[positions].reset_index(drop=True)
+    ranked = values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+    return positions[ranked]
+
+
+def window(df, positions, page, page_size):
+    # The rows of one page, with the index the result has
+    start = (page - 1) * page_size
+    return df.iloc[positions[start:start + page_size]]
+
+
+def summary(df, positions, group_column):
+    # One row per group of the given rows: their count, summed quantities
+    # and the mean of the other numeric columns
+    rows = df.iloc[positions]
+    numeric = [name for name in rows.columns
+               if name != group_column and pd.api.types.is_numeric_dtype(rows[name]) and not pd.api.types.is_bool_dtype(rows[name])]
+    sums = [name for name in numeric if name in SUM_COLUMNS]
+    means = [name for name in numeric if name not in SUM_COLUMNS]
+    grouped = rows.groupby(group_column, observed=True, sort=True)
+    result = grouped.size().rename('Rows').to_frame()
+    if sums:
+        result = result.join(grouped[sums].sum())
+    if means:
+        result = result.join(grouped[means].mean().round(2).add_suffix(' (mean)'))
+    return result.reset_index()
+
+
+def _filters(df, key):
+    import streamlit as st
+
+    chosen = st.multiselect("Filter columns", list(df.columns), key=f'{key}_filter_columns')
+    filters = {}
+    for name in chosen:
+        column = df[name]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            low, high = column.min(), column.max()
+            if pd.isna(low):
+                continue
+            picked = st.date_input(name, value=(low.date(), high.date()), key=f'{key}_filter_{name}')
+            if len(picked) == 2:
+                # Through the end of the last day picked
+                filters[name] = (pd.Timestamp(picked[0]), pd.Timestamp(picked[1]) + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns'))
+        elif pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+            low, high = column.min(), column.max()
+            if pd.isna(low) or low == high:
+                continue
+            if pd.api.types.is_integer_dtype(column):
+                low, high = int(low), int(high)
+            else:
+                low, high = float(low), float(high)
+            filters[name] = st.slider(name, min_value=low, max_value=high, value=(low, high), key=f'{key}_filter_{name}')
+        else:
+            values = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column.dropna().unique()
+            if len(values) <= MAX_CHOICES:
+                picked = st.multiselect(name, sorted(values, key=str), key=f'{key}_filter_{name}')
+                if picked:
+                    filters[name] = list(picked)
+            else:
+                filters[name] = st.text_input(f"{name} contains", key=f'{key}_filter_{name}').strip()
+    return filters
+
+
+def _paged(df, positions, key, total=None):
+    # Sort and page controls over the given rows, and the page itself
+    import streamlit as st
+
+    columns = st.columns([3, 1, 1, 1])
+    sort_column = columns[0].selectbox("Sort by", [None] + list(df.columns), format_func=lambda name: name or "—",
+                                       key=f'{key}_sort')
+    descending = columns[1].checkbox("Descending", key=f'{key}_descending')
+    page_size = columns[2].selectbox("Rows per page", PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE),
+                                     key=f'{key}_page_size')
+    pages = max(1, -(-len(positions) // page_size))
+    page = min(columns[3].number_input("Page", min_value=1, value=1, step=1, key=f'{key}_page'), pages)
+    positions = order(df, positions, sort_column, ascending=not descending)
+    st.dataframe(window(df, positions, page, page_size))
+    first = (page - 1) * page_size + 1 if len(positions) else 0
+    shown = f"Rows {first:,}–{min(page * page_size, len(positions)):,} of {len(positions):,}, page {page} of {pages}"
+    if total is not None and total != len(positions):
+        shown += f" (filtered from {total:,})"
+    st.caption(shown)
+
+
+def view(df, key, group_columns=None):
+    # Streamlit grid of a result frame, in place of st.dataframe(df)
+    import streamlit as st
+
+    filters = _filters(df, key)
+    positions = np.flatnonzero(filter_mask(df, filters)) if filters else np.arange(len(df))
+    _paged(df, positions, key, total=len(df))
+
+    groups = [name for name in (group_columns or GROUP_COLUMNS) if name in df.columns]
+    if not groups:
+        return
+    with st.expander("Summary by group"):
+        group_column = st.radio("Group by", groups, horizontal=True, key=f'{key}_group')
+        summarized = summary(df, positions, group_column)
+        _paged(summarized, np.arange(len(summarized)), f'{key}_summary')
@@ -0,0 +1,346 @@
+import argparse
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date
+import numpy as np
+import pandas as pd
+import compact
+import pipeline
+import snapshots
+import upload_cache
+
+# Maintained aggregates for the IST pages, fed by daily deltas instead of
+# a full cumulative export on every run.
+#
+# A state is the page's aggregated_data (one row per aggregation key, with
+# the summed quantities) kept on disk as an Arrow IPC file. Applying a
+# delta workbook runs only the page's load-to-aggregate stages on the delta
+# and upserts the result: quantities are added to the rows with the same
+# key and new keys are inserted. Every quantity in a delta is a change,
+# including O.H Qty. The cost of a refresh grows with the delta and the
+# number of keys, not with the length of the season. Sell-through, cover
+# and transfers are then derived from the state by the page's own stages.
+#
+#   python incremental.py apply regional season24 full_export.xlsx --launch-date 2024-03-01
+#   python incremental.py apply regional season24 delta_0412.xlsx
+#   python incremental.py run regional season24 --output-dir out
+#
+# A state is tied to the season launch date it was started with, since the
+# adjusted receiving dates in its keys depend on it. Deltas are recorded by
+# content hash and applying the same file twice changes nothing. State
+# names become file names, so only letters, digits, spaces, '_' and '-'
+# are accepted. Applying
+# holds a lock file next to the state from reading it to replacing it, so
+# deltas applied at the same time from several processes are all kept.
+
+DIRECTORY = os.path.join(os.path.expanduser('~'), '.ist_state')
+SUFFIX = '.arrow'
+METADATA_KEY = b'ist_state'
+
+# Where a page's data comes from
+SOURCE_LABELS = {'upload': "Full export", 'state': "Maintained state (daily deltas)"}
+
+QUANTITIES = ['Shop Rcv Qty', 'Disp. Qty', 'O.H Qty', 'Sold Qty']
+UPLOAD_STAGES = ('data', 'normalized_data', 'adjusted_data', 'aggregated_data')
+
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9 _-]*')
+
+
+def check_name(name):
+    # Raises ValueError for a state name that is not a plain file name
+    if not NAME_PATTERN.fullmatch(name):
+        raise ValueError(f"State names may only hold letters, digits, spaces, '_' and '-', not {name!r}")
+
+
+def path(page, name):
+    check_name(name)
+    return os.path.join(DIRECTORY, page, f'{name}{SUFFIX}')
+
+
+def states(page):
+    directory = os.path.join(DIRECTORY, page)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len(SUFFIX)] for name in os.listdir(directory) if name.endswith(SUFFIX))
+
+
+@contextmanager
+def _locked(page, name):
+    # Exclusive across processes and threads while held
+    check_name(name)
+    target = os.path.join(DIRECTORY, page, f'{name}.lock')
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'a+b') as handle:
+        if os.name == 'nt':
+            import msvcrt
+
+            handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ten seconds; keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def load(page, name):
+    # Returns (aggregated frame, metadata), or (None, None) for a new state
+    import pyarrow as pa
+
+    target = path(page, name)
+    if not os.path.exists(target):
+        return None, None
+    with pa.memory_map(target, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = json.loads(table.schema.metadata[METADATA_KEY])
+    # Buffers are copied out of the map, since later stages get their own copies anyway
+    return table.to_pandas().copy(), metadata
+
+
+def _save(page, name, df, metadata):
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+    target = path(page, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(target))
+    os.close(handle)
+    try:
+        with pa.OSFile(temporary, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temporary, target)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def aggregate(module, file, threshold_date):
+    # The page's aggregated_data for one upload, through its own stages
+    stages = [s for s in module.STAGES if s.name in UPLOAD_STAGES]
+    outputs, _ = pipeline.run(stages, ['aggregated_data'], {'upload': file}, {'threshold_date': threshold_date})
+    return outputs['aggregated_data']
+
+
+def upsert(state, delta, keys):
+    # Adds the delta's quantities to the state's rows with the same keys and
+    # inserts the rest; rows stay ordered by the keys, as aggregate_data's are
+    frames = [state, delta]
+    for key in keys:
+        frames = compact.align_categories(frames, key)
+    merged = pd.concat(frames, ignore_index=True)
+    for name in QUANTITIES:
+        if pd.api.types.is_integer_dtype(merged[name].dtype):
+            merged[name] = merged[name].astype(np.int64)
+    merged = merged.groupby(keys, observed=True, sort=True)[QUANTITIES].sum().reset_index()
+    for name in QUANTITIES:
+        merged[name] = compact.downcast(merged[name])
+    return merged
+
+
+def apply(module, page, name, file, threshold_date=None):
+    # Applies a delta (or, for a new state, the first full export) and
+    # returns the state's metadata
+    with _locked(page, name):
+        return _apply(module, page, name, file, threshold_date)
+
+
+def _apply(module, page, name, file, threshold_date):
+    state, metadata = load(page, name)
+    if metadata is None:
+        if threshold_date is None:
+            raise ValueError(f"State '{name}' does not exist yet; give the season launch date to start it")
+        metadata = {'page': page, 'threshold_date': pd.Timestamp(threshold_date).date().isoformat(), 'applied': []}
+    elif threshold_date is not None and pd.Timestamp(threshold_date).date().isoformat() != metadata['threshold_date']:
+        raise ValueError(f"State '{name}' was started with launch date {metadata['threshold_date']}")
+
+    digest = upload_cache.content_hash(file)
+    if any(entry['digest'] == digest for entry in metadata['applied']):
+        return metadata
+    start = time.perf_counter()
+    delta = aggregate(module, file, pd.Timestamp(metadata['threshold_date']).date())
+    keys = module.PLAN['aggregate_keys']
+    state = delta if state is None else upsert(state, delta, keys)
+    metadata['applied'].append({
+        'digest': digest,
+        'name': snapshots.upload_name(file),
+        'rows': len(delta),
+        'seconds': time.perf_counter() - start,
+        'applied': time.time()
+    })
+    metadata['rows'] = len(state)
+    _save(page, name, state, metadata)
+    return metadata
+
+
+def run(module, state, sell_through_threshold, days_threshold, profile=False, transfer_method='greedy', costs_file=None,
+        progress=None, as_of=None):
+    # The page's outputs derived from a state, like its run_pipeline
+    stages = [s for s in module.STAGES if s.name not in UPLOAD_STAGES]
+    params = {
+        'sell_through_threshold': sell_through_threshold,
+        'days_threshold': days_threshold,
+        'transfer_method': transfer_method,
+        'as_of': as_of or date.today()
+    }
+    return pipeline.run(stages, ['filtered_data', 'transfer_details'], {'aggregated_data': state, 'costs': costs_file},
+                        params, profile=profile, progress=progress)
+
+
+def run_state(page, name, sell_through_threshold, days_threshold, profile=False, transfer_method='greedy', costs_file=None,
+              progress=None, as_of=None):
+    # run() for a stored state, for background jobs that get names rather than frames
+    state, _ = load(page, name)
+    if state is None:
+        raise ValueError(f"No state '{name}' for {page}")
+    return run(importlib.import_module(page), state, sell_through_threshold, days_threshold, profile=profile,
+               transfer_method=transfer_method, costs_file=costs_file, progress=progress, as_of=as_of)
+
+
+def summary(metadata):
+    last = metadata['applied'][-1]
+    updated = time.strftime('%Y-%m-%d %H:%M', time.localtime(last['applied']))
+    return (f"{metadata['rows']:,} keys from {len(metadata['applied'])} files, launch date {metadata['threshold_date']}; "
+            f"last applied {last['name']} ({last['rows']:,} keys in {last['seconds']:.2f}s) at {updated}")
+
+
+def page(page_name):
+    # Streamlit section for a page: pick or start a state, apply a delta and
+    # plan from the state
+    import streamlit as st
+    import exports
+    import flow
+    import grid
+    import jobs
+
+    module = importlib.import_module(page_name)
+    existing = states(page_name)
+    name = st.selectbox("State", existing + ["New state…"], key=f'{page_name}_state')
+    if name == "New state…":
+        name = st.text_input("Name of the new state", key=f'{page_name}_state_name').strip()
+        if not name:
+            return
+        try:
+            check_name(name)
+        except ValueError as error:
+            st.error(str(error))
+            return
+    _, metadata = load(page_name, name)
+    threshold_date = None
+    if metadata is None:
+        st.caption("Start the state from a full export; later files are applied as daily changes.")
+        threshold_date = st.date_input("Season Launch Date", key=f'{page_name}_state_launch')
+    else:
+        st.caption(summary(metadata))
+
+    delta_file = st.file_uploader("Upload a delta (or the first full export)", type=['xlsx'], key=f'{page_name}_delta')
+    if delta_file is not None and st.button("Apply", key=f'{page_name}_apply'):
+        try:
+            metadata = apply(module, page_name, name, delta_file, threshold_date)
+        except (ValueError, KeyError) as error:
+            st.error(str(error))
+            return
+        st.caption(summary(metadata))
+    if metadata is None:
+        return
+
+    sell_through_threshold = st.number_input("Enter Sell-Through Threshold (%)", min_value=0, max_value=100, value=60,
+                                             key=f'{page_name}_state_sell_through')
+    days_threshold = st.number_input("Enter Minimum Age", min_value=0, max_value=100, value=30, key=f'{page_name}_state_age')
+    as_of = st.date_input("As-of date", value=date.today(), key=f'{page_name}_state_as_of')
+    transfer_method = st.radio("Transfer matching", list(flow.METHOD_LABELS), format_func=flow.METHOD_LABELS.get,
+                               horizontal=True, key=f'{page_name}_state_transfer_method')
+    if st.button("Process Data", key=f'{page_name}_state_process'):
+        jobs.start(f'{page_name}_state', 'incremental:run_state', {
+            'page': page_name,
+            'name': name,
+            'sell_through_threshold': sell_through_threshold,
+            'days_threshold': days_threshold,
+            'transfer_method': transfer_method,
+            'as_of': as_of
+        })
+    result = jobs.panel(jobs.current(f'{page_name}_state'), key=f'{page_name}_state')
+    if result is not None:
+        outputs, report = result
+        st.caption(pipeline.run_report(report))
+        grid.view(outputs['filtered_data'], key=f'{page_name}_state')
+        fingerprints = pipeline.output_fingerprints(report)
+        exports.download_buttons({
+            'Processed Data': (outputs['filtered_data'], 'processed_data'),
+            'Transfer Details': (outputs['transfer_details'], 'transfer_details')
+        }, {
+            'Processed Data': fingerprints['filtered_data'],
+            'Transfer Details': fingerprints['transfer_details']
+        }, key=f'{page_name}_state')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain an IST page's aggregates from daily deltas")
+    commands = parser.add_subparsers(dest='command', required=True)
+    apply_parser = commands.add_parser('apply', help="apply delta workbooks to a state, starting it if needed")
+    apply_parser.add_argument('page', choices=['network', 'regional', 'city'])
+    apply_parser.add_argument('state')
+    apply_parser.add_argument('files', nargs='+', help="workbooks, applied in order")
+    apply_parser.add_argument('--launch-date', type=date.fromisoformat, help="season launch date, required for a new state")
+    run_parser = commands.add_parser('run', help="write the plan derived from a state")
+    run_parser.add_argument('page', choices=['network', 'regional', 'city'])
+    run_parser.add_argument('state')
+    run_parser.add_argument('--sell-through', type=int, default=60, help="sell-through threshold in %% (default 60)")
+    run_parser.add_argument('--min-age', type=int, default=30, help="minimum age in days (default 30)")
+    run_parser.add_argument('--as-of', type=date.fromisoformat, help="date ages are counted to (default today)")
+    run_parser.add_argument('--output-dir', default='.')
+    args = parser.parse_args(argv)
+
+    try:
+        check_name(args.state)
+    except ValueError as error:
+        print(error)
+        return 1
+    module = importlib.import_module(args.page)
+    if args.command == 'apply':
+        for file in args.files:
+            try:
+                metadata = apply(module, args.page, args.state, file, args.launch_date)
+            except ValueError as error:
+                print(error)
+                return 1
+            print(f"{file}: {summary(metadata)}")
+        return 0
+
+    import exports
+
+    state, metadata = load(args.page, args.state)
+    if state is None:
+        print(f"No state '{args.state}' for {args.page}")
+        return 1
+    outputs, report = run(module, state, args.sell_through, args.min_age, as_of=args.as_of)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for output, suffix in (('filtered_data', 'processed_data'), ('transfer_details', 'transfer_details')):
+        with open(os.path.join(args.output_dir, f'{args.state}_{suffix}.xlsx'), 'wb') as handle:
+            handle.write(exports.to_xlsx({'Sheet1': outputs[output]}))
+    print(pipeline.run_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
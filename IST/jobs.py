@@ -0,0 +1,314 @@
+import importlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import loader
+import pipeline
+import results
+import transfers
+import upload_cache
+
+# Background jobs for the pages. "Process Data" submits the page's run to a
+# bounded pool of worker processes instead of running it in the Streamlit
+# script thread, so the page stays responsive, reruns do not restart the
+# work, and planners on one server do not share a GIL.
+#
+# A job names its function as 'module:function' and gets keyword arguments
+# that can be pickled; uploads are sent as their bytes. The function must
+# take a progress callback, which pipeline.run calls at every stage; the
+# worker publishes it and stops the job there once it is cancelled. It
+# returns pipeline.run's (outputs, report): the outputs go to the shared
+# result store and the job keeps only their keys.
+#
+# Jobs are admitted while fewer than WORKERS + QUEUE_LENGTH are outstanding
+# and the submitting session has fewer than PER_OWNER of them. The last
+# KEEP_FINISHED jobs are kept by ID, so a page can be left and come back to
+# a finished result while the result store still holds it. A job is only
+# shown to, and can only be cancelled by, the session that submitted it;
+# its ID is kept in that session's state and never put in the URL.
+#
+# Each worker is a process of its own with its own stage memo and upload
+# cache, so a session's jobs all go to one worker: the one its last kept job
+# ran on, or else the one with the fewest outstanding jobs. Reruns then find
+# the stages and uploads they share with the previous run. The memo's and
+# the upload cache's caps are split between the workers, so in total the
+# workers cache at most pipeline.MAX_BYTES + upload_cache.MAX_BYTES. The
+# real budget adds results.MAX_BYTES for the result store in the app
+# process, the working memory of up to WORKERS running jobs (a few times
+# the size of the frames they load) and snapshots.MAX_BYTES on disk.
+#
+# panel() converts a finished job's outputs back to pandas once and keeps
+# them in the session beside the job's ID, so paging, sorting and filtering
+# the result grid rerun the page without rebuilding the frames. A session
+# holds the frames of at most one job per page key; they are dropped when
+# the page starts another job.
+
+WORKERS = max(1, min(4, os.cpu_count() or 1))
+QUEUE_LENGTH = 8
+PER_OWNER = 2
+KEEP_FINISHED = 50
+POLL_SECONDS = 0.5
+
+STATUS_LABELS = {'queued': "Queued", 'running': "Running", 'done': "Finished", 'failed': "Failed", 'cancelled': "Cancelled"}
+ACTIVE = ('queued', 'running')
+
+
+class Busy(RuntimeError):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Upload(io.BytesIO):
+    # An uploaded file's bytes under its name, which can be sent to a worker
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def portable(file):
+    # Paths, snapshots and None go as they are; in-memory uploads as bytes
+    if isinstance(file, list):
+        return [portable(part) for part in file]
+    if file is None or isinstance(file, (str, os.PathLike, tuple)) or not hasattr(file, 'getvalue'):
+        return file
+    return Upload(file.getvalue(), getattr(file, 'name', 'upload'))
+
+
+_jobs = OrderedDict()
+_lock = threading.RLock()
+_lanes = []
+_manager = None
+_shared = None
+
+
+def _initialize(workers):
+    # Every worker holds its share of the caches' budget
+    pipeline.MAX_BYTES //= workers
+    upload_cache.MAX_BYTES //= workers
+    # Jobs already run side by side, so each one parses sheets and matches
+    # transfers serially rather than starting pools of its own
+    loader.WORKERS = 1
+    transfers.WORKERS = 1
+
+
+def _executor():
+    # Started on first use: one single-process pool per worker, and a
+    # manager holding every job's progress and the set of cancelled jobs
+    # for the workers to read
+    global _manager, _shared
+    with _lock:
+        if not _lanes:
+            context = multiprocessing.get_context('spawn')
+            _manager = context.Manager()
+            _shared = (_manager.dict(), _manager.dict())
+            _lanes.extend(ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_initialize, initargs=(WORKERS,))
+                          for _ in range(WORKERS))
+        return _lanes, _shared
+
+
+def _lane(owner):
+    # The worker the owner's last kept job went to, or the least busy one
+    for job in reversed(_jobs.values()):
+        if job['owner'] == owner:
+            return job['lane']
+    outstanding = [0] * WORKERS
+    for job in _jobs.values():
+        if job['status'] in ACTIVE:
+            outstanding[job['lane']] += 1
+    return outstanding.index(min(outstanding))
+
+
+def _work(job_id, target, kwargs, progress, cancelled):
+    module_name, function_name = target.split(':')
+    function = getattr(importlib.import_module(module_name), function_name)
+    started = time.time()
+
+    def report(stage, finished, total):
+        if job_id in cancelled:
+            raise Cancelled()
+        progress[job_id] = {'stage': stage, 'finished': finished, 'total': total, 'started': started}
+
+    report(None, 0, 0)
+    value = function(progress=report, **kwargs)
+    # The upload cache lives in the worker, so its state is reported from here
+    return value, upload_cache.stats_report()
+
+
+def _finish(job_id, future):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job['finished'] = time.time()
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or isinstance(error, Cancelled):
+            job['status'] = 'cancelled'
+        elif error is not None:
+            job['status'] = 'failed'
+            job['error'] = f'{type(error).__name__}: {error}'
+        else:
+            job['status'] = 'done'
+            value, job['notes'] = future.result()
+            job['result'] = _keep(value)
+        job['future'] = None
+    progress, cancelled = _shared
+    progress.pop(job_id, None)
+    cancelled.pop(job_id, None)
+
+
+def _keep(value):
+    outputs, report = value
+    keys = pipeline.output_fingerprints(report)
+    return {name: results.put(keys[name], output) for name, output in outputs.items()}, report
+
+
+def _fetch(kept):
+    # (outputs, report) from the result store, or None once any output is gone
+    keys, report = kept
+    outputs = {name: results.get(key) for name, key in keys.items()}
+    if any(output is None for output in outputs.values()):
+        return None
+    return outputs, report
+
+
+def _forget():
+    finished = [job_id for job_id, job in _jobs.items() if job['status'] not in ACTIVE]
+    for job_id in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+        del _jobs[job_id]
+
+
+def submit(owner, target, kwargs):
+    # Returns the new job's ID; raises Busy when the job is not admitted
+    with _lock:
+        _forget()
+        active = [job for job in _jobs.values() if job['status'] in ACTIVE]
+        if len(active) >= WORKERS + QUEUE_LENGTH:
+            raise Busy("The server is busy with other plans; try again in a minute")
+        if sum(job['owner'] == owner for job in active) >= PER_OWNER:
+            raise Busy(f"You already have {PER_OWNER} jobs waiting or running; cancel one or wait for it")
+        lanes, (progress, cancelled) = _executor()
+        job_id = uuid.uuid4().hex[:12]
+        lane = _lane(owner)
+        _jobs[job_id] = {'id': job_id, 'owner': owner, 'target': target, 'status': 'queued', 'submitted': time.time(),
+                         'finished': None, 'error': None, 'result': None, 'notes': None, 'future': None, 'lane': lane}
+        future = lanes[lane].submit(_work, job_id, target, kwargs, progress, cancelled)
+        _jobs[job_id]['future'] = future
+    future.add_done_callback(partial(_finish, job_id))
+    return job_id
+
+
+def status(job_id, owner):
+    # A copy of the job's record with its latest progress, or None once
+    # forgotten or when owner did not submit it
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job['owner'] != owner:
+            return None
+        job = dict(job, future=None)
+    job.update(stage=None, finished_stages=0, total_stages=0)
+    if job['status'] == 'queued':
+        current = _shared[0].get(job_id)
+        if current is not None:
+            job.update(status='running', stage=current['stage'], finished_stages=current['finished'],
+                       total_stages=current['total'])
+    return job
+
+
+def result(job_id, owner):
+    job = status(job_id, owner)
+    return _fetch(job['result']) if job is not None and job['status'] == 'done' else None
+
+
+def cancel(job_id, owner):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job['owner'] != owner or job['status'] not in ACTIVE:
+            return
+        future = job['future']
+    # Jobs still in the queue are dropped; running ones stop at their next stage
+    if future is None or not future.cancel():
+        _shared[1][job_id] = True
+
+
+def owner():
+    import streamlit as st
+
+    if 'job_owner' not in st.session_state:
+        st.session_state.job_owner = uuid.uuid4().hex
+    return st.session_state.job_owner
+
+
+def remember(key, job_id):
+    import streamlit as st
+
+    st.session_state[f'{key}_job'] = job_id
+    st.session_state.pop(f'{key}_outputs', None)
+
+
+def current(key):
+    import streamlit as st
+
+    return st.session_state.get(f'{key}_job')
+
+
+def start(key, target, kwargs):
+    # Submits from a page and remembers the job; shows why when it is not admitted
+    import streamlit as st
+
+    try:
+        remember(key, submit(owner(), target, kwargs))
+    except Busy as error:
+        st.warning(str(error))
+
+
+def panel(job_id, key):
+    # Shows the job's progress, polling while it runs, and returns its
+    # value once it has finished
+    import streamlit as st
+
+    if job_id is None:
+        return None
+    job = status(job_id, owner())
+    if job is None:
+        st.session_state.pop(f'{key}_outputs', None)
+        st.info("That result is no longer kept; process the data again.")
+        return None
+    if job['status'] in ACTIVE:
+        if job['status'] == 'queued':
+            st.progress(0.0, text="Waiting for a free worker…")
+        else:
+            done = job['finished_stages'] / job['total_stages'] if job['total_stages'] else 0.0
+            stage = job['stage'] or 'starting'
+            st.progress(min(done, 1.0), text=f"{stage} ({job['finished_stages']} of {job['total_stages']} stages)")
+        if st.button("Cancel", key=f'{key}_cancel'):
+            cancel(job_id, owner())
+        time.sleep(POLL_SECONDS)
+        st.rerun()
+    if job['status'] == 'failed':
+        st.error(f"Processing failed: {job['error']}")
+        return None
+    if job['status'] == 'cancelled':
+        st.info("Processing was cancelled.")
+        return None
+    kept = st.session_state.get(f'{key}_outputs')
+    if kept is not None and kept[0] == job_id:
+        value = kept[1]
+    else:
+        value = _fetch(job['result'])
+        if value is None:
+            st.info("That result is no longer kept; process the data again.")
+            return None
+        st.session_state[f'{key}_outputs'] = (job_id, value)
+    st.caption(f"Job {job_id} finished in {job['finished'] - job['submitted']:.1f}s")
+    st.caption(job['notes'])
+    st.caption(results.stats_report())
+    return value
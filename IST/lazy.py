@@ -0,0 +1,191 @@
+import pandas as pd
+import outofcore
+import schema
+import snapshots
+import upload_cache
+
+# Polars engine for the IST pages: the same plan as outofcore.py, written as
+# one LazyFrame query so Polars can optimise and multithread the whole chain
+# from the scan to the threshold filter. The result is converted to pandas
+# and finished by outofcore.finish, so it is the frame the in-memory stages
+# produce and the page's display and downloads are unchanged.
+
+SCANNERS = {'.csv': 'scan_csv', '.parquet': 'scan_parquet', '.pq': 'scan_parquet'}
+
+RECEIVED = '1st Rcv Date'
+ADJUSTED = 'Adjusted 1st Rcv Date'
+
+
+def _source(file, fields):
+    # Returns (LazyFrame with the schema's columns under stripped names,
+    # validated and without the rows missing a required value, temporary
+    # files, note or None)
+    import polars as pl
+
+    columns = schema.columns(fields)
+    suffix = outofcore.extension(file)
+    if suffix not in SCANNERS:
+        df = schema.validate(upload_cache.read_excel(file, columns=columns, dtype=schema.dtypes(fields)), fields,
+                             snapshots.upload_name(file))
+        return pl.from_pandas(df[columns]).lazy(), [], df.attrs.get('note')
+    paths, temporaries = outofcore.scan_paths(file, suffix)
+    try:
+        frames = [getattr(pl, SCANNERS[suffix])(path) for path in paths]
+        # Files are matched up by column name
+        frame = frames[0] if len(frames) == 1 else pl.concat(frames, how='diagonal_relaxed')
+        available = {str(name).strip(): name for name in frame.collect_schema().names()}
+        schema.check(fields, available, {}, snapshots.upload_name(file))
+        frame = frame.select([pl.col(available[name]).alias(name) for name in columns])
+        keep, note = _validate_scan(frame, fields, snapshots.upload_name(file))
+    except BaseException:
+        outofcore.remove(temporaries)
+        raise
+    return frame.filter(keep), temporaries, note
+
+
+def _validate_scan(frame, fields, upload):
+    # outofcore._validate_scan with Polars: one pass, counts only; returns
+    # the condition rows with every required value meet, and the note
+    import polars as pl
+
+    types = frame.collect_schema()
+    counts, present = [], []
+    for f in fields:
+        value = _value(f, types)
+        if f.kind in outofcore.CASTS:
+            # Blank text is missing, not unreadable, as in the loader
+            filled = pl.col(f.name).is_not_null() & (pl.col(f.name).cast(pl.String).str.strip_chars() != '')
+            counts.append((filled & value.is_null()).sum().alias(f'{f.name} unreadable'))
+        if f.drop_blank:
+            present.append(value.is_not_null())
+            counts.append(value.is_null().sum().alias(f'{f.name} blank'))
+    keep = pl.all_horizontal(present) if present else pl.lit(True)
+    row = frame.select(counts + [(~keep).sum().alias('dropped')]).collect().row(0, named=True)
+    failures = {f.name: {'count': row[f'{f.name} unreadable']} for f in fields if f.kind in outofcore.CASTS}
+    schema.check(fields, set(schema.columns(fields)), failures, upload)
+    blank = {f.name: row[f'{f.name} blank'] for f in fields if f.drop_blank}
+    return keep, schema.dropped_report(blank, row['dropped']) if row['dropped'] else None
+
+
+def _numeric(name):
+    import polars as pl
+
+    return pl.col(name).cast(pl.Float64, strict=False)
+
+
+def _received(types, name=RECEIVED):
+    import polars as pl
+
+    if types[name] == pl.String:
+        return pl.col(name).str.to_datetime(time_unit='us', strict=False)
+    return pl.col(name).cast(pl.Datetime('us'), strict=False)
+
+
+def _value(field, types):
+    # A schema field as the plan reads it; unreadable values become null
+    import polars as pl
+
+    if field.kind == 'numeric':
+        return _numeric(field.name)
+    if field.kind == 'datetime':
+        return _received(types, field.name)
+    return pl.col(field.name)
+
+
+def _finite_int(expression):
+    # pandas' .replace([inf, -inf, nan], 0).astype(int)
+    import polars as pl
+
+    return pl.when(expression.is_finite()).then(expression).otherwise(0.0).cast(pl.Int64)
+
+
+def _days(later, earlier):
+    # Whole days between two timestamps, rounded down like Timedelta.days
+    import polars as pl
+
+    return ((later - earlier).dt.total_microseconds() / outofcore.DAY_MICROSECONDS).floor().cast(pl.Int64)
+
+
+def plan_frame(source, plan, threshold, as_of, sell_through_threshold, days_threshold):
+    import polars as pl
+
+    aggregate_keys = plan['aggregate_keys']
+    received = _received(source.collect_schema())
+    planned = (
+        source
+        .with_columns(pl.when(received <= threshold).then(pl.lit(threshold)).otherwise(received).alias(ADJUSTED))
+        .drop_nulls(aggregate_keys)
+        .group_by(aggregate_keys)
+        .agg([_numeric(name).sum().alias(name) for name in outofcore.QUANTITIES])
+        .sort(aggregate_keys)
+        .with_row_index('position')
+        .with_columns(
+            (pl.col('Sold Qty') / (pl.col('Shop Rcv Qty') - pl.col('Disp. Qty')) * 100).alias('shop_ratio'),
+            _days(pl.lit(as_of), pl.col(ADJUSTED)).alias('Days'),
+            (pl.col('Shop Rcv Qty') - pl.col('Disp. Qty')).alias('Net Receiving')
+        )
+    )
+    sell_through = planned.group_by(plan['sell_through_keys']).agg(
+        (pl.col('Sold Qty').sum() / pl.col('Net Receiving').sum() * 100).alias('group_ratio')
+    )
+    cover = planned.group_by(plan['cover_keys']).agg(
+        (pl.col('O.H Qty').sum() / (pl.col('Sold Qty').sum() / pl.col('Days').max())).alias('cover_ratio'),
+        pl.col(ADJUSTED).min().alias('first_received')
+    )
+    return (
+        planned
+        .join(sell_through, on=plan['sell_through_keys'], how='left')
+        .join(cover, on=plan['cover_keys'], how='left')
+        .with_columns(
+            _finite_int(pl.col('shop_ratio')).alias(plan['shop_sell_through']),
+            _finite_int(pl.col('group_ratio')).alias(plan['group_sell_through']),
+            _finite_int(pl.col('cover_ratio')).alias('desired_cover'),
+            _days(pl.lit(as_of), pl.col('first_received')).alias(plan['age'])
+        )
+        .with_columns(
+            _finite_int(pl.col('desired_cover') * (pl.col('Sold Qty') / pl.col('Days')) - pl.col('O.H Qty')).alias('Transfer in/out')
+        )
+        .filter((pl.col(plan['group_sell_through']) > sell_through_threshold) & (pl.col(plan['age']) > days_threshold))
+        .sort('position')
+        .select(['position'] + aggregate_keys + outofcore.QUANTITIES + [
+            plan['shop_sell_through'], 'Days', 'Net Receiving', plan['group_sell_through'],
+            'desired_cover', 'Transfer in/out', plan['age']
+        ])
+    )
+
+
+def _source_types(source, key_columns):
+    # The same categories and quantity dtypes as outofcore._source_types
+    import polars as pl
+
+    queries = [source.select(pl.col(key).drop_nulls().unique().sort()) for key in key_columns]
+    stats = []
+    for name in outofcore.QUANTITIES:
+        value = _numeric(name)
+        stats += [(value == value.floor()).all().alias(f'{name} whole'),
+                  value.null_count().alias(f'{name} missing'),
+                  value.abs().sum().alias(f'{name} total')]
+    queries.append(source.select(stats))
+    results = pl.collect_all(queries)
+    categories = {key: pd.CategoricalDtype(pd.Index(values.to_series().to_list()))
+                  for key, values in zip(key_columns, results)}
+    row = results[-1].row(0, named=True)
+    dtypes = {name: outofcore.quantity_dtype(row[f'{name} whole'], row[f'{name} missing'], row[f'{name} total'])
+              for name in outofcore.QUANTITIES}
+    return categories, dtypes
+
+
+def filtered_plan(file, fields, key_columns, plan, threshold_date, sell_through_threshold, days_threshold, as_of):
+    # Returns the page's filtered_data for the upload, computed with Polars;
+    # fields is the page's schema
+    source, temporaries, note = _source(file, fields)
+    try:
+        categories, dtypes = _source_types(source, key_columns)
+        threshold = pd.Timestamp(threshold_date).to_pydatetime()
+        as_of = pd.Timestamp(as_of).normalize().to_pydatetime()
+        df = plan_frame(source, plan, threshold, as_of, sell_through_threshold, days_threshold).collect().to_pandas()
+    finally:
+        outofcore.remove(temporaries)
+    df = outofcore.finish(df, categories, dtypes, plan)
+    df.attrs['note'] = note
+    return df
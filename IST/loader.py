@@ -0,0 +1,265 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+import schema
+
+# Shared Excel reader for every upload page. Pages pass the columns their
+# pipeline needs so nothing else is parsed, and the Rust-backed calamine
+# reader is used when python-calamine is installed; openpyxl stays the fallback.
+#
+# Every sheet of a workbook is read, and an upload can be several workbooks
+# (exports split by zone, say). Sheets with none of the wanted columns are
+# skipped. With more than one sheet to parse and WORKERS > 1 the sheets are
+# parsed concurrently in a process pool, one sheet per task, so parse time
+# follows the largest sheet rather than the number of sheets and files. The
+# tasks are sent the workbook's path: an in-memory upload is written to a
+# temporary file once rather than pickled with every sheet's task.
+# The rows are then joined in upload and sheet order and converted once.
+
+FAST_ENGINE = 'calamine'
+DEFAULT_ENGINE = 'openpyxl'
+
+WORKERS = os.cpu_count() or 1
+
+
+def fast_engine_available():
+    try:
+        import python_calamine  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _read(file, engine, columns, sheets=None):
+    # {sheet name: frame} for the given sheets, or for all of them
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda name: str(name).strip() in wanted
+    return pd.read_excel(file, engine=engine, usecols=usecols, sheet_name=sheets)
+
+
+def _parse(file, columns, sheets=None):
+    # Returns ({sheet name: frame}, engine); also runs in the pool, where
+    # file is the workbook's path
+    if fast_engine_available():
+        try:
+            return _read(file, FAST_ENGINE, columns, sheets), FAST_ENGINE
+        except (ImportError, ValueError):
+            # Older pandas without the calamine engine, or a workbook it cannot read
+            pass
+    return _read(file, DEFAULT_ENGINE, columns, sheets), DEFAULT_ENGINE
+
+
+def _sheet_names(file):
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    engine = FAST_ENGINE if fast_engine_available() else DEFAULT_ENGINE
+    try:
+        with pd.ExcelFile(file, engine=engine) as workbook:
+            return workbook.sheet_names
+    except (ImportError, ValueError):
+        with pd.ExcelFile(file, engine=DEFAULT_ENGINE) as workbook:
+            return workbook.sheet_names
+
+
+def _portable(file):
+    # What a pool worker can open, as (path, temporary file or None)
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file), None
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    with os.fdopen(handle, 'wb') as output:
+        if hasattr(file, 'getvalue'):
+            output.write(file.getvalue())
+        else:
+            file.seek(0)
+            shutil.copyfileobj(file, output)
+    return path, path
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _executor():
+    # One pool per process, kept between uploads; spawned, as the app
+    # serves sessions from several threads
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != WORKERS:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = WORKERS
+        return _pool
+
+
+def _as_text(column):
+    # Whole numbers lose the '.0' they are read with next to blanks
+    if pd.api.types.is_numeric_dtype(column):
+        values = column.dropna()
+        if len(values) and values.eq(values.round()).all():
+            column = column.astype('Int64')
+    return column.astype(str).where(column.notna().to_numpy())
+
+
+def concat(frames, dtype=None):
+    # The rows of several parsed parts as one frame. A column the loader
+    # doesn't convert (a key, usually) that was read as numbers in one part
+    # and as text in another is made text throughout, so equal keys stay
+    # equal and compact.normalize gives them one category.
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0]
+    typed = set(dtype or {})
+    names = [name for name in dict.fromkeys(name for df in frames for name in df.columns) if name not in typed]
+    for name in names:
+        kinds = {pd.api.types.is_numeric_dtype(df[name]) for df in frames if name in df.columns and df[name].notna().any()}
+        if len(kinds) > 1:
+            frames = [df.assign(**{name: _as_text(df[name])}) if name in df.columns else df for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _coerce(df, dtype, label=None):
+    # Values that are present but do not convert are recorded in
+    # attrs['unparsed'], by column, for schema.validate to report; label
+    # turns a row position into the row reported
+    unparsed = {}
+    for name, kind in dtype.items():
+        if name not in df.columns:
+            continue
+        raw = df[name]
+        if kind == 'numeric':
+            df[name] = pd.to_numeric(raw, errors='coerce')
+        elif kind == 'datetime':
+            df[name] = pd.to_datetime(raw, errors='coerce')
+        else:
+            df[name] = raw.astype(kind)
+            continue
+        failed = schema.unparsed(raw, df[name], label)
+        if failed:
+            unparsed[name] = failed
+    df.attrs['unparsed'] = unparsed
+    return df
+
+
+def _workbook(sheets, columns, dtype):
+    # One workbook's frame from its parsed sheets
+    for df in sheets.values():
+        df.columns = df.columns.str.strip()  # Strip any leading/trailing whitespace from column names
+    kept = {name: df for name, df in sheets.items() if len(df.columns)}
+    if not kept:
+        # Nothing to read; the first sheet shows which columns are missing
+        kept = dict(list(sheets.items())[:1])
+    df = concat(kept.values(), dtype)
+
+    # Rows are reported as Sheet!row once there is more than one sheet
+    starts = np.cumsum([0] + [len(sheet) for sheet in kept.values()])
+    names = list(kept)
+
+    def label(position):
+        part = np.searchsorted(starts, position, side='right') - 1
+        return f"{names[part]}!{position - starts[part] + 2}"
+
+    # Declared types are applied once here, by stripped header name
+    if dtype:
+        df = _coerce(df, dtype, label if len(kept) > 1 else None)
+    else:
+        df.attrs['unparsed'] = {}
+    # Columns some of the workbook's sheets lack
+    partial = {}
+    for name in (columns if columns is not None else df.columns):
+        lacking = [sheet for sheet, frame in kept.items() if name not in frame.columns]
+        if lacking and len(lacking) < len(kept):
+            partial[name] = lacking
+    df.attrs['partial'] = partial
+    df.attrs['sheets'] = list(kept)
+    return df
+
+
+def read_workbooks(files, columns=None, dtype=None):
+    # One frame per workbook, with the rows of all its sheets
+    start = time.perf_counter()
+    tasks = []
+    if WORKERS > 1:
+        tasks = [(index, sheet) for index, file in enumerate(files) for sheet in _sheet_names(file)]
+    if len(tasks) > 1:
+        sources = [_portable(file) for file in files]
+        try:
+            parsed = _executor().map(_parse, [sources[index][0] for index, _ in tasks], repeat(columns),
+                                     [[sheet] for _, sheet in tasks])
+            workbooks = [({}, set()) for _ in files]
+            for (index, _), (sheets, engine) in zip(tasks, parsed):
+                workbooks[index][0].update(sheets)
+                workbooks[index][1].add(engine)
+        finally:
+            for _, temporary in sources:
+                if temporary is not None:
+                    os.remove(temporary)
+        workbooks = [(sheets, ', '.join(sorted(engines))) for sheets, engines in workbooks]
+    else:
+        workbooks = [_parse(file, columns) for file in files]
+    frames = []
+    for sheets, engine in workbooks:
+        df = _workbook(sheets, columns, dtype or {})
+        df.attrs['engine'] = engine
+        df.attrs['parse_seconds'] = time.perf_counter() - start
+        df.attrs['note'] = parse_report(df)
+        frames.append(df)
+    return frames
+
+
+def read_excel(file, columns=None, dtype=None):
+    return read_workbooks([file], columns=columns, dtype=dtype)[0]
+
+
+def _located(name, sheets, row):
+    # A row of one workbook, as Excel refers to a cell in another workbook
+    return f"[{name}]{row}" if isinstance(row, str) else f"[{name}]{sheets[0] if sheets else ''}!{row}"
+
+
+def combine(frames, names, dtype=None):
+    # One frame from several uploads, with their records of unreadable
+    # values and partly missing columns under each upload's name
+    df = concat(frames, dtype)
+    unparsed, partial = {}, {}
+    for frame, name in zip(frames, names):
+        sheets = frame.attrs.get('sheets', [])
+        for column, entry in frame.attrs.get('unparsed', {}).items():
+            merged = unparsed.setdefault(column, {'count': 0, 'rows': [], 'values': []})
+            merged['count'] += entry['count']
+            room = schema.SAMPLE_ROWS - len(merged['rows'])
+            merged['rows'] += [_located(name, sheets, row) for row in entry['rows'][:room]]
+            merged['values'] += entry['values'][:room]
+        for column, lacking in frame.attrs.get('partial', {}).items():
+            partial.setdefault(column, []).extend(f"[{name}]{sheet}" for sheet in lacking)
+        for column in df.columns:
+            if column not in frame.columns:
+                partial.setdefault(column, []).append(f"[{name}]")
+    df.attrs['unparsed'] = unparsed
+    df.attrs['partial'] = partial
+    df.attrs['note'] = '  \n'.join(f"{name}: {frame.attrs['note']}" for frame, name in zip(frames, names) if frame.attrs.get('note'))
+    return df
+
+
+def parse_report(df):
+    if 'parse_seconds' not in df.attrs:
+        return None
+    if 'snapshot_seconds' in df.attrs:
+        return (f"Opened {len(df):,} rows from a snapshot in {df.attrs['snapshot_seconds']:.2f}s "
+                f"(parsed in {df.attrs['parse_seconds']:.2f}s with {df.attrs['engine']} when first loaded)")
+    if df.attrs.get('cached'):
+        return f"Loaded {len(df):,} rows from cache (parsed in {df.attrs['parse_seconds']:.2f}s with {df.attrs['engine']})"
+    sheets = len(df.attrs.get('sheets', []))
+    parsed = f"Parsed {len(df):,} rows from {sheets} sheets" if sheets > 1 else f"Parsed {len(df):,} rows"
+    return f"{parsed} in {df.attrs['parse_seconds']:.2f}s ({df.attrs['engine']})"
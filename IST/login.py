@@ -1,5 +1,4 @@
 import streamlit as st
-import plotly.express as px
 
 # Dummy user credentials
 USER_CREDENTIALS = {'admin': 'password'}
@@ -159,6 +158,9 @@ def main():
         st.markdown('<div class="header"><h1>It\'s summer!</h1></div>', unsafe_allow_html=True)
         st.sidebar.header("Configuration")
 
+        # Only this demo page needs plotly, so it is imported here
+        import plotly.express as px
+
         df = px.data.iris()
 
         for i in range(1, 5):
@@ -1,12 +1,19 @@
+import importlib
 import streamlit as st
-import network
-import regional
-import city
-import assortment
-import ip
-from streamlit_option_menu import option_menu
 import login
 
+# Page modules are imported on first navigation rather than at startup
+PAGE_MODULES = {
+    'Network': 'network',
+    'Regional': 'regional',
+    'City': 'city',
+    'Assortment': 'assortment',
+    'IP': 'ip'
+}
+
+def show_page(name):
+    importlib.import_module(PAGE_MODULES[name]).main()
+
 
 def add_custom_css():
     st.markdown(
@@ -113,6 +120,8 @@ def handle_navigation():
     if not st.session_state['logged_in']:
         login.login()
     else:
+        from streamlit_option_menu import option_menu
+
         add_custom_css()
         
         with st.sidebar:
@@ -141,16 +150,11 @@ def handle_navigation():
             home()
         elif selected == 'Internal Store Transfer':
             ist_option = st.selectbox("Select an option", ["Network", "Regional", "City"], key="ist_selectbox")
-            if ist_option == 'Network':
-                network.main()
-            elif ist_option == 'Regional':
-                regional.main()
-            elif ist_option == 'City':
-                city.main()
+            show_page(ist_option)
         elif selected == 'Assortment':
-            assortment.main()
+            show_page('Assortment')
         elif selected == 'IP':
-            ip.main()
+            show_page('IP')
         st.markdown('</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import compact
+import schema
+import snapshots
+import upload_cache
+
+# Out-of-core engine for the IST pages. The aggregation, sell-through, cover
+# and age columns of fused.build_plan and the page's threshold filter are
+# expressed as one SQL query over an embedded DuckDB database, which spills
+# to TEMP_DIRECTORY once MEMORY_LIMIT is reached; only the filtered rows are
+# materialised in pandas. CSV and Parquet uploads are scanned from disk, so
+# files larger than memory (and than a workbook can hold) work; Excel
+# uploads are parsed by the shared loader first.
+#
+# The result is the frame the in-memory stages produce: same rows, row
+# labels, column order, values and dtypes. Every float expression is
+# evaluated in the same order as in pandas, and non-finite ratios become 0
+# as they do there.
+
+MEMORY_LIMIT = '2GB'
+TEMP_DIRECTORY = os.path.join(tempfile.gettempdir(), 'ist_duckdb')
+SCANNED_EXTENSIONS = {'.csv': 'read_csv', '.parquet': 'read_parquet', '.pq': 'read_parquet'}
+UPLOAD_TYPES = ['csv', 'parquet']
+
+QUANTITIES = ['Shop Rcv Qty', 'Disp. Qty', 'O.H Qty', 'Sold Qty']
+DAY_MICROSECONDS = 86400000000.0
+
+# SQL types the schema's field kinds are read as
+CASTS = {'numeric': 'DOUBLE', 'datetime': 'TIMESTAMP'}
+
+_INT32 = np.iinfo(np.int32)
+
+
+def _name(column):
+    return '"' + str(column).replace('"', '""') + '"'
+
+
+def _literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+def _keys(columns, prefix=''):
+    return ', '.join(prefix + _name(column) for column in columns)
+
+
+def connect():
+    import duckdb
+
+    os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+    con = duckdb.connect(config={'memory_limit': MEMORY_LIMIT, 'temp_directory': TEMP_DIRECTORY})
+    con.execute("SET enable_progress_bar = false")
+    return con
+
+
+def extension(file):
+    if isinstance(file, list):
+        # Several uploads are scanned together when they are of one kind
+        suffixes = {extension(part) for part in file}
+        return suffixes.pop() if len(suffixes) == 1 else ''
+    name = file if isinstance(file, (str, os.PathLike)) else getattr(file, 'name', '')
+    return os.path.splitext(str(name))[1].lower()
+
+
+def scan_path(file, suffix):
+    # Returns (path, temporary file or None); uploaded CSV/Parquet files are
+    # written out so they can be streamed from disk
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file), None
+    os.makedirs(TEMP_DIRECTORY, exist_ok=True)
+    handle, path = tempfile.mkstemp(suffix=suffix, dir=TEMP_DIRECTORY)
+    with os.fdopen(handle, 'wb') as output:
+        if hasattr(file, 'getvalue'):
+            output.write(file.getvalue())
+        else:
+            file.seek(0)
+            while True:
+                chunk = file.read(1024 * 1024)
+                if not chunk:
+                    break
+                output.write(chunk)
+    return path, path
+
+
+def scan_paths(file, suffix):
+    # scan_path for each of an upload's files; returns (paths, temporary files)
+    scanned = [scan_path(part, suffix) for part in (file if isinstance(file, list) else [file])]
+    return [path for path, _ in scanned], [temporary for _, temporary in scanned if temporary is not None]
+
+
+def remove(temporaries):
+    for temporary in temporaries:
+        os.remove(temporary)
+
+
+def _create_source(con, file, fields):
+    # Creates the view 'upload' with the schema's columns under stripped
+    # names, validated and without the rows missing a required value;
+    # returns (temporary files to remove afterwards, note or None)
+    columns = schema.columns(fields)
+    suffix = extension(file)
+    if suffix not in SCANNED_EXTENSIONS:
+        df = schema.validate(upload_cache.read_excel(file, columns=columns, dtype=schema.dtypes(fields)), fields,
+                             snapshots.upload_name(file))
+        con.register('upload_frame', df[columns])
+        con.execute("CREATE VIEW upload AS SELECT * FROM upload_frame")
+        return [], df.attrs.get('note')
+    paths, temporaries = scan_paths(file, suffix)
+    try:
+        if len(paths) == 1:
+            scan = f"{SCANNED_EXTENSIONS[suffix]}({_literal(paths[0])})"
+        else:
+            # Files are matched up by column name
+            scan = f"{SCANNED_EXTENSIONS[suffix]}([{', '.join(_literal(path) for path in paths)}], union_by_name = true)"
+        available = {str(name).strip(): name for name in con.execute(f"SELECT * FROM {scan} LIMIT 0").fetchdf().columns}
+        schema.check(fields, available, {}, snapshots.upload_name(file))
+        select = ', '.join(f"{_name(available[name])} AS {_name(name)}" for name in columns)
+        con.execute(f"CREATE VIEW scanned AS SELECT {select} FROM {scan}")
+        keep, note = _validate_scan(con, fields, snapshots.upload_name(file))
+        con.execute(f"CREATE VIEW upload AS SELECT * FROM scanned WHERE {keep}")
+    except BaseException:
+        remove(temporaries)
+        raise
+    return temporaries, note
+
+
+def _validate_scan(con, fields, upload):
+    # schema.validate for the scanned view, in one pass and with counts only;
+    # returns the condition rows with every required value meet, and the note
+    counts, present = [], []
+    for f in fields:
+        column = _name(f.name)
+        value = f"TRY_CAST({column} AS {CASTS[f.kind]})" if f.kind in CASTS else column
+        if f.kind in CASTS:
+            # Blank text is missing, not unreadable, as in the loader
+            counts.append(f"count(*) FILTER ({column} IS NOT NULL AND trim(CAST({column} AS VARCHAR)) <> '' "
+                          f"AND {value} IS NULL)")
+        if f.drop_blank:
+            present.append(f"{value} IS NOT NULL")
+            counts.append(f"count(*) FILTER ({value} IS NULL)")
+    keep = ' AND '.join(present) or 'true'
+    row = con.execute(f"SELECT {', '.join(counts + [f'count(*) FILTER (NOT ({keep}))'])} FROM scanned").fetchone()
+    values = iter(row)
+    failures, blank = {}, {}
+    for f in fields:
+        if f.kind in CASTS:
+            failures[f.name] = {'count': next(values)}
+        if f.drop_blank:
+            blank[f.name] = next(values)
+    schema.check(fields, set(schema.columns(fields)), failures, upload)
+    dropped = next(values)
+    return keep, schema.dropped_report(blank, dropped) if dropped else None
+
+
+def _finite_int(expression):
+    # pandas' .replace([inf, -inf, nan], 0).astype(int)
+    return f"CAST(CASE WHEN isfinite({expression}) THEN trunc({expression}) ELSE 0 END AS BIGINT)"
+
+
+def _days(later, earlier):
+    # Whole days between two timestamps, rounded down like Timedelta.days
+    return f"CAST(floor((epoch_us({later}) - epoch_us({earlier})) / {DAY_MICROSECONDS}) AS BIGINT)"
+
+
+def plan_query(plan):
+    aggregate_keys = plan['aggregate_keys']
+    sell_through_keys = plan['sell_through_keys']
+    cover_keys = plan['cover_keys']
+    not_null = ' AND '.join(f"{_name(key)} IS NOT NULL" for key in aggregate_keys)
+    sums = ', '.join(f"coalesce(sum(TRY_CAST({_name(name)} AS DOUBLE)), 0) AS {_name(name)}" for name in QUANTITIES)
+    quantities = ', '.join(f"a.{_name(name)}" for name in QUANTITIES)
+    return f"""
+        WITH adjusted AS (
+            SELECT * EXCLUDE ("1st Rcv Date"),
+                CASE WHEN TRY_CAST("1st Rcv Date" AS TIMESTAMP) <= $threshold THEN $threshold
+                     ELSE TRY_CAST("1st Rcv Date" AS TIMESTAMP) END AS "Adjusted 1st Rcv Date"
+            FROM upload
+        ),
+        aggregated AS (
+            SELECT {_keys(aggregate_keys)}, {sums}
+            FROM adjusted
+            WHERE {not_null}
+            GROUP BY {_keys(aggregate_keys)}
+        ),
+        planned AS (
+            SELECT *,
+                row_number() OVER (ORDER BY {_keys(aggregate_keys)}) - 1 AS position,
+                "Sold Qty" / ("Shop Rcv Qty" - "Disp. Qty") * 100 AS shop_ratio,
+                {_days('$as_of', '"Adjusted 1st Rcv Date"')} AS "Days",
+                "Shop Rcv Qty" - "Disp. Qty" AS "Net Receiving"
+            FROM aggregated
+        ),
+        sell_through AS (
+            SELECT {_keys(sell_through_keys)}, sum("Sold Qty") / sum("Net Receiving") * 100 AS group_ratio
+            FROM planned
+            GROUP BY {_keys(sell_through_keys)}
+        ),
+        cover AS (
+            SELECT {_keys(cover_keys)},
+                sum("O.H Qty") / (sum("Sold Qty") / max("Days")) AS cover_ratio,
+                min("Adjusted 1st Rcv Date") AS first_received
+            FROM planned
+            GROUP BY {_keys(cover_keys)}
+        ),
+        final AS (
+            SELECT {_keys(aggregate_keys, 'a.')}, {quantities},
+                {_finite_int('a.shop_ratio')} AS {_name(plan['shop_sell_through'])},
+                a."Days", a."Net Receiving",
+                {_finite_int('s.group_ratio')} AS {_name(plan['group_sell_through'])},
+                {_finite_int('c.cover_ratio')} AS desired_cover,
+                {_days('$as_of', 'c.first_received')} AS {_name(plan['age'])},
+                a.position
+            FROM planned a
+            JOIN sell_through s USING ({_keys(sell_through_keys)})
+            JOIN cover c USING ({_keys(cover_keys)})
+        )
+        SELECT *, {_finite_int('desired_cover * ("Sold Qty" / "Days") - "O.H Qty"')} AS "Transfer in/out"
+        FROM final
+        WHERE {_name(plan['group_sell_through'])} > $sell_through_threshold AND {_name(plan['age'])} > $days_threshold
+        ORDER BY position
+    """
+
+
+def quantity_dtype(whole, missing, total):
+    # The dtype a quantity column ends up with after loading and compact.normalize
+    if missing or whole is False:
+        return np.dtype(np.float64)
+    if total is not None and total > _INT32.max:
+        return np.dtype(np.int64)
+    return np.dtype(np.int32)
+
+
+def _source_types(con, key_columns):
+    # What compact.normalize makes of each column in the in-memory path:
+    # key categories, and quantity dtypes from the whole upload
+    categories = {}
+    for key in key_columns:
+        values = con.execute(f"SELECT DISTINCT {_name(key)} FROM upload WHERE {_name(key)} IS NOT NULL ORDER BY 1").fetchdf()
+        categories[key] = pd.CategoricalDtype(pd.Index(values.iloc[:, 0].tolist()))
+    dtypes = {}
+    for name in QUANTITIES:
+        column = f"TRY_CAST({_name(name)} AS DOUBLE)"
+        whole, missing, total = con.execute(
+            f"SELECT bool_and({column} = trunc({column})), count(*) - count({column}), sum(abs({column})) FROM upload"
+        ).fetchone()
+        dtypes[name] = quantity_dtype(whole, missing, total)
+    return categories, dtypes
+
+
+def filtered_plan(file, fields, key_columns, plan, threshold_date, sell_through_threshold, days_threshold, as_of):
+    # Returns the page's filtered_data for the upload, computed in DuckDB;
+    # fields is the page's schema
+    con = connect()
+    temporaries = []
+    try:
+        temporaries, note = _create_source(con, file, fields)
+        categories, dtypes = _source_types(con, key_columns)
+        df = con.execute(plan_query(plan), {
+            'threshold': pd.Timestamp(threshold_date).to_pydatetime(),
+            'as_of': pd.Timestamp(as_of).normalize().to_pydatetime(),
+            'sell_through_threshold': sell_through_threshold,
+            'days_threshold': days_threshold
+        }).fetchdf()
+    finally:
+        con.close()
+        remove(temporaries)
+
+    df = finish(df, categories, dtypes, plan)
+    df.attrs['note'] = note
+    return df
+
+
+def finish(df, categories, dtypes, plan):
+    # Turns an engine's result, with a 'position' column holding the row's
+    # position in the aggregated frame, into the in-memory stages' frame
+    df.index = pd.Index(df.pop('position').to_numpy(), dtype=np.int64)
+    for key, dtype in categories.items():
+        if key in df.columns:
+            df[key] = df[key].astype(dtype)
+    for name, dtype in dtypes.items():
+        df[name] = df[name].astype(dtype)
+    df['Net Receiving'] = df['Net Receiving'].astype(np.result_type(dtypes['Shop Rcv Qty'], dtypes['Disp. Qty']))
+    df['Status'] = compact.status(df[plan['shop_sell_through']] > df[plan['group_sell_through']])
+    order = plan['aggregate_keys'] + QUANTITIES + [plan['shop_sell_through'], 'Days', 'Net Receiving',
+                                                     plan['group_sell_through'], 'Status', 'desired_cover',
+                                                     'Transfer in/out', plan['age']]
+    return df[order]
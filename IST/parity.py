@@ -0,0 +1,92 @@
+import argparse
+import importlib
+import sys
+import tempfile
+from datetime import date
+import pandas as pd
+import benchmark
+import outofcore
+import pipeline
+
+# Parity check between the engines of the IST pages. Every engine must give
+# the in-memory engine's filtered_data exactly (rows, row labels, columns,
+# values and dtypes) and the same transfers, which are also totalled per
+# group so a mismatch report says where the quantities differ.
+#
+#   python parity.py regional upload.xlsx --launch-date 2024-03-01
+#   python parity.py city --rows 100000
+#
+# Without an upload, a file is generated with benchmark.generate. The
+# in-memory engine only reads workbooks, so CSV and Parquet uploads are
+# checked against the DuckDB engine instead.
+
+PAGES = ['network', 'regional', 'city']
+REFERENCE = 'pandas'
+
+
+def transfer_totals(transfer_details):
+    keys = [name for name in transfer_details.columns
+            if name not in ('Sending Store', 'Receiving Store', 'Quantity Transferred')]
+    return transfer_details.groupby(keys, observed=True)['Quantity Transferred'].sum()
+
+
+def reference_engine(upload):
+    return 'duckdb' if outofcore.extension(upload) in outofcore.SCANNED_EXTENSIONS else REFERENCE
+
+
+def check(module, upload, threshold_date, sell_through_threshold, days_threshold, engines=None, as_of=None):
+    # Raises AssertionError naming the first engine that differs; returns
+    # {engine: (filtered rows, transfers, total quantity)} otherwise
+    reference = reference_engine(upload)
+    # Engines are compared on the same day even when the check runs past midnight
+    as_of = as_of or date.today()
+    engines = [engine for engine in engines or module.ENGINES if engine not in (reference, REFERENCE)]
+    expected, _ = module.run_pipeline(upload, threshold_date, sell_through_threshold, days_threshold, engine=reference,
+                                      as_of=as_of)
+    summary = {reference: (len(expected['filtered_data']), len(expected['transfer_details']),
+                           int(expected['transfer_details']['Quantity Transferred'].sum()))}
+    for engine in engines:
+        outputs, _ = module.run_pipeline(upload, threshold_date, sell_through_threshold, days_threshold, engine=engine,
+                                         as_of=as_of)
+        try:
+            pd.testing.assert_frame_equal(outputs['filtered_data'], expected['filtered_data'])
+            pd.testing.assert_series_equal(transfer_totals(outputs['transfer_details']),
+                                           transfer_totals(expected['transfer_details']))
+            pd.testing.assert_frame_equal(outputs['transfer_details'], expected['transfer_details'])
+        except AssertionError as error:
+            raise AssertionError(f"{module.__name__}: {engine} differs from {reference}\n{error}") from None
+        summary[engine] = (len(outputs['filtered_data']), len(outputs['transfer_details']),
+                           int(outputs['transfer_details']['Quantity Transferred'].sum()))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that every engine of an IST page gives the in-memory results")
+    parser.add_argument('page', choices=PAGES)
+    parser.add_argument('upload', nargs='?', help="workbook, CSV or Parquet file (default: generate one)")
+    parser.add_argument('--rows', type=int, default=50_000, help="rows to generate when no upload is given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--launch-date', type=date.fromisoformat, default=date(2024, 3, 1))
+    parser.add_argument('--sell-through', type=int, default=60)
+    parser.add_argument('--min-age', type=int, default=30)
+    parser.add_argument('--engines', nargs='+', choices=[name for name in pipeline.ENGINE_LABELS if name != REFERENCE])
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(args.page)
+    with tempfile.TemporaryDirectory() as directory:
+        upload = args.upload
+        if upload is None:
+            upload = benchmark.write_uploads(benchmark.generate(args.page, args.rows, args.seed), directory, args.page)['sales']
+        try:
+            summary = check(module, upload, args.launch_date, args.sell_through, args.min_age, args.engines)
+        except AssertionError as error:
+            print(error)
+            return 1
+    for engine, (rows, transfers, quantity) in summary.items():
+        print(f"{engine:<8}{rows:>12,} rows{transfers:>12,} transfers{quantity:>14,} units")
+    print("All engines agree")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,187 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+import pandas as pd
+import profiling
+import upload_cache
+
+# Stage graph runner with memoized stage outputs.
+#
+# A page describes its processing chain as a list of stages. Each stage names
+# the earlier stages (or sources) it reads and the run parameters it takes.
+# A stage's fingerprint is derived from its name, its parameter values and
+# the fingerprints of its inputs, so every fingerprint is known before any
+# work is done. Outputs are cached process-wide under that fingerprint and
+# only the stages whose fingerprint changed are recomputed; a stage whose
+# output is cached never needs its inputs to be materialised.
+#
+# Stage functions get shallow copies of their input frames, so adding or
+# replacing columns leaves the cached input as it was without copying its
+# data; they must not write into an input's columns in place. Cached
+# outputs are shared and must not be modified by callers.
+# Report entries carry the timing, row counts and (with profile=True) peak
+# memory that profiling.measure records for each stage. A progress callback
+# is told about every needed stage before it runs or is taken from cache.
+
+Stage = namedtuple('Stage', ['name', 'func', 'inputs', 'params', 'keyed_on'])
+
+MAX_BYTES = 1024 * 1024 * 1024
+
+# Engines a page can run its chain on; each page maps them to its stage lists
+ENGINE_LABELS = {'pandas': "In memory (pandas)", 'duckdb': "Out of core (DuckDB)", 'polars': "Lazy (Polars)"}
+
+_outputs = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def stage(name, func, inputs=(), params=(), keyed_on=()):
+    # keyed_on lists run parameters that change the output without being passed to func
+    return Stage(name, func, tuple(inputs), tuple(params), tuple(keyed_on))
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def source_fingerprint(value):
+    if value is None:
+        # Optional sources that were not given
+        return _hash(None)
+    if isinstance(value, pd.DataFrame):
+        return _hash('frame', list(value.columns), int(pd.util.hash_pandas_object(value, index=True).sum()))
+    if isinstance(value, list):
+        # Several uploads read as one, in their order
+        return _hash('uploads', [source_fingerprint(part) for part in value])
+    return upload_cache.content_hash(value)
+
+
+def fingerprints(stages, sources, params):
+    prints = {name: source_fingerprint(value) for name, value in sources.items()}
+    for s in stages:
+        missing = [name for name in s.inputs if name not in prints]
+        if missing:
+            raise ValueError(f"Stage '{s.name}' reads {missing} before they are produced")
+        values = [(name, params[name]) for name in s.params + s.keyed_on]
+        prints[s.name] = _hash(s.name, s.func.__module__, s.func.__qualname__, [prints[name] for name in s.inputs], values)
+    return prints
+
+
+def _frame_bytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return 0
+
+
+def _store(fingerprint, value):
+    nbytes = _frame_bytes(value)
+    if nbytes > MAX_BYTES:
+        return
+    with _lock:
+        _outputs[fingerprint] = (value, nbytes)
+        total = sum(size for _, size in _outputs.values())
+        while total > MAX_BYTES and len(_outputs) > 1:
+            _, (_, size) = _outputs.popitem(last=False)
+            total -= size
+            _stats['evictions'] += 1
+
+
+def _lookup(fingerprint):
+    with _lock:
+        if fingerprint in _outputs:
+            _outputs.move_to_end(fingerprint)
+            _stats['hits'] += 1
+            return True, _outputs[fingerprint][0]
+        _stats['misses'] += 1
+        return False, None
+
+
+def _as_argument(value):
+    if not isinstance(value, pd.DataFrame):
+        return value
+    # Notes left in attrs describe the stage that produced a frame; don't inherit them
+    value = value.copy(deep=False)
+    value.attrs = {}
+    return value
+
+
+def _note(value):
+    return value.attrs.get('note') if isinstance(value, pd.DataFrame) else None
+
+
+def _needed(by_name, targets, sources):
+    needed = set()
+    pending = [name for name in targets if name not in sources]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(input_name for input_name in by_name[name].inputs if input_name not in sources)
+    return needed
+
+
+def run(stages, targets, sources, params, profile=False, progress=None):
+    # Returns ({name: output} for targets, report) where report lists, in
+    # execution order, every stage that was needed with whether it was cached.
+    # progress(stage, finished, total) is called as each stage starts; total
+    # counts every stage the targets depend on, though cached outputs can
+    # spare some of them.
+    by_name = {s.name: s for s in stages}
+    prints = fingerprints(stages, sources, params)
+    results = dict(sources)
+    report = []
+    total = len(_needed(by_name, targets, sources))
+
+    def evaluate(name):
+        if name in results:
+            return results[name]
+        s = by_name[name]
+        hit, value = _lookup(prints[name])
+        if hit:
+            if progress is not None:
+                progress(name, len(report), total)
+            report.append({'stage': name, 'fingerprint': prints[name], 'cached': True, 'seconds': 0.0, 'note': _note(value),
+                           'rows_in': None, 'rows_out': profiling.rows(value), 'peak_bytes': None})
+        else:
+            args = [_as_argument(evaluate(input_name)) for input_name in s.inputs]
+            args += [params[param] for param in s.params]
+            if progress is not None:
+                progress(name, len(report), total)
+            value, measured = profiling.measure(s.func, args, trace=profile)
+            report.append(dict({'stage': name, 'fingerprint': prints[name], 'cached': False, 'note': _note(value)}, **measured))
+            _store(prints[name], value)
+        results[name] = value
+        return value
+
+    outputs = {name: evaluate(name) for name in targets}
+    return outputs, report
+
+
+def output_fingerprints(report):
+    return {entry['stage']: entry['fingerprint'] for entry in report}
+
+
+def run_report(report):
+    computed = [entry for entry in report if not entry['cached']]
+    reused = len(report) - len(computed)
+    if not computed:
+        summary = f"All {reused} needed stages reused from cache"
+    else:
+        timings = ', '.join(f"{entry['stage']} {entry['seconds']:.2f}s" for entry in computed)
+        summary = f"Recomputed {timings}; reused {reused} from cache"
+    notes = [entry['note'] for entry in report if entry['note']]
+    return '  \n'.join([summary] + notes)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_outputs), bytes=sum(size for _, size in _outputs.values()))
+
+
+def clear():
+    with _lock:
+        _outputs.clear()
@@ -0,0 +1,114 @@
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+# Per-stage instrumentation for the pages. Every stage call records its wall
+# time and the rows it read and produced, which costs a clock read and a few
+# len() calls. Peak memory needs tracemalloc, which slows Python-level code
+# considerably, so it is only switched on when the planner ticks the option
+# in the "Stage profile" expander. tracemalloc is process-wide: while one
+# session traces, peaks include whatever other sessions allocate meanwhile.
+
+TRACE_KEY = 'trace_stage_memory'
+
+_lock = threading.Lock()
+_tracers = 0
+
+
+def rows(value):
+    if isinstance(value, (tuple, list)):
+        counts = [count for count in map(rows, value) if count is not None]
+        return sum(counts) if counts else None
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+
+def _start_tracing():
+    global _tracers
+    with _lock:
+        if _tracers == 0:
+            tracemalloc.start()
+        _tracers += 1
+
+
+def _stop_tracing():
+    global _tracers
+    with _lock:
+        _tracers -= 1
+        if _tracers == 0:
+            tracemalloc.stop()
+
+
+def measure(func, args, trace=False):
+    # Returns (value, {'seconds', 'rows_in', 'rows_out', 'peak_bytes'})
+    rows_in = rows(list(args))
+    peak_bytes = None
+    if trace:
+        _start_tracing()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        value = func(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        if trace:
+            peak_bytes = max(tracemalloc.get_traced_memory()[1] - base, 0)
+            _stop_tracing()
+    return value, {'seconds': seconds, 'rows_in': rows_in, 'rows_out': rows(value), 'peak_bytes': peak_bytes}
+
+
+def record(report, name, func, args, trace=False):
+    # Runs one stage of a page that is not a stage graph, in pipeline.run's report format
+    value, measured = measure(func, args, trace)
+    report.append(dict({'stage': name, 'cached': False, 'note': None}, **measured))
+    return value
+
+
+def tracing_enabled():
+    import streamlit as st
+
+    return bool(st.session_state.get(TRACE_KEY, False))
+
+
+def table(report):
+    return pd.DataFrame({
+        'Stage': [entry['stage'] for entry in report],
+        'Cached': [entry['cached'] for entry in report],
+        'Seconds': [round(entry['seconds'], 3) for entry in report],
+        'Rows in': pd.array([entry.get('rows_in') for entry in report], dtype='Int64'),
+        'Rows out': pd.array([entry.get('rows_out') for entry in report], dtype='Int64'),
+        'Peak memory (MB)': [None if entry.get('peak_bytes') is None else round(entry['peak_bytes'] / 1024 ** 2, 1)
+                             for entry in report]
+    })
+
+
+def waterfall(report):
+    import plotly.graph_objects as go
+
+    names = [entry['stage'] for entry in report] + ['Total']
+    seconds = [entry['seconds'] for entry in report]
+    figure = go.Figure(go.Waterfall(
+        orientation='h',
+        y=names,
+        x=seconds + [0],
+        measure=['relative'] * len(seconds) + ['total'],
+        text=[f"{value:.3f}s" for value in seconds + [sum(seconds)]],
+        textposition='outside'
+    ))
+    figure.update_yaxes(autorange='reversed')
+    figure.update_layout(xaxis_title='Seconds', showlegend=False, margin={'t': 20})
+    return figure
+
+
+def panel(report):
+    # report is the last run's report, or None before the first run
+    import streamlit as st
+
+    with st.expander("Stage profile"):
+        st.checkbox("Trace peak memory on the next run (slower)", key=TRACE_KEY)
+        if not report:
+            st.caption("Process data to see where the time goes")
+            return
+        st.dataframe(table(report), hide_index=True)
+        st.plotly_chart(waterfall(report))
@@ -1,9 +1,25 @@
-import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from functools import lru_cache
+from datetime import datetime, date
 from io import BytesIO
-
+import upload_cache
+import snapshots
+import incremental
+import pipeline
+import profiling
+import flow
+import compact
+import fused
+import lazy
+import outofcore
+import exports
+import schema
+import grid
+import jobs
+import sweep
+
+@lru_cache(maxsize=None)
 def create_sample_file():
     # Creating a sample DataFrame with the required headers
     sample_data = {
@@ -25,142 +41,129 @@ def create_sample_file():
     processed_data = output.getvalue()
     return processed_data
 
+# Columns the pipeline reads from the upload, the types they are parsed as
+# and which of them a row can't do without; see schema.py
+SCHEMA = [
+    schema.field('Zone', drop_blank=True),
+    schema.field('DESIGN', drop_blank=True),
+    schema.field('STORE_NAME', drop_blank=True),
+    schema.field('1st Rcv Date', 'datetime', drop_blank=True),
+    schema.field('Shop Rcv Qty', 'numeric'),
+    schema.field('Disp. Qty', 'numeric'),
+    schema.field('O.H Qty', 'numeric'),
+    schema.field('Sold Qty', 'numeric')
+]
+COLUMNS = schema.columns(SCHEMA)
+DTYPES = schema.dtypes(SCHEMA)
+
+KEY_COLUMNS = ['Zone', 'STORE_NAME', 'DESIGN']
+
 def load_data(file):
-    df = pd.read_excel(file)
-    df.columns = df.columns.str.strip()  # Strip any leading/trailing whitespace from column names
-    return df
+    # Fails on a missing column or unreadable value, before anything is aggregated
+    return schema.validate(upload_cache.read_excel(file, columns=COLUMNS, dtype=DTYPES), SCHEMA, snapshots.upload_name(file))
+
+def normalize_data(df):
+    return compact.normalize(df, KEY_COLUMNS)
 
 def adjust_date(df, threshold_date):
+    # Dates are parsed and rows without one dropped when the upload is loaded
     threshold_timestamp = pd.Timestamp(threshold_date)
-    df['1st Rcv Date'] = pd.to_datetime(df['1st Rcv Date'], errors='coerce')
-    df = df.dropna(subset=['1st Rcv Date'])  # Remove rows where date conversion failed
     df['Adjusted 1st Rcv Date'] = np.where(df['1st Rcv Date'] <= threshold_timestamp, threshold_timestamp, df['1st Rcv Date'])
     return df
 
 def aggregate_data(df):
-    df['Adjusted 1st Rcv Date'] = pd.to_datetime(df['Adjusted 1st Rcv Date'], errors='coerce')
-    df = df.dropna(subset=['Adjusted 1st Rcv Date'])  # Remove rows where date conversion failed
-    return df.groupby(['Zone', 'STORE_NAME', 'Adjusted 1st Rcv Date', 'DESIGN']).agg({
+    return df.groupby(['Zone', 'STORE_NAME', 'Adjusted 1st Rcv Date', 'DESIGN'], observed=True).agg({
         'Shop Rcv Qty': 'sum',
         'Disp. Qty': 'sum',
         'O.H Qty': 'sum',
         'Sold Qty': 'sum'
     }).reset_index()
 
-def calculate_sell_through(desired_df):
-    desired_df['shop design Sell Through'] = (desired_df['Sold Qty'] / (desired_df['Shop Rcv Qty'] - desired_df['Disp. Qty']) * 100).replace([np.inf, -np.inf, np.nan], 0).astype(int)
-    return desired_df
-
-def calculate_days(df):
-    current_date = datetime.now()
-    df['Days'] = (current_date - df['Adjusted 1st Rcv Date']).dt.days
-    return df
-
-def calculate_zone_design_sell_through(df):
-    df['Net Receiving'] = df['Shop Rcv Qty'] - df['Disp. Qty']
-    zone_design_totals = df.groupby(['Zone', 'DESIGN']).agg({'Sold Qty': 'sum', 'Net Receiving': 'sum'}).reset_index()
-    zone_design_totals['zone design Sell Through'] = (zone_design_totals['Sold Qty'] / zone_design_totals['Net Receiving'] * 100).replace([np.inf, -np.inf, np.nan], 0).astype(int)
-    return zone_design_totals
-
-def merge_data(desired_df, zone_design_totals):
-    return pd.merge(desired_df, zone_design_totals[['Zone', 'DESIGN', 'zone design Sell Through']], on=['Zone', 'DESIGN'], how='left')
+# Grouping levels and column names of this page for fused.py, outofcore.py and sweep.py
+PLAN = {
+    'aggregate_keys': ['Zone', 'STORE_NAME', 'Adjusted 1st Rcv Date', 'DESIGN'],
+    'sell_through_keys': ['Zone', 'DESIGN'],
+    'cover_keys': ['Zone'],
+    'shop_sell_through': 'shop design Sell Through',
+    'group_sell_through': 'zone design Sell Through',
+    'age': 'Zone_Days',
+    'senders_negative': False
+}
 
-def apply_status_condition(desired_df):
-    desired_df['Status'] = np.where(desired_df['shop design Sell Through'] > desired_df['zone design Sell Through'], 'High', 'Low')
-    return desired_df
+def build_plan(aggregated_df, as_of):
+    return fused.build_plan(aggregated_df, PLAN, as_of)
 
-def process_data(desired_df):
-    article_days = desired_df.groupby('Zone')['Days'].max().reset_index()
-    merged_df = pd.merge(desired_df, article_days, on='Zone', how='left', suffixes=('', '_max_days'))
-    merged_df_grouped = merged_df.groupby('Zone').agg({
-        'O.H Qty': 'sum',
-        'Sold Qty': 'sum',
-        'Days': 'max'
-    }).reset_index()
-    result_df = merged_df_grouped[['Zone', 'Days']].rename(columns={'Days': 'Date Difference'})
-    return result_df
-
-def process_and_calculate_cover(df, article_days):
-    merged_df = pd.merge(df, article_days, on='Zone', how='left', suffixes=('', '_max_days'))
-    merged_df_grouped = merged_df.groupby('Zone').agg({
-        'O.H Qty': 'sum',
-        'Sold Qty': 'sum',
-        'Days': 'max'
-    }).reset_index()
-    result_df = merged_df_grouped[['Zone', 'Days']].rename(columns={'Days': 'Date Difference'})
-    merged_df_grouped = pd.merge(merged_df_grouped, result_df, on='Zone', how='left')
-    merged_df_grouped['desired_cover'] = (merged_df_grouped['O.H Qty'] / (merged_df_grouped['Sold Qty'] / merged_df_grouped['Date Difference'])).replace([np.inf, -np.inf, np.nan], 0).astype(int)
-    return merged_df_grouped
-
-def merge_with_desired_cover(desired_df, merged_df_grouped):
-    desired_df = pd.merge(desired_df, merged_df_grouped[['Zone', 'desired_cover']], on='Zone', how='left')
-    desired_df['desired_cover'] = desired_df['desired_cover'].fillna(0).astype(int)
-    return desired_df
-
-def calculate_article_days(df):
-    df['Adjusted 1st Rcv Date'] = pd.to_datetime(df['Adjusted 1st Rcv Date'], errors='coerce')
-    df = df.dropna(subset=['Adjusted 1st Rcv Date'])
-    today = pd.Timestamp.now().normalize()
-    df['Zone_Days'] = (today - df['Adjusted 1st Rcv Date']).dt.days
-    article_days = df.groupby('Zone')['Zone_Days'].max().reset_index()
-    return article_days
-
-def calculate_required_cover(desired_df):
-    desired_df['Transfer in/out'] = (desired_df['desired_cover'] * (desired_df['Sold Qty'] / desired_df['Days']) - desired_df['O.H Qty']).replace([np.inf, -np.inf, np.nan], 0).astype(int)
-    return desired_df
-
-def merge_desired_with_article_days(desired_df, article_days):
-    desired_df = pd.merge(desired_df, article_days, on='Zone', how='left')
-    return desired_df
+def sweep_thresholds(final_df, costs, sell_through_values, days_values, transfer_method='greedy'):
+    return sweep.sweep(final_df, PLAN, sell_through_values, days_values, costs=costs, transfer_method=transfer_method)
 
 def filter_data(desired_df, sell_through_threshold, days_threshold):
     return desired_df[(desired_df['zone design Sell Through'] > sell_through_threshold) & (desired_df['Zone_Days'] > days_threshold)]
 
-def process_transfer_details(filtered_df):
-    sending_stores = filtered_df[filtered_df['Transfer in/out'] > 0]
-    receiving_stores = filtered_df[filtered_df['Transfer in/out'] < 0]
-    transfer_details = []
-
-    for receiving_index, receiving_row in receiving_stores.iterrows():
-        # Ensure that the receiving store does not appear in sending stores with the same DESIGN
-        matches = sending_stores[
-            (sending_stores['Zone'] == receiving_row['Zone']) &
-            (sending_stores['STORE_NAME'] != receiving_row['STORE_NAME']) &  # Ensure the store names are not the same
-            (sending_stores['DESIGN'] == receiving_row['DESIGN']) &  # Match on the same DESIGN
-            (sending_stores['Transfer in/out'] > 0)
-        ]
-
-        if matches.empty:
-            continue
-
-        total_qty_needed = abs(receiving_row['Transfer in/out'])
-
-        for sending_index, sending_row in matches.iterrows():
-            transfer_qty = min(total_qty_needed, sending_row['Transfer in/out'])
-            receiving_stores.at[receiving_index, 'Transfer in/out'] += transfer_qty
-            sending_stores.at[sending_index, 'Transfer in/out'] -= transfer_qty
-            transfer_details.append({
-                'Zone': receiving_row['Zone'],
-                'Sending Store': sending_row['STORE_NAME'],
-                'Receiving Store': receiving_row['STORE_NAME'],
-                'Quantity Transferred': transfer_qty,
-                'DESIGN': sending_row['DESIGN']
-            })
-            total_qty_needed -= transfer_qty
-            if total_qty_needed <= 0:
-                break
+def process_transfer_details(filtered_df, costs=None, transfer_method='greedy'):
+    # Receiving stores carry a negative 'Transfer in/out' on this page
+    transfer_df = flow.transfer_details(filtered_df, PLAN['sell_through_keys'], senders_negative=PLAN['senders_negative'],
+                                       method=transfer_method, costs=costs)
+    return transfer_df[['Zone', 'Sending Store', 'Receiving Store', 'Quantity Transferred', 'DESIGN']]
+
+def plan_out_of_core(upload, threshold_date, sell_through_threshold, days_threshold, as_of):
+    return outofcore.filtered_plan(upload, SCHEMA, KEY_COLUMNS, PLAN, threshold_date, sell_through_threshold, days_threshold,
+                                   as_of)
 
-    transfer_df = pd.DataFrame(transfer_details)
-    return transfer_df
+def plan_lazy(upload, threshold_date, sell_through_threshold, days_threshold, as_of):
+    return lazy.filtered_plan(upload, SCHEMA, KEY_COLUMNS, PLAN, threshold_date, sell_through_threshold, days_threshold,
+                              as_of)
 
 def to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-    processed_data = output.getvalue()
-    return processed_data
+    return exports.to_xlsx({'Sheet1': df})
+
+# Processing chain as a stage graph; see pipeline.py. The step-by-step
+# functions above are the reference for build_plan's single pass.
+STAGES = [
+    pipeline.stage('data', load_data, ['upload']),
+    pipeline.stage('normalized_data', normalize_data, ['data']),
+    pipeline.stage('adjusted_data', adjust_date, ['normalized_data'], ['threshold_date']),
+    pipeline.stage('aggregated_data', aggregate_data, ['adjusted_data']),
+    pipeline.stage('final_data', build_plan, ['aggregated_data'], ['as_of']),
+    pipeline.stage('filtered_data', filter_data, ['final_data'], ['sell_through_threshold', 'days_threshold']),
+    pipeline.stage('transfer_costs', flow.load_costs, ['costs']),
+    pipeline.stage('transfer_details', process_transfer_details, ['filtered_data', 'transfer_costs'], ['transfer_method'])
+]
+
+# The same chain with everything up to the filter run in DuckDB
+OUT_OF_CORE_STAGES = [
+    pipeline.stage('filtered_data', plan_out_of_core, ['upload'],
+                   ['threshold_date', 'sell_through_threshold', 'days_threshold', 'as_of']),
+    pipeline.stage('transfer_costs', flow.load_costs, ['costs']),
+    pipeline.stage('transfer_details', process_transfer_details, ['filtered_data', 'transfer_costs'], ['transfer_method'])
+]
+
+# ... and as one Polars query
+LAZY_STAGES = [
+    pipeline.stage('filtered_data', plan_lazy, ['upload'],
+                   ['threshold_date', 'sell_through_threshold', 'days_threshold', 'as_of']),
+    pipeline.stage('transfer_costs', flow.load_costs, ['costs']),
+    pipeline.stage('transfer_details', process_transfer_details, ['filtered_data', 'transfer_costs'], ['transfer_method'])
+]
+
+ENGINES = {'pandas': STAGES, 'duckdb': OUT_OF_CORE_STAGES, 'polars': LAZY_STAGES}
+
+def run_pipeline(uploaded_file, threshold_date, sell_through_threshold, days_threshold, profile=False, engine='pandas',
+                 transfer_method='greedy', costs_file=None, progress=None, as_of=None):
+    # Ages are counted to as_of, which defaults to today and is fixed for the run
+    params = {
+        'threshold_date': threshold_date,
+        'sell_through_threshold': sell_through_threshold,
+        'days_threshold': days_threshold,
+        'transfer_method': transfer_method,
+        'as_of': as_of or date.today()
+    }
+    return pipeline.run(ENGINES[engine], ['filtered_data', 'transfer_details'], {'upload': uploaded_file, 'costs': costs_file},
+                        params, profile=profile, progress=progress)
 
 def main():
+    # Only the page needs Streamlit; the pipeline above also runs headless from batch.py
+    import streamlit as st
+
     st.title('Regional🌏')
 
     # Provide the sample file for download
@@ -173,56 +176,71 @@ def main():
         mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
 
-    uploaded_file = st.file_uploader("Upload your Excel file", type=['xlsx'])
+    source = st.radio("Data", list(incremental.SOURCE_LABELS), format_func=incremental.SOURCE_LABELS.get, horizontal=True,
+                      key='regional_source')
+    if source == 'state':
+        incremental.page('regional')
+        return
+
+    engine = st.radio("Engine", list(ENGINES), format_func=pipeline.ENGINE_LABELS.get, horizontal=True, key='regional_engine')
+    # The DuckDB and Polars engines also scan CSV and Parquet exports, which can be larger than a workbook
+    upload_types = ['xlsx'] + (outofcore.UPLOAD_TYPES if engine != 'pandas' else [])
+    # An export split into several files is uploaded at once; every sheet of every file is read
+    uploaded_files = st.file_uploader("Upload your Excel files", type=upload_types, accept_multiple_files=True)
+    uploaded_file = uploaded_files[0] if len(uploaded_files) == 1 else uploaded_files or None
+    if uploaded_file is None:
+        uploaded_file = snapshots.picker(COLUMNS, DTYPES, key='regional')
     
     if uploaded_file is not None:
         threshold_date = st.date_input("Season Launch Date", min_value=datetime(2020, 1, 1), value=datetime.now())
+        # Ages are counted to this date; an earlier one replays a past plan
+        as_of = st.date_input("As-of date", value=date.today(), key='regional_as_of')
         sell_through_threshold = st.number_input("Enter Sell-Through Threshold (%)", min_value=0, max_value=100, value=60)
         days_threshold = st.number_input("Enter Minimum Age", min_value=0, max_value=100, value=30)
-
-        if st.button("Process Data") or 'filtered_data' not in st.session_state:
-            data = load_data(uploaded_file)
-            adjusted_data = adjust_date(data, threshold_date)
-            aggregated_data = aggregate_data(adjusted_data)
-            sell_through_data = calculate_sell_through(aggregated_data)
-            days_data = calculate_days(sell_through_data)
-            zone_design_sell_through_data = calculate_zone_design_sell_through(days_data)
-            merged_data = merge_data(days_data, zone_design_sell_through_data)
-            status_data = apply_status_condition(merged_data)
-            processed_data = process_data(status_data)
-            cover_data = process_and_calculate_cover(status_data, processed_data)
-            cover_merged_data = merge_with_desired_cover(status_data, cover_data)
-            article_days = calculate_article_days(cover_merged_data)
-            required_cover_data = calculate_required_cover(cover_merged_data)
-            final_data = merge_desired_with_article_days(required_cover_data, article_days)
-            filtered_data = filter_data(final_data, sell_through_threshold, days_threshold)
-            transfer_details = process_transfer_details(filtered_data)
-
-            # Store the processed data and transfer details in session state
-            st.session_state.filtered_data = filtered_data
-            st.session_state.transfer_details = transfer_details
-
-        # Load from session state
-        filtered_data = st.session_state.filtered_data
-        transfer_details = st.session_state.transfer_details
-
-        processed_data_bytes = to_excel(filtered_data)
-        transfer_data_bytes = to_excel(transfer_details)
-
-        st.dataframe(filtered_data)
-
-        st.download_button(
-            label="Download Processed Data",
-            data=processed_data_bytes,
-            file_name="processed_data.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        st.download_button(
-            label="Download Transfer Details",
-            data=transfer_data_bytes,
-            file_name="transfer_details.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        transfer_method = st.radio("Transfer matching", list(flow.METHOD_LABELS), format_func=flow.METHOD_LABELS.get,
+                                   horizontal=True, key='regional_transfer_method')
+        costs_file = None
+        if transfer_method == 'optimal':
+            # Without a cost table every store pair costs the same
+            costs_file = st.file_uploader("Upload store-to-store transfer costs (From Store, To Store, Cost)", type=['xlsx'],
+                                          key='regional_costs')
+
+        # The first visit processes right away; later runs wait for the button
+        if st.button("Process Data") or jobs.current('regional') is None:
+            # Runs in a worker process; the page polls the job until it finishes
+            jobs.start('regional', 'regional:run_pipeline', {
+                'uploaded_file': jobs.portable(uploaded_file),
+                'threshold_date': threshold_date,
+                'sell_through_threshold': sell_through_threshold,
+                'days_threshold': days_threshold,
+                'profile': profiling.tracing_enabled(),
+                'engine': engine,
+                'transfer_method': transfer_method,
+                'costs_file': jobs.portable(costs_file),
+                'as_of': as_of
+            })
+        result = jobs.panel(jobs.current('regional'), key='regional')
+        if result is not None:
+            outputs, report = result
+            st.session_state.regional_stage_report = report
+            st.caption(pipeline.run_report(report))
+            filtered_data = outputs['filtered_data']
+            transfer_details = outputs['transfer_details']
+
+            grid.view(filtered_data, key='regional')
+
+            fingerprints = pipeline.output_fingerprints(report)
+            exports.download_buttons({
+                'Processed Data': (filtered_data, 'processed_data'),
+                'Transfer Details': (transfer_details, 'transfer_details')
+            }, {
+                'Processed Data': fingerprints['filtered_data'],
+                'Transfer Details': fingerprints['transfer_details']
+            }, key='regional')
+
+        sweep.panel('regional', uploaded_file, threshold_date, transfer_method=transfer_method, costs_file=costs_file, as_of=as_of)
+
+        profiling.panel(st.session_state.get('regional_stage_report'))
 
 if __name__ == "__main__":
     main()
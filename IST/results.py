@@ -0,0 +1,173 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+# Process-wide store of finished page outputs, shared by every session.
+#
+# A page run's outputs are put here under their pipeline fingerprints,
+# which already hash the inputs and every parameter, so planners who run
+# the same upload with the same settings share one copy. Job records keep
+# only those keys; a session fetches the frames of the result it shows once
+# and keeps them until it moves on to another result (see jobs.panel), as
+# get() converts the whole table back to pandas each time.
+#
+# Frames are held as Arrow tables, which are smaller than the pandas
+# frames they come from and are not modified by callers. The store keeps
+# at most MAX_BYTES in memory; the least recently used tables beyond that
+# are written to DIRECTORY (when SPILL is set) and read back through a
+# memory map when asked for, or dropped. Spilled files are removed least
+# recently used first once they exceed MAX_SPILL_BYTES.
+
+MAX_BYTES = 1024 * 1024 * 1024
+SPILL = True
+DIRECTORY = os.path.join(tempfile.gettempdir(), 'ist_results')
+MAX_SPILL_BYTES = 8 * 1024 * 1024 * 1024
+SUFFIX = '.arrow'
+
+_entries = OrderedDict()
+_lock = threading.RLock()
+_stats = {'hits': 0, 'misses': 0, 'spills': 0, 'reloads': 0, 'evictions': 0}
+
+
+def _table(value):
+    # The Arrow table for a frame, or None when it has to be kept as it is
+    if not isinstance(value, pd.DataFrame):
+        return None
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    try:
+        return pa.Table.from_pandas(value)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+
+
+def _nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    nbytes = getattr(value, 'nbytes', None)
+    return int(nbytes) if nbytes is not None else 0
+
+
+def _path(key):
+    return os.path.join(DIRECTORY, f'{key}{SUFFIX}')
+
+
+def _spill(key, table):
+    import pyarrow as pa
+
+    os.makedirs(DIRECTORY, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=DIRECTORY)
+    os.close(handle)
+    try:
+        with pa.OSFile(temporary, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temporary, _path(key))
+    except BaseException:
+        os.remove(temporary)
+        raise
+    _stats['spills'] += 1
+    _trim_spilled()
+
+
+def _spilled():
+    # (path, bytes, last used) of spilled tables, most recently used first
+    found = []
+    if not os.path.isdir(DIRECTORY):
+        return found
+    for name in os.listdir(DIRECTORY):
+        if not name.endswith(SUFFIX):
+            continue
+        path = os.path.join(DIRECTORY, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        found.append((path, stat.st_size, stat.st_mtime))
+    return sorted(found, key=lambda entry: entry[2], reverse=True)
+
+
+def _trim_spilled():
+    total = 0
+    for path, size, _ in _spilled():
+        total += size
+        if total > MAX_SPILL_BYTES and total != size:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _evict():
+    total = sum(size for _, size in _entries.values())
+    while total > MAX_BYTES and len(_entries) > 1:
+        key, (value, size) = _entries.popitem(last=False)
+        total -= size
+        _stats['evictions'] += 1
+        if SPILL and not isinstance(value, pd.DataFrame) and value is not None:
+            _spill(key, value)
+
+
+def put(key, value):
+    # Stores a page output under its fingerprint and returns the key
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return key
+        if SPILL and os.path.exists(_path(key)):
+            return key
+    table = _table(value)
+    stored = table if table is not None else value
+    with _lock:
+        _entries[key] = (stored, _nbytes(stored))
+        _evict()
+    return key
+
+
+def get(key):
+    # A fresh pandas frame for the key, or None once it has been dropped
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            _stats['hits'] += 1
+            stored = _entries[key][0]
+        else:
+            stored = None
+    if stored is not None:
+        return stored.copy() if isinstance(stored, pd.DataFrame) else stored.to_pandas()
+    if SPILL and os.path.exists(_path(key)):
+        import pyarrow as pa
+
+        try:
+            with pa.memory_map(_path(key), 'r') as source:
+                df = pa.ipc.open_file(source).read_all().to_pandas()
+            os.utime(_path(key))
+        except (OSError, pa.ArrowInvalid):
+            pass
+        else:
+            with _lock:
+                _stats['reloads'] += 1
+            return df
+    with _lock:
+        _stats['misses'] += 1
+    return None
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_entries), bytes=sum(size for _, size in _entries.values()))
+
+
+def stats_report():
+    current = stats()
+    spilled = _spilled()
+    return (f"Result store: {current['entries']} results in memory ({current['bytes'] / 1e6:.1f} MB), "
+            f"{len(spilled)} on disk ({sum(size for _, size, _ in spilled) / 1e6:.1f} MB)")
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,123 @@
+import datetime
+from collections import namedtuple
+import numpy as np
+
+# Declarative upload schemas. Each page lists the fields it reads: the
+# header, how the loader converts it and whether rows without a value are
+# dropped. The loader converts every typed column once, vectorized, and
+# records the values it could not read; validate() then checks the frame
+# against the page's schema before anything else runs:
+#
+#   - a missing header, or any value that is present but is not a number or
+#     a date where one is expected, fails the upload with SchemaError, which
+#     names each problem with its count and the first offending rows;
+#   - rows with a blank key or date are dropped once, here, and counted in
+#     the load stage's note; later stages can rely on those columns.
+#
+# Blank quantities stay missing and are summed as nothing, as before.
+
+Field = namedtuple('Field', ['name', 'kind', 'drop_blank'])
+
+# What a failed conversion is reported as, by field kind
+KIND_LABELS = {'numeric': "a number", 'datetime': "a date"}
+
+# Offending rows named per problem
+SAMPLE_ROWS = 5
+
+
+class SchemaError(ValueError):
+    def __init__(self, upload, problems):
+        # problems lists (column, description) pairs
+        self.upload = upload
+        self.problems = problems
+        lines = [f"{upload or 'The upload'} does not match the expected layout:"]
+        lines += [f"- '{column}': {description}" for column, description in problems]
+        super().__init__('\n'.join(lines))
+
+    def __reduce__(self):
+        # Raised in job worker processes and re-raised in the page's
+        return SchemaError, (self.upload, self.problems)
+
+
+def field(name, kind='text', drop_blank=False):
+    # kind is 'text', 'numeric' or 'datetime'
+    return Field(name, kind, drop_blank)
+
+
+def columns(fields):
+    return [f.name for f in fields]
+
+
+def dtypes(fields):
+    # The loader's dtype option for the typed fields
+    return {f.name: f.kind for f in fields if f.kind != 'text'}
+
+
+def unparsed(raw, converted, label=None):
+    # Values that were present but did not convert, as the loader records
+    # them: their count, first spreadsheet rows and the values themselves;
+    # label turns a row position into the row reported
+    candidates = np.flatnonzero(converted.isna().to_numpy() & raw.notna().to_numpy())
+    if len(candidates):
+        # Cells holding only spaces are blank rather than unreadable, as is
+        # Excel's day zero (a placeholder date), which reads as a time of day
+        values = raw.iloc[candidates]
+        blank = values.astype(str).str.strip().eq('') | values.map(lambda value: isinstance(value, datetime.time))
+        candidates = candidates[~blank.to_numpy(dtype=bool)]
+    if not len(candidates):
+        return None
+    return {
+        'count': int(len(candidates)),
+        'rows': [label(position) if label else int(position) + 2 for position in candidates[:SAMPLE_ROWS]],
+        'values': raw.iloc[candidates[:SAMPLE_ROWS]].astype(str).tolist()
+    }
+
+
+def _describe(kind, entry):
+    values = ', '.join(repr(value) for value in entry.get('values', []))
+    rows = ', '.join(str(row) for row in entry.get('rows', []))
+    described = f"unreadable as {KIND_LABELS.get(kind, kind)}: {entry['count']:,}"
+    if rows:
+        described += f" (rows {rows}{'…' if entry['count'] > len(entry['rows']) else ''}"
+        described += f"; e.g. {values})" if values else ")"
+    return described
+
+
+def check(fields, available, failures, upload=None, partial=None):
+    # Raises SchemaError for missing headers and unconverted values;
+    # failures maps a column to unparsed()'s record, or to {'count': n}
+    # where only the count is known, and partial a column to the sheets or
+    # files of a combined upload that lack it
+    problems = [(f.name, "missing column") for f in fields if f.name not in available]
+    problems += [(f.name, f"missing in {', '.join(partial[f.name])}") for f in fields
+                 if f.name in available and (partial or {}).get(f.name)]
+    kinds = {f.name: f.kind for f in fields}
+    for name, entry in failures.items():
+        if name in kinds and entry and entry['count']:
+            problems.append((name, _describe(kinds[name], entry)))
+    if problems:
+        raise SchemaError(upload, problems)
+
+
+def dropped_report(blank_counts, dropped):
+    # blank_counts maps each required column to its blank values
+    counts = ', '.join(f"{name} {int(count):,}" for name, count in blank_counts.items() if count)
+    return f"Dropped {int(dropped):,} rows without a value (blank {counts})"
+
+
+def validate(df, fields, upload=None):
+    # Checks a loaded frame against the schema and drops the rows without a
+    # required value; returns the frame with a note of what was dropped
+    check(fields, set(df.columns), df.attrs.get('unparsed', {}), upload, df.attrs.get('partial'))
+    required = [f.name for f in fields if f.drop_blank]
+    if not required:
+        return df
+    blank = df[required].isna().to_numpy()
+    dropped = blank.any(axis=1)
+    if not dropped.any():
+        return df
+    note = df.attrs.get('note')
+    summary = dropped_report(dict(zip(required, blank.sum(axis=0))), dropped.sum())
+    df = df[~dropped]
+    df.attrs['note'] = f"{note}  \n{summary}" if note else summary
+    return df
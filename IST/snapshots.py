@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+# Disk snapshots of parsed uploads, so a workbook that was parsed once is
+# never parsed again, in any session, until it is evicted. Each parse that
+# upload_cache makes is written to DIRECTORY as an uncompressed Arrow IPC
+# file, keyed by the upload's SHA-256 and the loader options, with the
+# typed frame exactly as the loader returned it. Snapshots are opened
+# through a memory map, so a reload reads the Arrow buffers in place
+# instead of parsing cells; only the copy every caller gets is made.
+#
+# Files are replaced atomically, so sessions in other processes never see
+# half a snapshot. Opening one refreshes its modification time, and the
+# least recently used files are removed once they exceed MAX_BYTES.
+# Listing them only stats the files: a file's metadata is read once and
+# kept until the file is replaced or removed.
+#
+# A Snapshot stands in for an uploaded file: pages offer a picker of the
+# stored snapshots that hold their columns, and upload_cache reads a picked
+# one as if the workbook had been uploaded again. Snapshots belong to the
+# server, not to a session: every session's picker lists every file loaded
+# on it, like the upload cache serves every session. Point DIRECTORY at a
+# location of its own for each group of users that must not see each
+# other's files.
+
+DIRECTORY = os.path.join(tempfile.gettempdir(), 'ist_snapshots')
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+SUFFIX = '.arrow'
+METADATA_KEY = b'ist_snapshot'
+
+# Set to False to always parse, e.g. when timing the loader
+ENABLED = True
+
+Snapshot = namedtuple('Snapshot', ['digest', 'name'])
+
+# Metadata read so far, by path, with the (inode, size) it was read at
+_known = {}
+_lock = threading.Lock()
+
+
+def enabled():
+    if not ENABLED:
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def upload_name(file):
+    if isinstance(file, list):
+        # Several uploads read as one
+        names = [upload_name(part) for part in file]
+        return names[0] if len(names) == 1 else f"{names[0]} and {len(names) - 1} more"
+    if isinstance(file, Snapshot):
+        return file.name
+    if isinstance(file, (str, os.PathLike)):
+        return os.path.basename(os.fspath(file))
+    return getattr(file, 'name', None) or 'upload'
+
+
+def covers(entry_columns, entry_dtype, frame_columns, columns, dtype):
+    # Whether a parse with entry_columns/entry_dtype can serve a request for
+    # columns/dtype; both dtype mappings hold string kinds
+    wanted = set(columns) if columns is not None else None
+    if wanted is None:
+        if entry_columns is not None:
+            return False
+    elif entry_columns is not None and not wanted <= set(entry_columns):
+        return False
+    names = wanted if wanted is not None else set(frame_columns)
+    if any(entry_dtype.get(name) != kind for name, kind in dtype.items() if name in names):
+        return False
+    return not any(name in names and name not in dtype for name in entry_dtype)
+
+
+def _usable(entry, columns, dtype):
+    # Snapshots saved before the loader read every sheet and recorded
+    # unreadable values are parsed again
+    return 'sheets' in entry and covers(entry['columns'], entry['dtype'], entry['frame_columns'], columns, dtype)
+
+
+def _path(digest, columns, dtype):
+    options = hashlib.sha256(json.dumps([columns, sorted(dtype.items())]).encode('utf-8')).hexdigest()
+    return os.path.join(DIRECTORY, f'{digest}-{options[:16]}{SUFFIX}')
+
+
+def _metadata(path):
+    import pyarrow as pa
+
+    with pa.memory_map(path, 'r') as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads(schema.metadata[METADATA_KEY])
+
+
+def entries():
+    # Stored snapshots, most recently used first
+    found = []
+    if not os.path.isdir(DIRECTORY):
+        return found
+    for name in os.listdir(DIRECTORY):
+        if not name.endswith(SUFFIX):
+            continue
+        path = os.path.join(DIRECTORY, name)
+        try:
+            stat = os.stat(path)
+            # Replacing a file gives it a new inode; opening one only touches its times
+            identity = (stat.st_ino, stat.st_size)
+            with _lock:
+                known = _known.get(path)
+            if known is None or known[0] != identity:
+                known = (identity, _metadata(path))
+                with _lock:
+                    _known[path] = known
+        except (OSError, KeyError, ValueError, TypeError):
+            # Removed meanwhile, or not a snapshot
+            continue
+        found.append(dict(known[1], path=path, bytes=stat.st_size, used=stat.st_mtime))
+    listed = {entry['path'] for entry in found}
+    with _lock:
+        for path in [path for path in _known if path not in listed]:
+            del _known[path]
+    return sorted(found, key=lambda entry: entry['used'], reverse=True)
+
+
+def _evict():
+    total = 0
+    for entry in entries():
+        total += entry['bytes']
+        if total > MAX_BYTES and total != entry['bytes']:
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+
+
+def save(digest, name, columns, dtype, df):
+    # Returns False when the frame has values Arrow cannot store as one type
+    import pyarrow as pa
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return False
+    metadata = {
+        'digest': digest,
+        'name': name,
+        'columns': list(columns) if columns is not None else None,
+        'dtype': dict(dtype),
+        'frame_columns': [str(column) for column in df.columns],
+        'rows': len(df),
+        'engine': df.attrs.get('engine'),
+        'parse_seconds': df.attrs.get('parse_seconds'),
+        'unparsed': df.attrs.get('unparsed', {}),
+        'partial': df.attrs.get('partial', {}),
+        'sheets': df.attrs.get('sheets', []),
+        'saved': time.time()
+    }
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+    os.makedirs(DIRECTORY, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=DIRECTORY)
+    os.close(handle)
+    try:
+        with pa.OSFile(temporary, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temporary, _path(digest, columns, dtype))
+    except BaseException:
+        os.remove(temporary)
+        raise
+    _evict()
+    return True
+
+
+def load(digest, columns, dtype):
+    # Returns the stored frame for the upload and options, or None
+    import pyarrow as pa
+
+    start = time.perf_counter()
+    for entry in entries():
+        if entry['digest'] != digest or not _usable(entry, columns, dtype):
+            continue
+        try:
+            with pa.memory_map(entry['path'], 'r') as source:
+                df = pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+            os.utime(entry['path'])
+        except (OSError, pa.ArrowInvalid):
+            continue
+        if columns is not None:
+            df = df[[name for name in df.columns if name in set(columns)]]
+        df.attrs['engine'] = entry['engine']
+        df.attrs['parse_seconds'] = entry['parse_seconds']
+        df.attrs['unparsed'] = entry['unparsed']
+        df.attrs['partial'] = entry['partial']
+        df.attrs['sheets'] = entry['sheets']
+        df.attrs['snapshot_seconds'] = time.perf_counter() - start
+        return df
+    return None
+
+
+def available(columns, dtype):
+    # Snapshots that can stand in for an upload with these loader options
+    if not enabled():
+        return []
+    dtype = {name: str(kind) for name, kind in (dtype or {}).items()}
+    return [entry for entry in entries() if _usable(entry, columns, dtype)]
+
+
+def picker(columns, dtype, key):
+    # Streamlit select box of usable snapshots; returns a Snapshot or None
+    import streamlit as st
+
+    choices = available(columns, dtype)
+    if not choices:
+        return None
+    labels = {None: "—"}
+    for entry in choices:
+        saved = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['saved']))
+        labels.setdefault(Snapshot(entry['digest'], entry['name']),
+                          f"{entry['name']} ({entry['rows']:,} rows, loaded {saved})")
+    return st.selectbox("Or reopen a previously loaded file", list(labels), format_func=labels.get, key=f'{key}_snapshot',
+                        help="Files loaded on this server by any user")
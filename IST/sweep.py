@@ -0,0 +1,175 @@
+import importlib
+from datetime import date
+import numpy as np
+import pandas as pd
+import flow
+import pipeline
+
+# Threshold sweep for the Network, Regional and City pages: rows kept,
+# transfers, units moved and stores touched for every pair of a grid of
+# sell-through thresholds and minimum ages, from one pass over final_data.
+#
+# filter_data keeps a row when its group sell-through is above the
+# threshold and its group age is above the minimum age. Both are constant
+# over a transfer group (the page's sell_through_keys), and transfers never
+# cross groups, so each group either keeps all of its transfers or none.
+# The transfers are therefore matched once, on the unfiltered plan, and
+# every row and transfer is placed on the grid by how many thresholds of
+# each axis it clears. A grid cell's totals are then a two-dimensional
+# suffix sum over those counts, which costs the same for a 20×20 grid as
+# for a single pair; stores touched take a running maximum per store.
+
+SELL_THROUGH = 'Sell-Through Threshold'
+MIN_AGE = 'Minimum Age'
+
+# Results per threshold pair, and their labels in the charts
+METRICS = {'Rows': "Rows kept", 'Transfers': "Transfers", 'Units Moved': "Units moved", 'Stores Touched': "Stores touched"}
+
+MAX_STEPS = 50
+
+
+def steps(low, high, count):
+    # count whole-number thresholds from low to high, without repeats
+    return tuple(int(value) for value in np.unique(np.linspace(low, high, count).round()))
+
+
+def _cleared(values, thresholds):
+    # How many of the ascending thresholds each value is above; missing
+    # values are above none, as they fail the filter's comparison
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), 0, np.searchsorted(thresholds, values, side='left'))
+
+
+def _suffix_totals(first, second, weights, shape):
+    # totals[a, b] sums the weights of entries that clear more than a
+    # thresholds on the first axis and more than b on the second
+    counts = np.bincount(first * (shape[1] + 1) + second, weights=weights, minlength=(shape[0] + 1) * (shape[1] + 1))
+    counts = counts.reshape(shape[0] + 1, shape[1] + 1)
+    return counts[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1][1:, 1:]
+
+
+def _stores_touched(store, first, second, shape):
+    # A store is touched in a cell when any of its transfers is kept there.
+    # reach[s, a] is the most second-axis thresholds a transfer of store s
+    # clears among those clearing more than a on the first axis.
+    n_stores = int(store.max()) + 1 if len(store) else 0
+    reach = np.zeros((n_stores, shape[0] + 1), dtype=np.int64)
+    np.maximum.at(reach, (store, first), second)
+    reach = np.maximum.accumulate(reach[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    cells = (np.arange(shape[0]) * (shape[1] + 1) + reach).ravel()
+    counts = np.bincount(cells, minlength=shape[0] * (shape[1] + 1)).reshape(shape[0], shape[1] + 1)
+    return counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+
+
+def sweep(final_df, plan, sell_through_values, days_values, costs=None, transfer_method='greedy', store_col='STORE_NAME'):
+    # Returns one row per threshold pair with the METRICS filter_data and the
+    # page's transfers would give for it
+    keys = plan['sell_through_keys']
+    sell_through_values = np.unique(np.asarray(sell_through_values, dtype=np.float64))
+    days_values = np.unique(np.asarray(days_values, dtype=np.float64))
+    shape = (len(sell_through_values), len(days_values))
+
+    first = _cleared(final_df[plan['group_sell_through']], sell_through_values)
+    second = _cleared(final_df[plan['age']], days_values)
+    rows = _suffix_totals(first, second, None, shape)
+
+    transfer_df = flow.transfer_details(final_df, keys, plan['senders_negative'], method=transfer_method, costs=costs,
+                                        store_col=store_col)
+    groups = pd.DataFrame({key: final_df[key].astype(object) for key in keys})
+    groups['first'] = first
+    groups['second'] = second
+    groups = groups.drop_duplicates(keys)
+    placed = transfer_df[keys].astype(object).merge(groups, on=keys, how='left')
+    transfer_first = placed['first'].fillna(0).to_numpy(dtype=np.int64)
+    transfer_second = placed['second'].fillna(0).to_numpy(dtype=np.int64)
+    quantity = transfer_df['Quantity Transferred'].to_numpy(dtype=np.float64)
+    transfers = _suffix_totals(transfer_first, transfer_second, None, shape)
+    units = _suffix_totals(transfer_first, transfer_second, quantity, shape)
+
+    # Both ends of a transfer touch a store
+    store_codes, _ = pd.factorize(pd.concat([transfer_df['Sending Store'], transfer_df['Receiving Store']], ignore_index=True))
+    known = store_codes >= 0
+    touched = _stores_touched(store_codes[known], np.tile(transfer_first, 2)[known], np.tile(transfer_second, 2)[known], shape)
+
+    result = pd.MultiIndex.from_product([sell_through_values.astype(np.int64), days_values.astype(np.int64)],
+                                        names=[SELL_THROUGH, MIN_AGE]).to_frame(index=False)
+    result['Rows'] = rows.ravel().astype(np.int64)
+    result['Transfers'] = transfers.ravel().astype(np.int64)
+    result['Units Moved'] = units.ravel().astype(np.int64)
+    result['Stores Touched'] = touched.ravel().astype(np.int64)
+    return result
+
+
+def run(page, uploaded_file, threshold_date, sell_through_values, days_values, transfer_method='greedy', costs_file=None,
+        as_of=None, profile=False, progress=None):
+    # The page's chain up to final_data, then the sweep; shares cached
+    # stages with the page's own runs
+    module = importlib.import_module(page)
+    stages = [s for s in module.STAGES if s.name not in ('filtered_data', 'transfer_details')]
+    stages.append(pipeline.stage('threshold_sweep', module.sweep_thresholds, ['final_data', 'transfer_costs'],
+                                 ['sell_through_values', 'days_values', 'transfer_method']))
+    params = {
+        'threshold_date': threshold_date,
+        'sell_through_values': tuple(sell_through_values),
+        'days_values': tuple(days_values),
+        'transfer_method': transfer_method,
+        'as_of': as_of or date.today()
+    }
+    return pipeline.run(stages, ['threshold_sweep'], {'upload': uploaded_file, 'costs': costs_file}, params, profile=profile,
+                        progress=progress)
+
+
+def heatmap(table, metric):
+    import plotly.graph_objects as go
+
+    pivot = table.pivot(index=MIN_AGE, columns=SELL_THROUGH, values=metric)
+    figure = go.Figure(go.Heatmap(z=pivot.to_numpy(), x=pivot.columns, y=pivot.index, colorbar={'title': METRICS[metric]}))
+    figure.update_layout(xaxis_title="Sell-through threshold (%)", yaxis_title="Minimum age (days)", margin={'t': 20})
+    return figure
+
+
+def curve(table, metric):
+    # The metric against the sell-through threshold, one line per minimum age
+    import plotly.graph_objects as go
+
+    figure = go.Figure()
+    for days, rows in table.groupby(MIN_AGE, sort=True):
+        figure.add_trace(go.Scatter(x=rows[SELL_THROUGH], y=rows[metric], mode='lines', name=f"{days} days"))
+    figure.update_layout(xaxis_title="Sell-through threshold (%)", yaxis_title=METRICS[metric], legend_title="Minimum age",
+                         margin={'t': 20})
+    return figure
+
+
+def panel(page, uploaded_file, threshold_date, transfer_method='greedy', costs_file=None, as_of=None):
+    # Streamlit section of a page: pick the grid, run the sweep as a job and
+    # chart the result
+    import streamlit as st
+    import grid
+    import jobs
+
+    with st.expander("Threshold sweep"):
+        columns = st.columns(2)
+        sell_through_range = columns[0].slider("Sell-through thresholds (%)", 0, 100, (20, 80), key=f'{page}_sweep_sell_through')
+        days_range = columns[1].slider("Minimum ages (days)", 0, 100, (0, 60), key=f'{page}_sweep_age')
+        count = st.number_input("Steps per axis", min_value=2, max_value=MAX_STEPS, value=20, key=f'{page}_sweep_steps')
+        if st.button("Run sweep", key=f'{page}_sweep_run'):
+            jobs.start(f'{page}_sweep', 'sweep:run', {
+                'page': page,
+                'uploaded_file': jobs.portable(uploaded_file),
+                'threshold_date': threshold_date,
+                'sell_through_values': steps(*sell_through_range, count),
+                'days_values': steps(*days_range, count),
+                'transfer_method': transfer_method,
+                'costs_file': jobs.portable(costs_file),
+                'as_of': as_of
+            })
+        result = jobs.panel(jobs.current(f'{page}_sweep'), key=f'{page}_sweep')
+        if result is None:
+            return
+        outputs, report = result
+        st.caption(pipeline.run_report(report))
+        table = outputs['threshold_sweep']
+        metric = st.radio("Show", list(METRICS), format_func=METRICS.get, horizontal=True, key=f'{page}_sweep_metric')
+        st.plotly_chart(heatmap(table, metric))
+        st.plotly_chart(curve(table, metric))
+        grid.view(table, key=f'{page}_sweep_table')
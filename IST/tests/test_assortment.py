@@ -0,0 +1,21 @@
+import pandas as pd
+
+import assortment
+
+
+def test_allocate_stock_with_different_totals_per_upc():
+    sales = pd.DataFrame({
+        'STORE_NAME': ['A', 'B', 'A', 'B'],
+        'UPC': ['u1', 'u1', 'u2', 'u2'],
+        'Shop Rcv Qty': [10, 10, 10, 10],
+        'Disp. Qty': [0, 0, 0, 0],
+        'Sold Qty': [9, 8, 7, 1]
+    })
+    stock = pd.DataFrame({'UPC': ['u1', 'u2'], 'QTY': [13, 5]})
+    sales, stock = assortment.normalize_data(sales, stock)
+
+    result = assortment.process_data(sales, stock, 50)
+
+    transfers = result.set_index(['STORE_NAME', 'UPC'])['Transfer Qty']
+    assert transfers.dtype == 'int64'
+    assert transfers.to_dict() == {('A', 'u1'): 9, ('B', 'u1'): 4, ('A', 'u2'): 5, ('B', 'u2'): 0}
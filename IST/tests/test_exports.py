@@ -0,0 +1,12 @@
+import pandas as pd
+import pytest
+
+import exports
+
+
+def test_xlsx_refuses_more_rows_than_a_sheet_holds(monkeypatch):
+    monkeypatch.setattr(exports, 'XLSX_MAX_ROWS', 5)
+
+    assert exports.to_xlsx({'Sheet1': pd.DataFrame({'a': range(4)})})
+    with pytest.raises(ValueError, match='CSV or Parquet'):
+        exports.to_xlsx({'Sheet1': pd.DataFrame({'a': range(5)})})
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+import benchmark
+import flow
+import transfers
+
+
+def test_cheap_pair_kept_beyond_neighbours_listed_outside_the_group():
+    # The sender lists more than NEIGHBOURS cheaper destinations, none of them in its group
+    outside = [f"Far {n}" for n in range(flow.NEIGHBOURS + 10)]
+    costs = pd.DataFrame({
+        'From Store': ['S'] * len(outside) + ['S', 'X'],
+        'To Store': outside + ['R2', 'Y'],
+        'Cost': [1.0] * len(outside) + [10.0, 100.0]
+    })
+    positions = pd.DataFrame({
+        'DESIGN': ['D1'] * 3,
+        'STORE_NAME': ['S', 'R1', 'R2'],
+        'Transfer in/out': [-5, 3, 4]
+    })
+
+    result = flow.optimal_transfers(positions, ['DESIGN'], senders_negative=True, costs=costs, workers=1)
+
+    moved = result.set_index('Receiving Store')['Quantity Transferred'].to_dict()
+    # R2 is filled over its listed pair first, the rest goes to R1 at the unlisted cost
+    assert moved == {'R1': 1, 'R2': 4}
+
+
+def plan_cost(plan, costs):
+    # Pairs the table doesn't list cost as much as the dearest listed pair
+    listed = costs.set_index(['From Store', 'To Store'])['Cost']
+    pairs = pd.MultiIndex.from_frame(plan[['Sending Store', 'Receiving Store']].astype(object))
+    return float((listed.reindex(pairs).fillna(listed.max()).to_numpy() * plan['Quantity Transferred'].to_numpy()).sum())
+
+
+def test_lowest_cost_plan_moves_as_much_as_row_order_for_less():
+    costs = benchmark.generate_costs(60, seed=1, listed=8)
+    rng = np.random.default_rng(2)
+    positions = pd.DataFrame([(f'D{design}', store) for design in range(40) for store in costs['From Store'].unique()
+                              if rng.random() < 0.3], columns=['DESIGN', 'STORE_NAME'])
+    positions['Transfer in/out'] = rng.integers(-9, 10, len(positions))
+
+    optimal = flow.optimal_transfers(positions, ['DESIGN'], senders_negative=True, costs=costs, workers=1)
+    greedy = transfers.transfer_details(positions, ['DESIGN'], senders_negative=True)
+
+    assert optimal['Quantity Transferred'].sum() == greedy['Quantity Transferred'].sum()
+    assert plan_cost(optimal, costs) < plan_cost(greedy, costs)
@@ -0,0 +1,77 @@
+import importlib
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+import compact
+import fused
+import incremental
+
+AS_OF = date(2024, 9, 1)
+
+
+def _ratio_to_int(values):
+    return values.replace([np.inf, -np.inf, np.nan], 0).astype(int)
+
+
+def step_by_step(df, spec, as_of):
+    # The chain build_plan replaced, as the pages ran it: one step per
+    # column, with every group total merged back onto the rows
+    sell_keys, cover_keys = spec['sell_through_keys'], spec['cover_keys']
+    as_of = pd.Timestamp(as_of).normalize()
+    df[spec['shop_sell_through']] = _ratio_to_int(df['Sold Qty'] / (df['Shop Rcv Qty'] - df['Disp. Qty']) * 100)
+    df['Days'] = (as_of - df['Adjusted 1st Rcv Date']).dt.days
+    df['Net Receiving'] = df['Shop Rcv Qty'] - df['Disp. Qty']
+
+    group_totals = df.groupby(sell_keys, observed=True).agg({'Sold Qty': 'sum', 'Net Receiving': 'sum'}).reset_index()
+    group_totals[spec['group_sell_through']] = _ratio_to_int(group_totals['Sold Qty'] / group_totals['Net Receiving'] * 100)
+    df = compact.merge(df, group_totals[sell_keys + [spec['group_sell_through']]], on=sell_keys, how='left')
+    df['Status'] = compact.status(df[spec['shop_sell_through']] > df[spec['group_sell_through']])
+
+    cover = df.groupby(cover_keys, observed=True).agg({'O.H Qty': 'sum', 'Sold Qty': 'sum', 'Days': 'max'}).reset_index()
+    cover['desired_cover'] = _ratio_to_int(cover['O.H Qty'] / (cover['Sold Qty'] / cover['Days']))
+    df = compact.merge(df, cover[cover_keys + ['desired_cover']], on=cover_keys, how='left')
+    df['desired_cover'] = df['desired_cover'].fillna(0).astype(int)
+
+    ages = df.assign(**{spec['age']: df['Days']}).groupby(cover_keys, observed=True)[spec['age']].max().reset_index()
+    df['Transfer in/out'] = _ratio_to_int(df['desired_cover'] * (df['Sold Qty'] / df['Days']) - df['O.H Qty'])
+    return compact.merge(df, ages, on=cover_keys, how='left')
+
+
+@pytest.fixture(scope='module')
+def aggregated(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('uploads'))
+    frames = {}
+    for page in ('network', 'regional', 'city'):
+        module = importlib.import_module(page)
+        upload = benchmark.write_uploads(benchmark.generate(page, 5_000, seed=3), directory, page)['sales']
+        frames[page] = incremental.aggregate(module, upload, date(2024, 3, 1))
+    return frames
+
+
+@pytest.mark.parametrize('page', ['network', 'regional', 'city'])
+def test_build_plan_matches_step_by_step_chain(page, aggregated):
+    spec = importlib.import_module(page).PLAN
+
+    expected = step_by_step(aggregated[page].copy(), spec, AS_OF)
+    result = fused.build_plan(aggregated[page].copy(), spec, AS_OF)
+
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize('page', ['network', 'regional', 'city'])
+def test_build_plan_counts_days_to_the_given_date(page, aggregated):
+    spec = importlib.import_module(page).PLAN
+
+    earlier = fused.build_plan(aggregated[page].copy(), spec, AS_OF)
+    later = fused.build_plan(aggregated[page].copy(), spec, date(2024, 9, 11))
+
+    # Ages move with the date passed in, not with the day the plan is built
+    assert ((later['Days'] - earlier['Days']) == 10).all()
+    assert ((later[spec['age']] - earlier[spec['age']]) == 10).all()
+    received = pd.Timestamp(AS_OF) - pd.to_timedelta(earlier['Days'], unit='D')
+    pd.testing.assert_series_equal(received, aggregated[page]['Adjusted 1st Rcv Date'].dt.normalize(), check_names=False,
+                                   check_index=False, check_dtype=False)
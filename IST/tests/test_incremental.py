@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+import incremental
+import regional
+
+
+@pytest.mark.parametrize('name', ['../../x', 'a/b', '..', '.hidden', 'C:\\temp\\x', ' lead', ''])
+def test_state_names_that_are_not_plain_file_names_are_refused(name, monkeypatch, tmp_path):
+    monkeypatch.setattr(incremental, 'DIRECTORY', str(tmp_path / 'state'))
+
+    with pytest.raises(ValueError, match='State names'):
+        incremental.path('regional', name)
+    with pytest.raises(ValueError, match='State names'):
+        incremental.apply(regional, 'regional', name, str(tmp_path / 'delta.xlsx'), '2024-03-01')
+    assert incremental.main(['run', 'regional', name]) == 1
+    assert not os.path.exists(tmp_path / 'state')
+
+
+def test_plain_state_names_stay_under_the_state_directory(monkeypatch, tmp_path):
+    monkeypatch.setattr(incremental, 'DIRECTORY', str(tmp_path))
+
+    target = incremental.path('regional', 'Season 24_north-1')
+
+    assert os.path.dirname(target) == os.path.join(str(tmp_path), 'regional')
@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import Future
+
+import jobs
+
+
+def test_only_the_submitting_session_sees_or_cancels_a_job(monkeypatch):
+    future = Future()
+    monkeypatch.setitem(jobs._jobs, 'job1', {
+        'id': 'job1', 'owner': 'alice', 'target': 'regional:run_pipeline', 'status': 'queued', 'submitted': time.time(),
+        'finished': None, 'error': None, 'result': None, 'notes': None, 'future': future, 'lane': 0
+    })
+    monkeypatch.setattr(jobs, '_shared', ({}, {}))
+
+    assert jobs.status('job1', 'mallory') is None
+    assert jobs.result('job1', 'mallory') is None
+    jobs.cancel('job1', 'mallory')
+    assert not future.cancelled()
+
+    assert jobs.status('job1', 'alice')['status'] == 'queued'
+    jobs.cancel('job1', 'alice')
+    assert future.cancelled()
+
+
+
+class _State(dict):
+    # Stands in for st.session_state outside a running app
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+def test_panel_converts_a_finished_job_once_per_session(monkeypatch):
+    import streamlit as st
+
+    now = time.time()
+    monkeypatch.setitem(jobs._jobs, 'job1', {
+        'id': 'job1', 'owner': 'alice', 'target': 'regional:run_pipeline', 'status': 'done', 'submitted': now - 1,
+        'finished': now, 'error': None, 'result': ({'filtered_data': 'key1'}, []), 'notes': '', 'future': None, 'lane': 0
+    })
+    fetched = []
+    monkeypatch.setattr(jobs, '_fetch', lambda kept: fetched.append(kept) or ({'filtered_data': object()}, []))
+
+    monkeypatch.setattr(st, 'session_state', _State(job_owner='alice'))
+    first = jobs.panel('job1', key='page')
+    assert jobs.panel('job1', key='page') is first
+    assert len(fetched) == 1
+
+    # Another session fetches its own copy
+    monkeypatch.setattr(st, 'session_state', _State(job_owner='alice'))
+    jobs.panel('job1', key='page')
+    assert len(fetched) == 2
+
+    # Starting another job drops the frames kept for the last one
+    jobs.remember('page', 'job2')
+    assert 'page_outputs' not in st.session_state
@@ -0,0 +1,21 @@
+import importlib
+from datetime import date
+
+import pytest
+
+import benchmark
+import parity
+
+pytest.importorskip('duckdb')
+pytest.importorskip('polars')
+
+
+@pytest.mark.parametrize('page', parity.PAGES)
+def test_engines_match_pandas_on_a_seeded_upload(page, tmp_path):
+    module = importlib.import_module(page)
+    upload = benchmark.write_uploads(benchmark.generate(page, 3_000, seed=7), str(tmp_path), page)['sales']
+
+    summary = parity.check(module, upload, date(2024, 3, 1), 60, 30, engines=['duckdb', 'polars'], as_of=date(2024, 9, 1))
+
+    assert set(summary) == {'pandas', 'duckdb', 'polars'}
+    assert summary['pandas'][1] > 0
@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+
+import snapshots
+
+pytest.importorskip('pyarrow')
+
+
+def test_listing_reads_metadata_once_per_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(snapshots, 'DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(snapshots, '_known', {})
+    reads = []
+    metadata = snapshots._metadata
+    monkeypatch.setattr(snapshots, '_metadata', lambda path: reads.append(path) or metadata(path))
+    df = pd.DataFrame({'UPC': ['a', 'b'], 'QTY': [1, 2]})
+
+    snapshots.save('digest', 'stock.xlsx', ['UPC', 'QTY'], {'QTY': 'numeric'}, df)
+    snapshots.save('other', 'sales.xlsx', None, {}, df)
+    assert len(snapshots.entries()) == 2
+    assert len(snapshots.entries()) == 2
+    assert len(reads) == 2
+
+    # A replaced snapshot is read again, with its new metadata
+    snapshots.save('digest', 'renamed.xlsx', ['UPC', 'QTY'], {'QTY': 'numeric'}, df)
+    names = {entry['name'] for entry in snapshots.entries()}
+    assert names == {'renamed.xlsx', 'sales.xlsx'}
+    assert len(reads) == 3
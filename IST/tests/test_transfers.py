@@ -0,0 +1,109 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transfers
+
+
+def greedy_reference(df, group_keys):
+    # The row-by-row walk the matcher replaced: every receiver, in row order,
+    # takes from the senders of its group in row order, skipping its own store
+    remaining = df['Transfer in/out'].to_numpy().copy()
+    keys = list(df[group_keys].itertuples(index=False, name=None))
+    stores = df['STORE_NAME'].tolist()
+    senders = np.flatnonzero(remaining > 0)
+    pairs = []
+    for receiver in np.flatnonzero(remaining < 0):
+        needed = -remaining[receiver]
+        for sender in senders:
+            if needed <= 0:
+                break
+            if keys[sender] != keys[receiver] or stores[sender] == stores[receiver] or remaining[sender] <= 0:
+                continue
+            qty = min(needed, remaining[sender])
+            remaining[sender] -= qty
+            needed -= qty
+            pairs.append((receiver, sender, qty))
+    return sorted(pairs)
+
+
+def positions(rows, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(-8, 9, rows)
+    return pd.DataFrame({
+        'Zone': rng.choice(['Z1', 'Z2'], rows),
+        'DESIGN': rng.choice([f'D{n}' for n in range(40)], rows),
+        # Few stores, so a store often both sends and receives within a group
+        'STORE_NAME': rng.choice([f'S{n}' for n in range(6)], rows),
+        'Transfer in/out': values
+    })
+
+
+@pytest.mark.parametrize('page', ['network', 'regional', 'city'])
+def test_page_transfers_match_greedy_walk(page):
+    # Each page's transfer table, as its row-by-row loop built it
+    module = importlib.import_module(page)
+    keys = module.PLAN['sell_through_keys']
+    df = positions(2_000, 3).rename(columns={'Zone': 'City'} if page == 'city' else {})
+    if page == 'network':
+        df = df.drop(columns='Zone')
+    pairs = greedy_reference(df, keys)
+    negative, positive, qty = (np.array(values, dtype=np.int64) for values in zip(*pairs))
+    sending, receiving = (negative, positive) if module.PLAN['senders_negative'] else (positive, negative)
+    expected = {key: df[key].to_numpy()[negative] for key in keys}
+    expected['Design'] = expected['DESIGN']
+    expected.update({'Sending Store': df['STORE_NAME'].to_numpy()[sending],
+                     'Receiving Store': df['STORE_NAME'].to_numpy()[receiving],
+                     'Quantity Transferred': qty})
+
+    result = module.process_transfer_details(df)
+
+    expected = pd.DataFrame(expected)[list(result.columns)]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_vectorized_matcher_matches_greedy_walk(seed):
+    df = positions(2_000, seed)
+
+    neg_idx, pos_idx, qty = transfers.match_pairs(df, ['Zone', 'DESIGN'], workers=1)
+
+    assert list(zip(neg_idx.tolist(), pos_idx.tolist(), qty.tolist())) == greedy_reference(df, ['Zone', 'DESIGN'])
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_parallel_matcher_matches_greedy_walk(monkeypatch, workers):
+    monkeypatch.setattr(transfers, 'PARALLEL_MIN_ROWS', 0)
+    df = positions(2_000, 11)
+
+    neg_idx, pos_idx, qty = transfers.match_pairs(df, ['Zone', 'DESIGN'], workers=workers)
+
+    assert list(zip(neg_idx.tolist(), pos_idx.tolist(), qty.tolist())) == greedy_reference(df, ['Zone', 'DESIGN'])
+
+
+def test_parallel_matcher_with_one_group_larger_than_the_rest(monkeypatch):
+    # The group ranges cannot split the large group, so some workers get little or nothing
+    monkeypatch.setattr(transfers, 'PARALLEL_MIN_ROWS', 0)
+    df = positions(1_000, 12)
+    df.loc[:699, ['Zone', 'DESIGN']] = ['Z1', 'D0']
+
+    neg_idx, pos_idx, qty = transfers.match_pairs(df, ['Zone', 'DESIGN'], workers=4)
+
+    assert list(zip(neg_idx.tolist(), pos_idx.tolist(), qty.tolist())) == greedy_reference(df, ['Zone', 'DESIGN'])
+
+
+def test_group_ranges_cover_every_row_once():
+    neg_group = np.sort(np.random.default_rng(0).integers(0, 50, 700))
+    pos_group = np.sort(np.random.default_rng(1).integers(0, 50, 400))
+
+    ranges = transfers._ranges(neg_group, pos_group, 4)
+
+    assert 1 < len(ranges) <= 4
+    for side, groups in ((0, neg_group), (1, pos_group)):
+        spans = [span[side] for span in ranges]
+        assert spans[0][0] == 0 and spans[-1][1] == len(groups)
+        assert all(span[1] == following[0] for span, following in zip(spans, spans[1:]))
+        # No group is split between two ranges
+        assert all(groups[end - 1] != groups[end] for _, end in spans[:-1] if 0 < end < len(groups))
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import exports
+import snapshots
+import upload_cache
+
+pytest.importorskip('pyarrow')
+
+
+def test_snapshot_reload_is_mapped_once_and_counted_as_a_snapshot_hit(monkeypatch, tmp_path):
+    monkeypatch.setattr(snapshots, 'DIRECTORY', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(snapshots, '_known', {})
+    upload = str(tmp_path / 'stock.xlsx')
+    exports.write_xlsx({'Sheet1': pd.DataFrame({'UPC': ['a', 'b', 'c'], 'QTY': [1.0, 2.0, 3.0]})}, upload)
+    upload_cache.clear()
+    upload_cache.read_excel(upload, columns=['UPC', 'QTY'], dtype={'QTY': 'numeric'})
+    upload_cache.clear()
+    before = upload_cache.stats()
+
+    reopened = upload_cache.read_excel(upload, columns=['UPC', 'QTY'], dtype={'QTY': 'numeric'})
+    again = upload_cache.read_excel(upload, columns=['UPC', 'QTY'], dtype={'QTY': 'numeric'})
+
+    after = upload_cache.stats()
+    assert 'snapshot_seconds' in reopened.attrs
+    assert (after['snapshot_hits'] - before['snapshot_hits'], after['misses'] - before['misses']) == (1, 0)
+    assert after['hits'] - before['hits'] == 1
+    # Both callers read the one mapped copy of the data
+    assert np.shares_memory(reopened['QTY'].to_numpy(), again['QTY'].to_numpy())
+    assert reopened['QTY'].tolist() == [1.0, 2.0, 3.0]
@@ -0,0 +1,274 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import pandas as pd
+import numpy as np
+
+# Shared transfer matcher for the Network, Regional and City pages.
+#
+# Every page pairs rows with a negative 'Transfer in/out' against rows with a
+# positive one inside the same group (DESIGN, plus Zone/City where relevant).
+# Negative rows are walked in row order and each one drains the positive rows
+# of its group in row order, never pairing a store with itself. Without the
+# self-exclusion that greedy walk is exactly an overlap of the two cumulative
+# sums, so those groups are paired in one vectorized pass; groups where a
+# store sits on both sides are replayed with the exact greedy loop.
+#
+# Groups never exchange stock, so large frames are split into group ranges
+# of about equal row counts and matched in a process pool. The sorted key,
+# quantity and store-code arrays are placed in shared memory once and every
+# worker reads its range from there; pairs are put back in row order, so
+# the result does not depend on how the work was split.
+
+WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_ROWS = 200_000
+
+
+def _group_ids(negative, positive, group_keys):
+    keys = pd.concat([negative[group_keys], positive[group_keys]], ignore_index=True)
+    ids = keys.groupby(group_keys, sort=False, dropna=True, observed=True).ngroup()
+    ids = ids.fillna(-1).to_numpy().astype(np.int64)
+    return ids[:len(negative)], ids[len(negative):]
+
+
+def _conflicting_groups(neg_group, neg_store, pos_group, pos_store):
+    neg = pd.DataFrame({'group': neg_group, 'store': neg_store}).drop_duplicates()
+    pos = pd.DataFrame({'group': pos_group, 'store': pos_store}).drop_duplicates()
+    both = neg.merge(pos, on=['group', 'store'])
+    return np.unique(both['group'].to_numpy())
+
+
+def overlap_pairs(neg_group, neg_qty, pos_group, pos_qty):
+    # Also pairs off flow.py's hub flows. Rows are already stable-sorted by
+    # group; lay every group out on one global axis so a single searchsorted
+    # finds the pair for each segment.
+    n_groups = int(max(neg_group.max(initial=-1), pos_group.max(initial=-1))) + 1
+    neg_total = np.bincount(neg_group, weights=neg_qty, minlength=n_groups).astype(np.int64)
+    pos_total = np.bincount(pos_group, weights=pos_qty, minlength=n_groups).astype(np.int64)
+    capacity = np.minimum(neg_total, pos_total)
+    offset = np.concatenate([[0], np.cumsum(capacity)[:-1]])
+
+    def global_ends(group, qty):
+        ends = np.cumsum(qty)
+        starts = np.concatenate([[0], np.cumsum(np.bincount(group, minlength=n_groups))[:-1]])
+        group_start_total = np.concatenate([[0], ends])[starts]
+        local = ends - group_start_total[group]
+        return offset[group] + np.minimum(local, capacity[group])
+
+    neg_ends = global_ends(neg_group, neg_qty)
+    pos_ends = global_ends(pos_group, pos_qty)
+
+    breaks = np.unique(np.concatenate([[0], neg_ends, pos_ends]))
+    seg_start = breaks[:-1]
+    seg_qty = np.diff(breaks)
+    neg_pos = np.searchsorted(neg_ends, seg_start, side='right')
+    pos_pos = np.searchsorted(pos_ends, seg_start, side='right')
+    return neg_pos, pos_pos, seg_qty
+
+
+def _greedy_pairs(neg_qty, neg_store, pos_qty, pos_store):
+    remaining = pos_qty.tolist()
+    neg_store = neg_store.tolist()
+    pos_store = pos_store.tolist()
+    n = len(remaining)
+    # next_live[j] leads to the first positive row at or after j with stock left
+    next_live = list(range(n + 1))
+
+    def live(j):
+        root = j
+        while next_live[root] != root:
+            root = next_live[root]
+        while next_live[j] != root:
+            next_live[j], j = root, next_live[j]
+        return root
+
+    neg_out, pos_out, qty_out = [], [], []
+    for i, needed in enumerate(neg_qty.tolist()):
+        j = live(0)
+        while j < n and needed > 0:
+            if pos_store[j] == neg_store[i]:
+                j = live(j + 1)
+                continue
+            qty = min(needed, remaining[j])
+            remaining[j] -= qty
+            needed -= qty
+            neg_out.append(i)
+            pos_out.append(j)
+            qty_out.append(qty)
+            if remaining[j] <= 0:
+                next_live[j] = j + 1
+            j = live(j + 1)
+    return np.array(neg_out, dtype=np.int64), np.array(pos_out, dtype=np.int64), np.array(qty_out, dtype=np.int64)
+
+
+def _store_codes(codes, missing):
+    # Missing stores get a side-specific negative code so they never match
+    # a store on the other side
+    return np.where(codes < 0, missing, codes).astype(np.int64)
+
+
+def _match(neg_group, neg_qty, neg_store, pos_group, pos_qty, pos_store):
+    # Both sides are stable-sorted by group. Returns positions into the two
+    # sides of every pair and the quantity moved, in no particular order.
+    conflicts = _conflicting_groups(neg_group, neg_store, pos_group, pos_store)
+    neg_slow = np.isin(neg_group, conflicts)
+    pos_slow = np.isin(pos_group, conflicts)
+
+    neg_idx, pos_idx, qty = [], [], []
+
+    fast_neg = np.flatnonzero(~neg_slow)
+    fast_pos = np.flatnonzero(~pos_slow)
+    if len(fast_neg) and len(fast_pos):
+        a, b, q = overlap_pairs(neg_group[fast_neg], neg_qty[fast_neg], pos_group[fast_pos], pos_qty[fast_pos])
+        neg_idx.append(fast_neg[a])
+        pos_idx.append(fast_pos[b])
+        qty.append(q)
+
+    slow_neg = np.flatnonzero(neg_slow)
+    slow_pos = np.flatnonzero(pos_slow)
+    neg_bounds = np.searchsorted(neg_group[slow_neg], conflicts, side='right')
+    pos_bounds = np.searchsorted(pos_group[slow_pos], conflicts, side='right')
+    for gn, gp in zip(np.split(slow_neg, neg_bounds[:-1]), np.split(slow_pos, pos_bounds[:-1])):
+        a, b, q = _greedy_pairs(neg_qty[gn], neg_store[gn], pos_qty[gp], pos_store[gp])
+        neg_idx.append(gn[a])
+        pos_idx.append(gp[b])
+        qty.append(q)
+
+    empty = np.array([], dtype=np.int64)
+    if not neg_idx:
+        return empty, empty, empty
+    return np.concatenate(neg_idx), np.concatenate(pos_idx), np.concatenate(qty)
+
+
+def match_pairs(df, group_keys, value_col='Transfer in/out', store_col='STORE_NAME', workers=None):
+    # Returns positional indices into df of the negative and positive row of
+    # every pair, plus the quantity moved, in the order the greedy walk emits them.
+    # workers overrides WORKERS for frames large enough to split up.
+    values = df[value_col].to_numpy()
+    neg_rows = np.flatnonzero(values < 0)
+    pos_rows = np.flatnonzero(values > 0)
+    negative = df.iloc[neg_rows]
+    positive = df.iloc[pos_rows]
+    empty = np.array([], dtype=np.int64)
+    if negative.empty or positive.empty:
+        return empty, empty, empty
+
+    neg_group, pos_group = _group_ids(negative, positive, group_keys)
+    neg_keep = neg_group >= 0
+    pos_keep = pos_group >= 0
+    neg_rows, neg_group = neg_rows[neg_keep], neg_group[neg_keep]
+    pos_rows, pos_group = pos_rows[pos_keep], pos_group[pos_keep]
+    if not len(neg_rows) or not len(pos_rows):
+        return empty, empty, empty
+
+    # Groups are independent, so both sides are laid out group by group
+    # (keeping row order within a group) and matched in group ranges
+    neg_order = np.argsort(neg_group, kind='stable')
+    pos_order = np.argsort(pos_group, kind='stable')
+    neg_rows, neg_group = neg_rows[neg_order], neg_group[neg_order]
+    pos_rows, pos_group = pos_rows[pos_order], pos_group[pos_order]
+    stores, _ = pd.factorize(df[store_col])
+    neg = np.stack([neg_group, -values[neg_rows].astype(np.int64), _store_codes(stores[neg_rows], -1)])
+    pos = np.stack([pos_group, values[pos_rows].astype(np.int64), _store_codes(stores[pos_rows], -2)])
+
+    workers = WORKERS if workers is None else workers
+    if workers > 1 and len(neg_rows) + len(pos_rows) >= PARALLEL_MIN_ROWS:
+        a, b, qty = _parallel_match(neg, pos, workers)
+    else:
+        a, b, qty = _match(*neg, *pos)
+    if not len(qty):
+        return empty, empty, empty
+    neg_idx = neg_rows[a]
+    pos_idx = pos_rows[b]
+    order = np.lexsort((pos_idx, neg_idx))
+    return neg_idx[order], pos_idx[order], qty[order]
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block again; workers
+        # share the parent's resource tracker, which drops it on unlink
+        return shared_memory.SharedMemory(name=name)
+
+
+def _match_range(neg_name, neg_len, pos_name, pos_len, neg_span, pos_span):
+    neg_block, pos_block = _attach(neg_name), _attach(pos_name)
+    try:
+        neg = np.ndarray((3, neg_len), dtype=np.int64, buffer=neg_block.buf)[:, neg_span[0]:neg_span[1]]
+        pos = np.ndarray((3, pos_len), dtype=np.int64, buffer=pos_block.buf)[:, pos_span[0]:pos_span[1]]
+        a, b, qty = _match(*neg, *pos)
+        # Results own their memory, so the views can go before the blocks close
+        del neg, pos
+        return a + neg_span[0], b + pos_span[0], qty
+    finally:
+        neg_block.close()
+        pos_block.close()
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def executor(workers):
+    # One pool per process, kept between runs and shared with flow.py's
+    # solver. Workers are spawned rather than forked because the app serves
+    # sessions from several threads.
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+
+def _ranges(neg_group, pos_group, parts):
+    # Cuts the group axis into at most parts ranges holding about equal rows
+    n_groups = int(max(neg_group[-1], pos_group[-1])) + 1
+    sizes = np.bincount(neg_group, minlength=n_groups) + np.bincount(pos_group, minlength=n_groups)
+    cumulative = np.cumsum(sizes)
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, parts) / parts, side='right')
+    cuts = np.unique(np.concatenate([[0], cuts, [n_groups]]))
+    neg_cuts = np.searchsorted(neg_group, cuts)
+    pos_cuts = np.searchsorted(pos_group, cuts)
+    return [((neg_cuts[i], neg_cuts[i + 1]), (pos_cuts[i], pos_cuts[i + 1])) for i in range(len(cuts) - 1)]
+
+
+def _shared_copy(array):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    return block
+
+
+def _parallel_match(neg, pos, workers):
+    neg_block, pos_block = _shared_copy(neg), _shared_copy(pos)
+    try:
+        pool = executor(workers)
+        futures = [pool.submit(_match_range, neg_block.name, neg.shape[1], pos_block.name, pos.shape[1], neg_span, pos_span)
+                   for neg_span, pos_span in _ranges(neg[0], pos[0], workers)]
+        results = [future.result() for future in futures]
+    finally:
+        neg_block.close()
+        neg_block.unlink()
+        pos_block.close()
+        pos_block.unlink()
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+def transfer_details(filtered_df, group_keys, senders_negative, store_col='STORE_NAME', workers=None):
+    # group_keys drive the pairing; the result keeps them alongside the
+    # 'Sending Store' / 'Receiving Store' / 'Quantity Transferred' columns.
+    neg_idx, pos_idx, qty = match_pairs(filtered_df, group_keys, store_col=store_col, workers=workers)
+    send_idx, recv_idx = (neg_idx, pos_idx) if senders_negative else (pos_idx, neg_idx)
+    stores = filtered_df[store_col].to_numpy()
+    result = {key: filtered_df[key].to_numpy()[neg_idx] for key in group_keys}
+    result['Sending Store'] = stores[send_idx]
+    result['Receiving Store'] = stores[recv_idx]
+    result['Quantity Transferred'] = qty
+    return pd.DataFrame(result)
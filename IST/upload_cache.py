@@ -0,0 +1,158 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import loader
+import snapshots
+
+# Process-wide cache of parsed uploads, shared by every session and page.
+# Entries are keyed by the SHA-256 of the uploaded bytes plus the loader
+# options; a request for a subset of the columns of a cached parse with the
+# same types is served from that parse. Least recently used entries are
+# evicted once the frames together exceed MAX_BYTES.
+#
+# Behind it, every parse is also kept on disk by snapshots.py, so other
+# processes and later runs open the stored frame instead of parsing again.
+# A snapshots.Snapshot can be passed wherever an upload is expected. An
+# opened snapshot is cached as it was mapped, without copying it.
+#
+# Callers get shallow copies: they add or replace columns, which leaves the
+# cached frame as it was, and never write into its columns in place (see
+# pipeline.py).
+
+MAX_BYTES = 1024 * 1024 * 1024
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'snapshot_hits': 0}
+
+
+def _update(digest, handle):
+    # Files are hashed in chunks so large exports are never read whole
+    for chunk in iter(lambda: handle.read(HASH_CHUNK_BYTES), b''):
+        digest.update(chunk)
+
+
+def content_hash(file):
+    if isinstance(file, snapshots.Snapshot):
+        return file.digest
+    digest = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as handle:
+            _update(digest, handle)
+    elif hasattr(file, 'getvalue'):
+        digest.update(file.getvalue())
+    else:
+        position = file.tell()
+        _update(digest, file)
+        file.seek(position)
+    return digest.hexdigest()
+
+
+def _frame_bytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _find(digest, columns, dtype):
+    kinds = {name: str(kind) for name, kind in dtype.items()}
+    for key, (df, _) in reversed(_entries.items()):
+        entry_digest, entry_columns, entry_dtype = key
+        if entry_digest == digest and snapshots.covers(entry_columns, dict(entry_dtype), df.columns, columns, kinds):
+            return key, df
+    return None, None
+
+
+def _evict():
+    total = sum(nbytes for _, nbytes in _entries.values())
+    while total > MAX_BYTES and _entries:
+        _, (_, nbytes) = _entries.popitem(last=False)
+        total -= nbytes
+        _stats['evictions'] += 1
+
+
+def _cached(digest, columns, dtype):
+    # The parse of an upload kept in memory, or None
+    with _lock:
+        key, cached = _find(digest, columns, dtype)
+        if key is not None:
+            _entries.move_to_end(key)
+            _stats['hits'] += 1
+    if cached is None:
+        return None
+    if columns is not None:
+        cached = cached[[name for name in cached.columns if name in set(columns)]]
+    df = cached.copy(deep=False)
+    df.attrs = dict(cached.attrs, cached=True)
+    df.attrs['note'] = loader.parse_report(df)
+    return df
+
+
+def _remember(digest, columns, dtype, df):
+    nbytes = _frame_bytes(df)
+    key = (digest, tuple(columns) if columns is not None else None, tuple(sorted((name, str(kind)) for name, kind in dtype.items())))
+    with _lock:
+        if nbytes <= MAX_BYTES:
+            _entries[key] = (df, nbytes)
+            _evict()
+    result = df.copy(deep=False)
+    result.attrs = dict(df.attrs)
+    return result
+
+
+def read_excel(file, columns=None, dtype=None):
+    # file can be a list of uploads read as one: those that aren't cached
+    # are parsed together by loader.read_workbooks, each is cached on its
+    # own, and their rows come back in one frame
+    dtype = dtype or {}
+    files = file if isinstance(file, list) else [file]
+    digests = [content_hash(part) for part in files]
+    frames = [_cached(digest, columns, dtype) for digest in digests]
+    for index, digest in enumerate(digests):
+        if frames[index] is None:
+            df = _open_snapshot(digest, columns, dtype)
+            if df is not None:
+                frames[index] = _remember(digest, columns, dtype, df)
+            elif isinstance(files[index], snapshots.Snapshot):
+                raise FileNotFoundError(f"The stored copy of {files[index].name} is gone; upload the file again")
+    missing = [index for index, df in enumerate(frames) if df is None]
+    if missing:
+        parsed = loader.read_workbooks([files[index] for index in missing], columns=columns, dtype=dtype)
+        with _lock:
+            _stats['misses'] += len(missing)
+        for index, df in zip(missing, parsed):
+            if snapshots.enabled():
+                snapshots.save(digests[index], snapshots.upload_name(files[index]), columns,
+                               {name: str(kind) for name, kind in dtype.items()}, df)
+            frames[index] = _remember(digests[index], columns, dtype, df)
+    if not isinstance(file, list):
+        return frames[0]
+    return loader.combine(frames, [snapshots.upload_name(part) for part in files], dtype)
+
+
+def _open_snapshot(digest, columns, dtype):
+    if not snapshots.enabled():
+        return None
+    df = snapshots.load(digest, columns, {name: str(kind) for name, kind in dtype.items()})
+    if df is None:
+        return None
+    df.attrs['note'] = loader.parse_report(df)
+    with _lock:
+        _stats['snapshot_hits'] += 1
+    return df
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_entries), bytes=sum(nbytes for _, nbytes in _entries.values()))
+
+
+def stats_report():
+    current = stats()
+    return (f"Upload cache: {current['hits']} hits, {current['snapshot_hits']} opened from snapshots, {current['misses']} parsed, "
+            f"{current['entries']} entries ({current['bytes'] / 1024 ** 2:.1f} MB)")
+
+
+def clear():
+    with _lock:
+        _entries.clear()